@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import warnings
+import statistics
+
+# ใช้ Backend ที่ไม่ต้องมีหน้าจอ (plt.show() ของตัวสร้างกราฟจะไม่บล็อก) ต้องตั้งก่อน import matplotlib
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import torch
+from PIL import Image, ImageDraw
+
+import main as evaluation
+from KeywordIndex import load_vocabulary
+from ResultStore import ResultStore
+from RougeScorer import RougeScorer
+from LLaVADentist import LLaVADentist
+from TinyLLaVA import create_tiny_llava, save_tiny_llava
+
+# --- การตั้งค่า ---
+# ไฟล์ค่าอ้างอิง (Baseline) ของเวลาแต่ละ Benchmark สร้าง/อัปเดตด้วย --update-baseline
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+# จำนวนเคสและจำนวน keyword ที่ทดสอบ
+CASE_COUNTS = (1, 4, 8)
+KEYWORD_COUNTS = (1, 4, 8)
+# จำนวนครั้งที่จับเวลาต่อ Benchmark (ใช้ค่ามัธยฐาน) หลังจากรันอุ่นเครื่อง 1 ครั้ง
+REPEATS = 3
+# ถือว่าช้าลง (Regression) เมื่อค่ามัธยฐานมากกว่า Baseline เกิน 25% และช้าลงเกิน 5 ms (ไม่นับความต่างเล็กๆ จาก noise)
+REGRESSION_TOLERANCE = 0.25
+MIN_REGRESSION_SECONDS = 0.005
+# ใช้ Thread เดียวและ Seed คงที่ เพื่อให้ผลลัพธ์และเวลาทำซ้ำได้
+BENCHMARK_THREADS = 1
+SEED = 0
+# โมเดลขนาดเล็ก: Vision Tower 24 layers และ vision_feature_layer=-2 เหมือน CLIP ViT-L/14 ของ LLaVA-1.5
+# (Layer เป้าหมายของ Grad-CAM ถูกค้นหาจาก config จึงเป็น Layer 22 เช่นเดียวกับโมเดลจริง)
+TINY_MODEL_CONFIG = {"vision_layers": 24, "text_layers": 2, "hidden_size": 64}
+TINY_LORA_RANK = 4
+# จำกัดความยาวของ Narrative (โมเดลสุ่มน้ำหนักแทบไม่สร้าง EOS จึงสร้างจนครบทุกครั้ง)
+BENCHMARK_MAX_NEW_TOKENS = 32
+SYNTHETIC_IMAGE_SIZE = (336, 224)
+# ประโยคของ Narrative สังเคราะห์ ({keyword} ถูกแทนด้วยคำศัพท์ทางคลินิก) ใช้สร้างคำศัพท์ของ Tokenizer ด้วย
+NARRATIVE_OPENING = "This intraoral photograph shows the anterior teeth."
+NARRATIVE_TEMPLATES = (
+    "There is evidence of {keyword} on the left side.",
+    "The {keyword} appears visible near the midline.",
+    "Signs of {keyword} are noted in this view.",
+)
+
+
+# --- ข้อมูลสังเคราะห์ ---
+def make_dental_image(seed, size=SYNTHETIC_IMAGE_SIZE):
+    """
+    รูปภาพสังเคราะห์ที่คล้ายภาพถ่ายฟันหน้าในช่องปาก: เหงือกบน/ล่างสีชมพู ฟัน 2 แถวสีงาช้าง
+    และรอยสีเข้ม (คล้ายฟันผุ/รอยสึก) แบบสุ่มบนฟันบางซี่
+    """
+    rng = random.Random(seed)
+    width, height = size
+    image = Image.new("RGB", size, (60, 20, 25)) # ช่องปาก (มืด)
+    draw = ImageDraw.Draw(image)
+    gum = (200 + rng.randint(-20, 20), 90 + rng.randint(-20, 20), 100 + rng.randint(-20, 20))
+    draw.rectangle([0, 0, width, height * 0.22], fill=gum)
+    draw.rectangle([0, height * 0.78, width, height], fill=gum)
+    teeth_per_row = 6
+    tooth_width = width / (teeth_per_row + 1)
+    for top, bottom in ((height * 0.18, height * 0.49), (height * 0.51, height * 0.82)):
+        for i in range(teeth_per_row):
+            left = tooth_width * (i + 0.5) + rng.uniform(-3, 3)
+            shade = rng.randint(215, 245)
+            box = [left + 2, top + rng.uniform(0, 4), left + tooth_width - 2, bottom - rng.uniform(0, 4)]
+            draw.rounded_rectangle(box, radius=tooth_width * 0.25, fill=(shade, shade - 10, shade - 35))
+            if rng.random() < 0.2:
+                cx, cy = rng.uniform(box[0] + 6, box[2] - 6), rng.uniform(box[1] + 6, box[3] - 6)
+                draw.ellipse([cx - 4, cy - 3, cx + 4, cy + 3], fill=(90, 60, 40))
+    return image
+
+def make_narrative(keywords, rng):
+    """Narrative สังเคราะห์ที่กล่าวถึง keyword ที่กำหนด (ใช้เป็นทั้ง Expert Narrative และข้อความสำหรับ XAI)"""
+    sentences = [NARRATIVE_OPENING] + [rng.choice(NARRATIVE_TEMPLATES).format(keyword=keyword) for keyword in keywords]
+    return " ".join(sentences)
+
+def make_dataset(directory, num_cases, seed=SEED):
+    """
+    สร้างชุดข้อมูลสังเคราะห์ใน directory ตามรูปแบบเดียวกับ evaluation_dataset (รูปภาพ .png และ Ground Truth .json)
+    คืนค่าลิสต์ของ path ของไฟล์ Ground Truth
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    keywords = sorted(load_vocabulary())
+    gt_paths = []
+    for i in range(num_cases):
+        case_name = f"case_{i:03d}"
+        image_path = os.path.join(directory, f"{case_name}.png")
+        make_dental_image(seed + i).save(image_path)
+        expected_keywords = rng.sample(keywords, k=min(4, len(keywords)))
+        ground_truth = {
+            "image_path": image_path,
+            "expert_narrative": make_narrative(expected_keywords, rng),
+            "anterior_teeth_findings": {str(tooth): {"status": rng.choice(["normal", "restored", "carious"]),
+                                                     "notes": "Synthetic finding."} for tooth in range(6, 12)},
+            "key_keywords_expected": expected_keywords,
+            "analysis_focus": "Synthetic benchmark case.",
+        }
+        gt_path = os.path.join(directory, f"{case_name}.json")
+        with open(gt_path, 'w', encoding='utf-8') as f: json.dump(ground_truth, f, indent=2)
+        gt_paths.append(gt_path)
+    return gt_paths
+
+def write_results(results_json_dir, gt_paths, rouge_metric, seed=SEED):
+    """เขียนผลลัพธ์สังเคราะห์ (*_result.json และ ResultStore) ของทุกเคส สำหรับทดสอบตัวสร้างกราฟสรุปผล"""
+    os.makedirs(results_json_dir, exist_ok=True)
+    result_store = ResultStore(results_json_dir)
+    rng = random.Random(seed)
+    for gt_path in gt_paths:
+        case = evaluation.load_case(gt_path)
+        expected_keywords = case["ground_truth"]["key_keywords_expected"]
+        generated_narrative = make_narrative(rng.sample(expected_keywords, k=len(expected_keywords) // 2), rng)
+        result_data = {
+            "case_name": case["case_name"], "image_path": case["image_path"], "ground_truth_path": gt_path,
+            "generated_narrative": generated_narrative,
+            "expert_narrative": case["ground_truth"]["expert_narrative"],
+            "rouge_scores": rouge_metric.compute(predictions=[generated_narrative],
+                                                 references=[case["ground_truth"]["expert_narrative"]]),
+            "xai_explanations": {},
+        }
+        evaluation.write_result(result_data, results_json_dir)
+        result_store.append(result_data, expected_keywords=expected_keywords)
+    result_store.compact()
+
+
+# --- การจับเวลา ---
+def time_call(function, repeats=REPEATS, setup=None):
+    """รัน function อุ่นเครื่อง 1 ครั้ง แล้วจับเวลา repeats ครั้ง (setup ถูกเรียกก่อนทุกครั้งและไม่นับเวลา)"""
+    timings, result = [], None
+    for i in range(repeats + 1):
+        if setup is not None: setup()
+        start_time = time.perf_counter()
+        result = function()
+        if i > 0: timings.append(time.perf_counter() - start_time)
+    return {"median_s": statistics.median(timings), "min_s": min(timings), "repeats": repeats}, result
+
+class BenchmarkSuite:
+    """
+    Benchmark บน CPU ด้วยโมเดล LLaVA ขนาดเล็กแบบสุ่มน้ำหนัก + LoRA Adapter และข้อมูลสังเคราะห์
+    (ไม่ต้องใช้ Checkpoint 7B หรือ GPU) ใช้เปรียบเทียบความเร็วก่อน/หลังการแก้ไขโค้ด
+    """
+    def __init__(self, work_dir, case_counts=CASE_COUNTS, keyword_counts=KEYWORD_COUNTS, repeats=REPEATS):
+        self.work_dir = work_dir
+        self.case_counts = case_counts
+        self.keyword_counts = keyword_counts
+        self.repeats = repeats
+        self.results = {}
+        self.failures = [] # ผลลัพธ์ที่ผิดปกติ (ไม่ใช่เรื่องเวลา) เช่น Heatmap ไม่ถูกสร้าง
+
+    def run(self):
+        torch.set_num_threads(BENCHMARK_THREADS)
+        gt_paths = make_dataset(os.path.join(self.work_dir, "dataset"), max(self.case_counts))
+        self.cases = [evaluation.load_case(gt_path) for gt_path in gt_paths]
+
+        build_start_time = time.perf_counter()
+        self.model = create_tiny_llava(corpus=[NARRATIVE_OPENING, *NARRATIVE_TEMPLATES], seed=SEED,
+                                       lora_rank=TINY_LORA_RANK, **TINY_MODEL_CONFIG)
+        build_time = time.perf_counter() - build_start_time
+        self.model.GENERATION_CONFIG = {**self.model.GENERATION_CONFIG, "max_new_tokens": BENCHMARK_MAX_NEW_TOKENS}
+        self._record("model_build", {"median_s": build_time, "min_s": build_time, "repeats": 1})
+
+        self.bench_startup()
+        self.bench_generate_narrative()
+        self.bench_generate_xai_heatmap()
+        self.bench_rouge()
+        self.bench_plotters()
+        return self.results
+
+    def bench_startup(self):
+        # เวลาโหลดโมเดลจากดิสก์ (Base Model + Processor + Adapter) แบบเดิม เทียบกับโมเดลที่ Materialize แล้ว
+        # cold_s = การโหลดครั้งแรกของแต่ละแบบใน process นี้ ค่ามัธยฐานคือการโหลดซ้ำ (warm)
+        startup_dir = os.path.join(self.work_dir, "startup")
+        base_model_path, adapter_path = save_tiny_llava(startup_dir, seed=SEED, lora_rank=TINY_LORA_RANK, **TINY_MODEL_CONFIG)
+        materialized_dir = os.path.join(startup_dir, "materialized")
+        LLaVADentist.materialize(base_model_path, adapter_path, materialized_dir)
+        for source, kwargs in (("original", {}), ("materialized", {"materialized_dir": materialized_dir})):
+            load = lambda: LLaVADentist(base_model_path, adapter_path, **kwargs)
+            cold_start_time = time.perf_counter()
+            model = load()
+            cold_time = time.perf_counter() - cold_start_time
+            if model.load_source != source:
+                self.failures.append(f"startup/{source}: loaded {model.load_source} weights")
+            timing, _ = time_call(load, self.repeats)
+            self._record(f"startup/{source}", timing, cold_s=cold_time)
+
+    def bench_generate_narrative(self):
+        for num_cases in self.case_counts:
+            image_paths = [case["image_path"] for case in self.cases[:num_cases]]
+            # ล้าง Cache ของรูปภาพก่อนทุกครั้ง เพื่อให้รวมเวลาถอดรหัสรูปภาพและ Vision Tower เหมือนการรันจริงครั้งแรก
+            timing, narratives = time_call(
+                lambda: [self.model.generate_narrative(image_path, evaluation.INSTRUCTION, seed=SEED) for image_path in image_paths],
+                self.repeats, setup=self.model.image_cache.clear)
+            self._record(f"generate_narrative/cases={num_cases}", timing, cases=num_cases)
+            timing, _ = time_call(
+                lambda: self.model.generate_narratives(image_paths, evaluation.INSTRUCTION,
+                                                       batch_size=evaluation.NARRATIVE_BATCH_SIZE, seed=SEED),
+                self.repeats, setup=self.model.image_cache.clear)
+            self._record(f"generate_narratives_batched/cases={num_cases}", timing, cases=num_cases)
+            errors = [narrative for narrative in narratives if narrative.startswith("Error: Image")]
+            if errors: self.failures.append(f"generate_narrative/cases={num_cases}: {errors[0]}")
+
+    def bench_generate_xai_heatmap(self):
+        keywords = sorted(load_vocabulary())
+        case = self.cases[0]
+        prompt = f"USER: <image>\n{evaluation.INSTRUCTION}\nASSISTANT: "
+        for num_keywords in self.keyword_counts:
+            selected = keywords[:num_keywords]
+            full_text = prompt + make_narrative(selected, random.Random(SEED))
+            if num_keywords == 1:
+                timing, heatmap = time_call(
+                    lambda: self.model.generate_xai_heatmap(case["image_path"], full_text, selected[0]), self.repeats)
+                heatmaps = {selected[0]: heatmap}
+            else:
+                timing, heatmaps = time_call(
+                    lambda: self.model.generate_xai_heatmaps(case["image_path"], full_text, selected), self.repeats)
+            self._record(f"generate_xai_heatmap/keywords={num_keywords}", timing, keywords=num_keywords)
+            missing = [keyword for keyword in selected if heatmaps.get(keyword) is None]
+            if missing: self.failures.append(f"generate_xai_heatmap/keywords={num_keywords}: no heatmap for {missing}")
+
+    def bench_rouge(self):
+        rouge_metric = RougeScorer()
+        rng = random.Random(SEED)
+        for num_cases in self.case_counts:
+            references = [case["ground_truth"]["expert_narrative"] for case in self.cases[:num_cases]]
+            predictions = [make_narrative(rng.sample(case["ground_truth"]["key_keywords_expected"], k=2), rng)
+                           for case in self.cases[:num_cases]]
+            timing, _ = time_call(lambda: [rouge_metric.compute(predictions=[prediction], references=[reference])
+                                           for prediction, reference in zip(predictions, references)], self.repeats)
+            self._record(f"rouge/cases={num_cases}", timing, cases=num_cases)
+
+    def bench_plotters(self):
+        import matplotlib.pyplot as plt
+        from CreateSummaryHeatMap import CreateHeatMap
+        from CreateRougeScore import CreateRougeMatrix
+
+        rouge_metric = RougeScorer()
+        for num_cases in self.case_counts:
+            run_dir = os.path.join(self.work_dir, f"results_{num_cases}")
+            results_json_dir = os.path.join(run_dir, "results_json")
+            os.makedirs(os.path.join(run_dir, "heatmaps"), exist_ok=True)
+            write_results(results_json_dir, [case["gt_path"] for case in self.cases[:num_cases]], rouge_metric)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore") # plt.show() บน Backend Agg
+                timing, _ = time_call(lambda: (CreateHeatMap(results_json_dir), plt.close("all")), self.repeats)
+                self._record(f"plot_summary_heatmap/cases={num_cases}", timing, cases=num_cases)
+                timing, _ = time_call(lambda: (CreateRougeMatrix(results_json_dir).generate(), plt.close("all")), self.repeats)
+                self._record(f"plot_rouge_matrix/cases={num_cases}", timing, cases=num_cases)
+
+    def _record(self, name, timing, **params):
+        self.results[name] = {**timing, **params}
+        cold = f"   cold {params['cold_s'] * 1000:9.1f} ms" if "cold_s" in params else ""
+        print(f"  {name:<44} median {timing['median_s'] * 1000:9.1f} ms   min {timing['min_s'] * 1000:9.1f} ms{cold}")
+
+
+# --- Baseline ---
+def environment_info():
+    return {"python": platform.python_version(), "torch": torch.__version__, "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(), "threads": BENCHMARK_THREADS}
+
+def compare_to_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE, min_seconds=MIN_REGRESSION_SECONDS):
+    """คืนค่าลิสต์ของข้อความ Regression (Benchmark ที่ช้ากว่า Baseline เกินเกณฑ์ หรือหายไปจากผลลัพธ์)"""
+    regressions = []
+    for name, reference in sorted(baseline["results"].items()):
+        current = results.get(name)
+        if current is None:
+            regressions.append(f"{name}: missing from this run")
+            continue
+        limit = reference["median_s"] * (1 + tolerance)
+        if current["median_s"] > limit and current["median_s"] - reference["median_s"] > min_seconds:
+            regressions.append(f"{name}: {current['median_s'] * 1000:.1f} ms vs baseline "
+                               f"{reference['median_s'] * 1000:.1f} ms (+{(current['median_s'] / reference['median_s'] - 1) * 100:.0f}%)")
+    return regressions
+
+def save_baseline(results, path=BASELINE_PATH):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"environment": environment_info(), "results": results}, f, indent=2)
+    print(f"Baseline saved to '{path}'.")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU benchmark suite with a tiny randomly initialized LLaVA + LoRA.")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="Save this run as the new baseline.")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                        help="Allowed slowdown relative to the baseline (0.25 = 25%%).")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--work-dir", default=None, help="Keep the synthetic dataset and plots here (default: temp dir).")
+    return parser.parse_args()
+
+def check_results(results, failures, baseline_path=BASELINE_PATH, update_baseline=False, tolerance=REGRESSION_TOLERANCE):
+    """
+    เปรียบเทียบผลลัพธ์กับ Baseline และคืนค่า exit code (0 = ผ่าน)
+    ถ้าไม่มีไฟล์ Baseline จะถือว่าไม่ผ่าน (ต้องสร้างด้วย --update-baseline ก่อน) เพื่อไม่ให้ CI ผ่านโดยไม่ได้เปรียบเทียบ
+    """
+    for failure in failures:
+        print(f"FAILED: {failure}")
+    if update_baseline:
+        save_baseline(results, baseline_path)
+        return 1 if failures else 0
+    if not os.path.exists(baseline_path):
+        print(f"ERROR: No baseline found at '{baseline_path}'. Run with --update-baseline to record one.")
+        return 1
+
+    with open(baseline_path, 'r', encoding='utf-8') as f: baseline = json.load(f)
+    if baseline.get("environment") != environment_info():
+        print(f"Warning: The baseline was recorded on a different environment: {baseline.get('environment')}")
+    regressions = compare_to_baseline(results, baseline, tolerance=tolerance)
+    for regression in regressions:
+        print(f"REGRESSION: {regression}")
+    return 1 if regressions or failures else 0
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.update_baseline and not os.path.exists(args.baseline):
+        # ตรวจก่อนรัน Benchmark จะได้ไม่เสียเวลารันทั้งชุดแล้วไม่ผ่าน
+        print(f"ERROR: No baseline found at '{args.baseline}'. Run with --update-baseline to record one.")
+        sys.exit(1)
+    print(f"Running benchmarks ({args.repeats} repeats, {BENCHMARK_THREADS} thread(s))...")
+    with tempfile.TemporaryDirectory(prefix="llava_benchmark_") as temp_dir:
+        suite = BenchmarkSuite(args.work_dir or temp_dir, repeats=args.repeats)
+        results = suite.run()
+    sys.exit(check_results(results, suite.failures, args.baseline, args.update_baseline, args.tolerance))
@@ -5,6 +5,8 @@ import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+from ResultStore import ResultStore, ROUGE_COLUMNS
+
 # --- การตั้งค่า ---
 # Path ไปยังโฟลเดอร์ที่สคริปต์หลักใช้บันทึกผลลัพธ์ .json
 RESULTS_DIR = "evaluation_results/results_json/"
@@ -25,7 +27,22 @@ class CreateRougeMatrix:
     def _load_scores_from_json(self):
         """
         Private method ทำหน้าที่ค้นหาไฟล์ผลลัพธ์ .json ทั้งหมด และดึงค่า ROUGE score ออกมา
+        ถ้ามีไฟล์ผลลัพธ์รวม (ResultStore) จะอ่านเฉพาะคอลัมน์ ROUGE จากไฟล์นั้นในครั้งเดียวแทน
         """
+        store = ResultStore(self.results_directory)
+        if store.exists():
+            columns = store.collect_columns(["case_name"] + ROUGE_COLUMNS)
+            all_scores = []
+            for i, case_name in enumerate(columns["case_name"]):
+                if columns["rouge1"][i] is None:
+                    print(f"Skipping case '{case_name}' as it has no valid ROUGE scores in the results store.")
+                    continue
+                rouge_scores = {column: columns[column][i] for column in ROUGE_COLUMNS}
+                rouge_scores['case'] = case_name
+                all_scores.append(rouge_scores)
+            print(f"Loaded {len(columns['case_name'])} cases from the results store.")
+            return all_scores
+
         # ค้นหาไฟล์ .json ทั้งหมดที่อยู่ในโฟลเดอร์ที่กำหนด
         json_files = glob.glob(os.path.join(self.results_directory, "*_result.json"))
         if not json_files:
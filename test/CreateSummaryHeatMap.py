@@ -6,46 +6,63 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
 
+from ResultStore import ResultStore
+from KeywordIndex import DEFAULT_VOCABULARY_PATH, load_keyword_index
+
 # --- การตั้งค่า ---
 # Path ไปยังโฟลเดอร์ที่เก็บไฟล์ผลลัพธ์ .json
 RESULTS_DIR = "evaluation_results/results_json/"
 
-def CreateHeatMap(results_directory, filename="heatmaps/evaluation_summary_heatmap.png"):
+def _load_cases(results_directory):
+    """
+    คืนค่าลิสต์ของ (case_name, generated_narrative, expected_keywords)
+    อ่านจาก ResultStore ในครั้งเดียวถ้ามี ไม่เช่นนั้นอ่านไฟล์ *_result.json และไฟล์ Ground Truth ทีละไฟล์แบบเดิม
+    """
+    store = ResultStore(results_directory)
+    if store.exists():
+        columns = store.collect_columns(["case_name", "generated_narrative", "expected_keywords"])
+        return list(zip(columns["case_name"], columns["generated_narrative"], columns["expected_keywords"]))
+
+    cases = []
+    for file_path in glob.glob(os.path.join(results_directory, "*_result.json")):
+        with open(file_path, 'r', encoding='utf-8') as f: result_data = json.load(f)
+        case_name = result_data["case_name"]
+        expected_keywords = []
+        # แปลงตัวคั่น path แบบ Windows (backslash) ให้ใช้ได้ทุกระบบปฏิบัติการ
+        ground_truth_path = result_data.get("ground_truth_path", "").replace("\\", "/")
+        try:
+            with open(ground_truth_path, 'r', encoding='utf-8') as gt_f:
+                expected_keywords = json.load(gt_f).get("key_keywords_expected", [])
+        except FileNotFoundError:
+            print(f"Warning: Ground truth file not found for {case_name}.")
+        cases.append((case_name, result_data.get("generated_narrative", ""), expected_keywords))
+    return cases
+
+def CreateHeatMap(results_directory, filename="heatmaps/evaluation_summary_heatmap.png", vocabulary_path=DEFAULT_VOCABULARY_PATH):
     """
     อ่านไฟล์ผลลัพธ์ JSON จากการประเมิน แล้วสร้าง Heatmap สรุปผลการทำงาน (.png)
     """
     print("\n--- Generating Final Summary Heatmap ---")
     
-    # 1. ค้นหาไฟล์ผลลัพธ์ .json ทั้งหมด
-    json_files = glob.glob(os.path.join(results_directory, "*_result.json"))
-    if not json_files:
+    # 1. อ่านเฉพาะคอลัมน์ที่ต้องใช้จากไฟล์ผลลัพธ์รวมในครั้งเดียว (หรืออ่านไฟล์ .json ทีละไฟล์ถ้ายังไม่มีไฟล์รวม)
+    cases = _load_cases(results_directory)
+    if not cases:
         print(f"Error: No result files found in '{results_directory}' to create a heatmap.")
         return
 
-    # 2. กำหนด Keywords ทั้งหมดที่จะใช้เป็นคอลัมน์ใน Heatmap
-    all_relevant_keywords = sorted([
-        "anterior", "bone", "canine", "central incisor", "crown", "fracture", 
-        "incisor", "lateral incisor", "lesion", "loss", "mandibular", "maxillary", 
-        "normal", "pathology", "periapical", "restoration", "untreated"
-    ])
+    # 2. กำหนด Keywords ทั้งหมดที่จะใช้เป็นคอลัมน์ใน Heatmap (จากไฟล์คำศัพท์เดียวกับ main.py)
+    keyword_index = load_keyword_index(vocabulary_path)
+    all_relevant_keywords = sorted(keyword_index.keywords)
 
     # 3. ประมวลผลไฟล์ JSON แต่ละไฟล์เพื่อสร้างข้อมูลสำหรับ Heatmap
     evaluation_data = []
-    for file_path in json_files:
-        with open(file_path, 'r', encoding='utf-8') as f: result_data = json.load(f)
-        case_name = result_data["case_name"]
-        generated_narrative_lower = result_data.get("generated_narrative", "").lower()
-        expected_keywords = set()
-        try:
-            with open(result_data["ground_truth_path"], 'r', encoding='utf-8') as gt_f:
-                ground_truth = json.load(gt_f)
-                expected_keywords = set(ground_truth.get("key_keywords_expected", []))
-        except FileNotFoundError:
-            print(f"Warning: Ground truth file not found for {case_name}.")
+    for case_name, generated_narrative, expected_keywords in cases:
+        mentioned_keywords = keyword_index.mentioned(generated_narrative or "")
+        expected_keywords = set(expected_keywords or [])
         
         for keyword in all_relevant_keywords:
             score = 0  # 0 = Not Applicable (ไม่เกี่ยวข้อง)
-            if keyword in generated_narrative_lower:
+            if keyword in mentioned_keywords:
                 score = 2  # 2 = Mentioned (พูดถึง)
             elif keyword in expected_keywords:
                 score = 1  # 1 = Omission (มองข้าม)
@@ -0,0 +1,105 @@
+import math
+import time
+
+import torch
+
+
+def vit_gradcam(feature_maps, gradients, drop_cls=True, normalize=True):
+    """
+    คำนวณ Grad-CAM ของ Vision Transformer แบบ Vectorized (ไม่มีลูป Python)
+
+    Args:
+        feature_maps: Feature Map ของ Layer เป้าหมาย รูปแบบ (tokens, hidden) หรือ (batch, tokens, hidden)
+                      โดย batch เป็น 1 (ใช้ร่วมกันทุก keyword) หรือเท่ากับจำนวน Gradient
+        gradients:    Gradient เทียบกับ Feature Map รูปแบบ (tokens, hidden) หรือ (K, tokens, hidden)
+                      โดย K คือจำนวน keyword ที่ต้องการคำนวณพร้อมกัน
+        drop_cls:     ตัด CLS token (ตำแหน่งแรก) ออกก่อนจัดเรียงเป็นตาราง Patch
+        normalize:    ปรับค่าสูงสุดของแต่ละ Heatmap ให้เป็น 1
+
+    Returns:
+        Tensor รูปแบบ (K, grid, grid) เช่น (K, 24, 24) สำหรับ 576 Patch ของ CLIP ViT-L/14 ที่ 336px
+    """
+    if feature_maps.dim() == 2: feature_maps = feature_maps.unsqueeze(0)
+    if gradients.dim() == 2: gradients = gradients.unsqueeze(0)
+    feature_maps = feature_maps.detach().float()
+    gradients = gradients.detach().float()
+    if drop_cls:
+        feature_maps, gradients = feature_maps[:, 1:], gradients[:, 1:]
+
+    num_patches, hidden_size = feature_maps.shape[1], feature_maps.shape[2]
+    grid_size = math.isqrt(num_patches)
+    if grid_size * grid_size != num_patches:
+        raise ValueError(f"Cannot reshape {num_patches} patch tokens into a square grid.")
+
+    # น้ำหนักของแต่ละ Channel = ค่าเฉลี่ยของ Gradient บนทุก Patch (Global Average Pooling)
+    weights = gradients.mean(dim=1) # (K, hidden)
+    # ผลรวมถ่วงน้ำหนักของ Feature Map บนแกน Channel (หารด้วย hidden ให้เป็นค่าเฉลี่ยแบบเดิม)
+    if feature_maps.shape[0] == 1:
+        cam = (weights @ feature_maps[0].T) / hidden_size # (K, patches) ด้วย matmul ครั้งเดียว
+    else:
+        cam = torch.einsum("kph,kh->kp", feature_maps, weights) / hidden_size
+    cam = torch.relu(cam).reshape(-1, grid_size, grid_size)
+
+    if normalize:
+        # เพิ่มการจัดการ Normalization ที่ทนทาน (ไม่หารถ้าค่าสูงสุดใกล้ศูนย์เกินไป)
+        max_vals = cam.amax(dim=(1, 2), keepdim=True)
+        cam = torch.where(max_vals > 1e-6, cam / max_vals.clamp_min(1e-6), cam)
+    return cam
+
+def multi_layer_gradcam(feature_maps, gradients, drop_cls=True):
+    """
+    Grad-CAM จากหลาย Layer: ค่าเฉลี่ยของ Heatmap ที่ Normalize แล้วของแต่ละ Layer แล้ว Normalize อีกครั้ง
+    feature_maps / gradients เป็นลิสต์ (1 รายการต่อ Layer) ตามรูปแบบของ vit_gradcam
+    Layer ที่ Gradient เป็น None (ไม่มีผลต่อเป้าหมาย) จะถูกข้าม
+    """
+    cams = [vit_gradcam(feature_map, gradient, drop_cls=drop_cls)
+            for feature_map, gradient in zip(feature_maps, gradients) if gradient is not None]
+    if not cams:
+        raise ValueError("No target layer has gradients for Grad-CAM.")
+    if len(cams) == 1:
+        return cams[0]
+    cam = torch.stack(cams).mean(dim=0)
+    max_vals = cam.amax(dim=(1, 2), keepdim=True)
+    return torch.where(max_vals > 1e-6, cam / max_vals.clamp_min(1e-6), cam)
+
+def _loop_gradcam(feature_maps, gradients, drop_cls=True):
+    """วิธีเดิมแบบวนลูปทีละ Channel และทีละ keyword (ใช้เป็นค่าอ้างอิงในการเปรียบเทียบความเร็วและความถูกต้อง)"""
+    heatmaps = []
+    for gradient in gradients:
+        last_feature_maps = feature_maps.detach().float().clone()
+        gradient = gradient.detach().float()
+        if drop_cls:
+            last_feature_maps, gradient = last_feature_maps[1:], gradient[1:]
+        pooled_gradients = torch.mean(gradient, dim=0)
+        for i in range(last_feature_maps.shape[1]): last_feature_maps[:, i] *= pooled_gradients[i]
+        heatmap = torch.relu(torch.mean(last_feature_maps, dim=1))
+        grid_size = math.isqrt(heatmap.shape[0])
+        heatmap = heatmap.reshape(grid_size, grid_size)
+        max_val = heatmap.max()
+        if max_val > 1e-6: heatmap /= max_val
+        heatmaps.append(heatmap)
+    return torch.stack(heatmaps)
+
+def benchmark(num_keywords=17, num_tokens=577, hidden_size=1024, repeats=5):
+    """เปรียบเทียบเวลาและผลลัพธ์ระหว่าง vit_gradcam และวิธีวนลูปเดิม บนข้อมูลสุ่ม"""
+    feature_maps = torch.randn(num_tokens, hidden_size)
+    gradients = torch.randn(num_keywords, num_tokens, hidden_size)
+
+    start = time.perf_counter()
+    for _ in range(repeats): vectorized = vit_gradcam(feature_maps, gradients)
+    vectorized_time = (time.perf_counter() - start) / repeats
+
+    start = time.perf_counter()
+    for _ in range(repeats): looped = _loop_gradcam(feature_maps, gradients)
+    loop_time = (time.perf_counter() - start) / repeats
+
+    grid_size = math.isqrt(num_tokens - 1)
+    assert vectorized.shape == (num_keywords, grid_size, grid_size), vectorized.shape
+    assert torch.allclose(vectorized, looped, atol=1e-4), "Vectorized Grad-CAM does not match the loop reference."
+    print(f"Grad-CAM for {num_keywords} keyword(s) on {num_tokens}x{hidden_size} tokens -> {tuple(vectorized.shape)}")
+    print(f"  loop:       {loop_time * 1000:.2f} ms")
+    print(f"  vectorized: {vectorized_time * 1000:.2f} ms ({loop_time / vectorized_time:.1f}x faster)")
+    return {"loop_ms": loop_time * 1000, "vectorized_ms": vectorized_time * 1000}
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,104 @@
+import os
+import json
+import argparse
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+from HeatmapStore import HeatmapStore, overlay_filename
+from Profiler import profile
+from ResultStore import ResultStore
+
+# --- การตั้งค่า ---
+RESULTS_DIR = "evaluation_results/results_json/"
+HEATMAPS_DIR = "evaluation_results/heatmaps/"
+
+
+@lru_cache(maxsize=None)
+def _half_colormap_lut(colormap=cv2.COLORMAP_JET):
+    """
+    ตารางสี (LUT) ของ colormap ที่คำนวณไว้ครั้งเดียว รูปแบบ (256, 3) BGR
+    เก็บค่าที่หารครึ่งแล้ว (alpha=0.5) เป็น uint16 เพื่อให้การซ้อนภาพเป็นการบวกจำนวนเต็มล้วน
+    (floor(สี * 0.5 + รูป) = สี // 2 + รูป สำหรับค่าจำนวนเต็ม จึงได้ผลเท่ากับวิธีเดิมทุกพิกเซล)
+    """
+    lut = cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), colormap).reshape(256, 3)
+    return (lut >> 1).astype(np.uint16)
+
+def superimpose_batch(image_bgr, heatmaps):
+    """
+    ซ้อน Heatmap หลายอันบนรูปภาพเดียวพร้อมกัน
+    Args:
+        image_bgr: รูปภาพ BGR (H, W, 3) uint8
+        heatmaps:  Heatmap ดิบ (grid, grid) หรือ (K, grid, grid) ค่า 0-1
+    Returns:
+        numpy array (K, H, W, 3) uint8
+    """
+    heatmaps = np.asarray(heatmaps, dtype=np.float32)
+    if heatmaps.ndim == 2: heatmaps = heatmaps[None]
+    height, width = image_bgr.shape[:2]
+    with profile("render_overlay", overlays=heatmaps.shape[0]):
+        # ปรับขนาดทุก Heatmap ในการเรียก cv2.resize ครั้งเดียว (แต่ละ Heatmap เป็น 1 channel)
+        resized = cv2.resize(np.ascontiguousarray(heatmaps.transpose(1, 2, 0)), (width, height))
+        resized = resized.reshape(height, width, -1).transpose(2, 0, 1)
+        indices = np.uint8(255 * np.clip(resized, 0, 1))
+        blended = _half_colormap_lut()[indices] + image_bgr.astype(np.uint16) # (K, H, W, 3)
+        return np.minimum(blended, 255).astype(np.uint8)
+
+def superimpose(image_bgr, heatmap):
+    """ซ้อน Heatmap อันเดียวบนรูปภาพ (JET colormap, alpha=0.5)"""
+    return superimpose_batch(image_bgr, heatmap)[0]
+
+def load_explanations(results_directory, case_name):
+    """อ่าน xai_explanations ของเคสจากไฟล์ <case>_result.json (dict ว่างถ้าไม่มีไฟล์)"""
+    result_path = os.path.join(results_directory, f"{case_name}_result.json")
+    if not os.path.exists(result_path):
+        return {}
+    with open(result_path, 'r', encoding='utf-8') as f:
+        return json.load(f).get("xai_explanations") or {}
+
+def render_overlays(results_directory=RESULTS_DIR, output_directory=HEATMAPS_DIR, cases=None, keywords=None):
+    """
+    สร้างภาพ Overlay (JPG) จาก HeatmapStore เมื่อต้องการดูเท่านั้น (ไม่ได้สร้างระหว่างการประเมินผล)
+    สร้างเฉพาะ keyword ที่อยู่ใน xai_explanations ของผลลัพธ์แต่ละเคส และตั้งชื่อไฟล์ตาม mentioned_in_narrative
+    ที่บันทึกไว้ (ตรงกับ overlay_path ในผลลัพธ์)
+    cases / keywords จำกัดเฉพาะเคสหรือ keyword ที่ต้องการ (None = ทั้งหมด)
+    คืนค่าลิสต์ของ path ที่เขียน
+    """
+    heatmap_store = HeatmapStore(results_directory)
+    maps, stored_rows, written = heatmap_store.as_array(), heatmap_store.rows(), []
+    os.makedirs(output_directory, exist_ok=True)
+    for row in ResultStore(results_directory).rows():
+        case_name = row["case_name"]
+        if cases is not None and case_name not in cases:
+            continue
+        explanations = {keyword: explanation for keyword, explanation in load_explanations(results_directory, case_name).items()
+                        if (keywords is None or keyword in keywords) and (case_name, keyword) in stored_rows}
+        if not explanations:
+            continue
+        image = cv2.imread(row["image_path"]) if row.get("image_path") else None
+        if image is None:
+            print(f"Warning: Image for '{case_name}' not found. Skipping its overlays.")
+            continue
+        # ซ้อนทุก keyword ของเคสนี้พร้อมกันในครั้งเดียว
+        overlays = superimpose_batch(image, maps[[stored_rows[(case_name, keyword)] for keyword in explanations]])
+        for (keyword, explanation), overlay in zip(explanations.items(), overlays):
+            filename = overlay_filename(case_name, keyword, explanation.get("mentioned_in_narrative", True))
+            path = os.path.join(output_directory, filename)
+            with profile("io.write_overlay"):
+                cv2.imwrite(path, overlay)
+            written.append(path)
+    print(f"Rendered {len(written)} heatmap overlay(s) to '{output_directory}'.")
+    return written
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Render JET heatmap overlays from the raw heatmap store.")
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("--output-dir", default=HEATMAPS_DIR)
+    parser.add_argument("--case", action="append", help="Only render this case (repeatable).")
+    parser.add_argument("--keyword", action="append", help="Only render this keyword (repeatable).")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    render_overlays(args.results_dir, args.output_dir, cases=args.case, keywords=args.keyword)
@@ -0,0 +1,229 @@
+import os
+import json
+import threading
+
+import numpy as np
+
+# --- การตั้งค่า ---
+# Heatmap ดิบถูกเก็บเป็น float16 (24x24 = 1,152 bytes ต่อ keyword) แทนภาพ JPG ความละเอียดเต็ม
+HEATMAP_DTYPE = np.float16
+
+
+def heatmap_key(case_name, keyword):
+    return f"{case_name}/{keyword}"
+
+def overlay_filename(case_name, keyword, mentioned=True):
+    """ชื่อไฟล์ภาพ Overlay (JPG) ของ keyword หนึ่ง (keyword ที่ไม่ปรากฏใน Narrative ลงท้ายด้วย _omitted)"""
+    return f"{case_name}_heatmap_{keyword}{'' if mentioned else '_omitted'}.jpg"
+
+
+class HeatmapStore:
+    """
+    ที่เก็บ Heatmap ดิบ (Attribution map ก่อนใส่สีและซ้อนบนรูปภาพ) ของทั้งการรัน
+    - <name>.f16         : ข้อมูล float16 ของทุก Heatmap ต่อท้ายกันไปเรื่อยๆ (Append-only, ไม่มี header)
+    - <name>.index.json  : Snapshot ของขนาดตาราง (grid) และลำดับแถวของแต่ละ (case, keyword) ล่าสุด
+    - <name>.index.log   : การเปลี่ยนแปลงของ index หลัง Snapshot (1 บรรทัด JSON ต่อการเพิ่ม/ลบ, Append-only)
+    ไฟล์ข้อมูลไม่มี header จึงต่อท้ายได้โดยไม่ต้องเขียนไฟล์ใหม่ และอ่านทั้งหมดแบบ memory-mapped ได้ด้วย as_array()
+    index ถูกเก็บในหน่วยความจำ การ put จึงต่อท้ายเพียงแถวข้อมูลและบรรทัด log (ไม่เขียน index ทั้งไฟล์ใหม่)
+    flush() รวม log เข้ากับ Snapshot Heatmap ที่ถูกบันทึกซ้ำจะใช้แถวล่าสุดเสมอ
+    แถวเก่าที่ไม่มี index ชี้ถึงแล้วยังอยู่ในไฟล์ข้อมูลจนกว่าจะเรียก compact() (เรียกเมื่อจบการรันหรือการรวม Shard)
+    """
+    def __init__(self, directory, name="heatmaps_raw"):
+        self.data_path = os.path.join(directory, f"{name}.f16")
+        self.index_path = os.path.join(directory, f"{name}.index.json")
+        self.log_path = os.path.join(directory, f"{name}.index.log")
+        self.compact_path = os.path.join(directory, f"{name}.index.compact") # Snapshot ของ compact() ที่ยังทำไม่เสร็จ
+        self._lock = threading.Lock() # put จาก Writer หลาย Thread พร้อมกันได้
+        self._index = None
+        self._stamp = None # สถานะไฟล์ตอนโหลด index (ใช้ตรวจว่ามีการแก้ไขจากภายนอกหรือไม่)
+
+    def exists(self):
+        return os.path.exists(self.data_path) and (os.path.exists(self.index_path) or os.path.exists(self.log_path))
+
+    def put(self, case_name, keyword, heatmap):
+        """บันทึก (หรือแทนที่) Heatmap ของ keyword หนึ่งในเคสหนึ่ง"""
+        heatmap = np.ascontiguousarray(heatmap, dtype=HEATMAP_DTYPE)
+        with self._lock:
+            index = self._current_index()
+            self._write_log(self._append(index, case_name, keyword, heatmap))
+
+    def put_case(self, case_name, heatmaps):
+        """
+        แทนที่ Heatmap ทั้งหมดของเคสหนึ่งด้วย heatmaps ({keyword: heatmap})
+        - keyword ที่มีแถวเดิมค่าเท่ากันอยู่แล้วจะไม่ถูกเขียนซ้ำ (ไฟล์ข้อมูลไม่โตขึ้นเมื่อรันซ้ำ)
+        - keyword ของเคสนี้ที่ไม่อยู่ใน heatmaps (หรือมีค่าเป็น None) จะถูกลบออกจาก index
+        """
+        heatmaps = {keyword: heatmap for keyword, heatmap in heatmaps.items() if heatmap is not None}
+        with self._lock:
+            index = self._current_index()
+            stored = self.as_array(index)
+            prefix, changes = heatmap_key(case_name, ""), []
+            for key in [key for key in index["rows"] if key.startswith(prefix)]:
+                if key[len(prefix):] not in heatmaps:
+                    del index["rows"][key]
+                    changes.append({"key": key, "row": None})
+            for keyword, heatmap in heatmaps.items():
+                heatmap = np.ascontiguousarray(heatmap, dtype=HEATMAP_DTYPE)
+                row = index["rows"].get(heatmap_key(case_name, keyword))
+                if row is None or not np.array_equal(stored[row], heatmap):
+                    changes.extend(self._append(index, case_name, keyword, heatmap))
+            self._write_log(changes)
+
+    def flush(self):
+        """เขียน Snapshot ของ index ใหม่และลบ log (compact() ทำขั้นนี้ด้วย)"""
+        with self._lock:
+            if not os.path.exists(self.log_path):
+                return
+            index = self._current_index()
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+            # ถ้าหยุดกลางคันก่อนลบ log การเล่น log ซ้ำบน Snapshot ใหม่ก็ได้ผลเท่าเดิม
+            os.remove(self.log_path)
+            self._stamp = self._file_stamp()
+
+    def compact(self):
+        """
+        เขียนไฟล์ข้อมูลใหม่ให้เหลือเฉพาะแถวที่ index ชี้ถึง (ลดขนาดไฟล์หลังการรันหลายครั้ง) แล้วเขียน Snapshot ใหม่และลบ log
+        แถวที่เหลือเรียงตามลำดับเดิม ถ้าไม่มีแถวเก่าเลยไฟล์ข้อมูลจะเหมือนเดิมทุก byte
+        """
+        with self._lock:
+            if not self.exists():
+                return
+            index = self._current_index()
+            stored = self.as_array(index)
+            keys = sorted(index["rows"], key=index["rows"].get)
+            compacted = {"shape": index["shape"], "rows": {key: row for row, key in enumerate(keys)}}
+            tmp_path = self.data_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                for key in keys:
+                    f.write(np.ascontiguousarray(stored[index["rows"][key]]).tobytes())
+                compacted["data_size"] = f.tell()
+            del stored # ปิด memmap ก่อนแทนที่ไฟล์ข้อมูล
+            # บันทึก Snapshot ใหม่ก่อนแทนที่ไฟล์ข้อมูล ถ้าหยุดกลางคัน _load_index จะทำขั้นที่เหลือต่อให้จบ (ดู _finish_compaction)
+            with open(self.compact_path, 'w', encoding='utf-8') as f: json.dump(compacted, f)
+            os.replace(tmp_path, self.data_path)
+            self._finish_compaction()
+            self._index, self._stamp = compacted, self._file_stamp()
+
+    def get(self, case_name, keyword):
+        """คืนค่า Heatmap (float32) หรือ None ถ้าไม่มี"""
+        if not self.exists():
+            return None
+        with self._lock: index = self._current_index()
+        row = index["rows"].get(heatmap_key(case_name, keyword))
+        if row is None:
+            return None
+        return self.as_array(index)[row].astype(np.float32)
+
+    def keys(self):
+        """คืนค่าลิสต์ของ (case_name, keyword) ทั้งหมดในที่เก็บ เรียงตามชื่อ"""
+        if not self.exists():
+            return []
+        with self._lock: index = self._current_index()
+        return [tuple(key.split("/", 1)) for key in sorted(index["rows"])]
+
+    def as_array(self, index=None):
+        """
+        Heatmap ทุกแถวในไฟล์แบบ memory-mapped (อ่านอย่างเดียว) รูปแบบ (rows, grid, grid)
+        ใช้คู่กับ rows() เพื่อหาแถวของแต่ละ (case, keyword) โดยไม่ต้องโหลดทั้งไฟล์เข้าหน่วยความจำ
+        """
+        if index is None:
+            with self._lock: index = self._current_index()
+        if index["shape"] is None or not os.path.exists(self.data_path) or not os.path.getsize(self.data_path):
+            return np.zeros((0, 0, 0), dtype=HEATMAP_DTYPE)
+        row_size = int(np.prod(index["shape"]))
+        num_rows = os.path.getsize(self.data_path) // (row_size * np.dtype(HEATMAP_DTYPE).itemsize)
+        return np.memmap(self.data_path, dtype=HEATMAP_DTYPE, mode="r", shape=(num_rows, *index["shape"]))
+
+    def rows(self):
+        """คืนค่า dict {(case_name, keyword): ลำดับแถวใน as_array()}"""
+        if not self.exists():
+            return {}
+        with self._lock: index = self._current_index()
+        return {tuple(key.split("/", 1)): row for key, row in index["rows"].items()}
+
+    def _append(self, index, case_name, keyword, heatmap):
+        # ต่อท้ายแถวใหม่ในไฟล์ข้อมูลและชี้ index ไปที่แถวนั้น คืนค่ารายการเปลี่ยนแปลงสำหรับ log (ผู้เรียกถือ lock)
+        changes = []
+        if index["shape"] is None:
+            index["shape"] = list(heatmap.shape)
+            changes.append({"shape": index["shape"]})
+        elif list(heatmap.shape) != index["shape"]:
+            raise ValueError(f"Heatmap shape {heatmap.shape} does not match the store shape {tuple(index['shape'])}.")
+        row_bytes = heatmap.nbytes
+        os.makedirs(os.path.dirname(self.data_path) or ".", exist_ok=True)
+        with open(self.data_path, "ab+") as f:
+            size = f.seek(0, os.SEEK_END)
+            if size % row_bytes: # แถวสุดท้ายเขียนไม่สมบูรณ์ (process ถูกหยุดกลางคัน) ตัดทิ้ง
+                f.truncate(size - size % row_bytes)
+                size -= size % row_bytes
+            f.write(heatmap.tobytes())
+        key = heatmap_key(case_name, keyword)
+        index["rows"][key] = size // row_bytes
+        changes.append({"key": key, "row": index["rows"][key]})
+        return changes
+
+    def _write_log(self, changes):
+        if changes:
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write("".join(json.dumps(change) + "\n" for change in changes))
+        self._stamp = self._file_stamp()
+
+    def _file_stamp(self):
+        stamp = []
+        for path in (self.data_path, self.index_path, self.log_path):
+            try:
+                stat = os.stat(path)
+                stamp.append((stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _current_index(self):
+        # ใช้ index ในหน่วยความจำ ถ้าไฟล์ไม่ถูกแก้ไขจากภายนอกตั้งแต่ครั้งล่าสุด (ผู้เรียกถือ lock)
+        stamp = self._file_stamp()
+        if self._index is None or stamp != self._stamp:
+            self._index, self._stamp = self._load_index(), stamp
+        return self._index
+
+    def _finish_compaction(self):
+        # compact() ถูกหยุดกลางคัน: ถ้าไฟล์ข้อมูลถูกแทนที่แล้ว (ขนาดตรงกับ Snapshot ของ compact) ใช้ Snapshot นั้นและลบ log
+        # ไม่เช่นนั้นไฟล์ข้อมูลยังเป็นไฟล์เดิม จึงทิ้ง Snapshot ของ compact (ถ้าขนาดเท่ากัน แสดงว่าไม่มีแถวเก่า ไฟล์ทั้งสองจึงเหมือนกัน)
+        if not os.path.exists(self.compact_path):
+            return
+        try:
+            with open(self.compact_path, 'r', encoding='utf-8') as f: compacted = json.load(f)
+        except (OSError, ValueError):
+            compacted = None # Snapshot เขียนไม่สมบูรณ์ (หยุดก่อนแทนที่ไฟล์ข้อมูล)
+        if compacted is not None and os.path.exists(self.data_path) and os.path.getsize(self.data_path) == compacted["data_size"]:
+            os.replace(self.compact_path, self.index_path)
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+        else:
+            os.remove(self.compact_path)
+
+    def _load_index(self):
+        index = {"shape": None, "rows": {}}
+        self._finish_compaction()
+        if not os.path.exists(self.data_path):
+            return index
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f: index = json.load(f)
+            except (OSError, ValueError):
+                pass
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        continue # บรรทัดสุดท้ายเขียนไม่สมบูรณ์ (process ถูกหยุดกลางคัน)
+                    if "shape" in change:
+                        index["shape"] = change["shape"]
+                    elif change["row"] is None:
+                        index["rows"].pop(change["key"], None)
+                    else:
+                        index["rows"][change["key"]] = change["row"]
+        return index
@@ -0,0 +1,130 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from PIL import Image
+
+from Profiler import profile
+from ResultCache import atomic_write
+
+
+class CachedImage:
+    """
+    ข้อมูลของรูปภาพหนึ่งรูปที่ถูกเก็บไว้ใน Cache
+    - image:          รูปภาพที่ถอดรหัสแล้ว (PIL, RGB)
+    - pixel_values:   Tensor ที่ผ่าน Image Processor แล้ว (เก็บบน CPU)
+    - image_features: Image Embeddings ที่ผ่าน Vision Tower และ multi_modal_projector แล้ว (เก็บบน CPU)
+    """
+    def __init__(self, key, image, pixel_values=None, image_features=None):
+        self.key = key
+        self.image = image
+        self.pixel_values = pixel_values
+        self.image_features = image_features
+        self._image_bgr = None
+
+    @property
+    def image_bgr(self):
+        """รูปภาพในรูปแบบ BGR (numpy) สำหรับใช้กับ OpenCV แทนการเรียก cv2.imread ซ้ำ"""
+        if self._image_bgr is None:
+            self._image_bgr = np.ascontiguousarray(np.asarray(self.image)[:, :, ::-1])
+        return self._image_bgr
+
+
+class ImageFeatureCache:
+    """
+    Cache ของรูปภาพและ Feature ของรูปภาพ โดยใช้ค่า Hash ของเนื้อหาไฟล์ (SHA-256) เป็น key
+    มี 2 ระดับ:
+    1. หน่วยความจำ (LRU) จำกัดจำนวนรายการด้วย max_entries
+    2. ดิสก์ (ไม่บังคับ) เก็บไฟล์ .pt ใน disk_dir เพื่อให้การรันครั้งถัดไปข้ามการถอดรหัสรูปภาพและ Preprocessing ได้
+    """
+    def __init__(self, max_entries=16, disk_dir=None, namespace=""):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        # namespace ใช้แยก Cache บนดิสก์ของโมเดล/Processor คนละตัว ไม่ให้ปนกัน
+        self.namespace = hashlib.sha256(namespace.encode("utf-8")).hexdigest()[:12]
+        self._entries = OrderedDict()
+        self._path_keys = {} # จำค่า hash ของแต่ละ path ไว้ (ตรวจสอบด้วย mtime และขนาดไฟล์)
+        self._lock = threading.Lock() # ใช้ร่วมกันได้ระหว่าง Thread (เช่น Prefetch และ Writer ของ Pipeline)
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def key_for(self, image_path):
+        """คำนวณ (หรือดึงค่าที่จำไว้) Hash ของเนื้อหาไฟล์รูปภาพ"""
+        stat = os.stat(image_path)
+        abs_path = os.path.abspath(image_path)
+        with self._lock:
+            cached = self._path_keys.get(abs_path)
+        if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            return cached[1]
+        with open(image_path, "rb") as f:
+            key = hashlib.sha256(f.read()).hexdigest()
+        with self._lock:
+            self._path_keys[abs_path] = ((stat.st_mtime_ns, stat.st_size), key)
+        return key
+
+    def get(self, image_path):
+        """
+        คืนค่า CachedImage ของรูปภาพ โดยค้นหาจากหน่วยความจำ -> ดิสก์ -> ถอดรหัสไฟล์ใหม่ ตามลำดับ
+        จะ raise FileNotFoundError ถ้าไม่พบไฟล์รูปภาพ
+        """
+        key = self.key_for(image_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        entry = self._load_from_disk(key)
+        if entry is None:
+            # โหลดรูปภาพจาก path ที่กำหนด และแปลงเป็น RGB
+            with profile("io.image_decode"):
+                entry = CachedImage(key, Image.open(image_path).convert("RGB"))
+        self._remember(entry)
+        return entry
+
+    def save(self, entry):
+        """บันทึกรายการลงดิสก์ (เรียกหลังจากคำนวณ pixel_values / image_features แล้ว)"""
+        if not self.disk_dir:
+            return
+        data = {"image": torch.from_numpy(np.asarray(entry.image).copy())}
+        if entry.pixel_values is not None:
+            data["pixel_values"] = entry.pixel_values
+        if entry.image_features is not None:
+            data["image_features"] = entry.image_features
+        path = self._disk_path(entry.key)
+        with profile("io.image_cache_write"):
+            # เขียนแบบ atomic ป้องกันไฟล์เสียถ้า process ถูกหยุดกลางคัน (ไฟล์ชั่วคราวไม่ซ้ำกันระหว่าง Thread/Shard)
+            atomic_write(path, lambda f: torch.save(data, f))
+
+    def clear(self):
+        """ล้าง Cache ในหน่วยความจำ (ไม่ลบไฟล์บนดิสก์)"""
+        with self._lock:
+            self._entries.clear()
+
+    def _remember(self, entry):
+        with self._lock:
+            self._entries[entry.key] = entry
+            self._entries.move_to_end(entry.key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}_{self.namespace}.pt")
+
+    def _load_from_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with profile("io.image_cache_read"):
+                data = torch.load(path, map_location="cpu", weights_only=True)
+        except Exception as e:
+            print(f"Warning: Ignoring unreadable image cache file '{path}': {e}")
+            return None
+        image = Image.fromarray(data["image"].numpy())
+        return CachedImage(key, image, data.get("pixel_values"), data.get("image_features"))
@@ -0,0 +1,398 @@
+import os
+import json
+import math
+import time
+import base64
+import asyncio
+import argparse
+import tempfile
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import main as evaluation
+from KeywordIndex import load_keyword_index
+from ResultCache import hash_file, make_key
+
+# --- การตั้งค่า ---
+HOST = "127.0.0.1"
+PORT = 8080
+# Micro-batching: รวบรวมคำขอที่เข้ามาพร้อมกันภายใน MAX_WAIT_MS มิลลิวินาที (สูงสุด MAX_BATCH_SIZE คำขอ) ก่อนเรียก generate
+MAX_BATCH_SIZE = 4
+MAX_WAIT_MS = 20
+# Backpressure: จำนวนคำขอที่รอในคิวได้สูงสุด (เกินนี้จะตอบ 503 ทันที) และเวลารอสูงสุดต่อคำขอ (เกินนี้จะตอบ 504)
+MAX_QUEUE_SIZE = 32
+REQUEST_TIMEOUT = 120.0
+# จำนวนค่า Latency ล่าสุดที่ใช้คำนวณ p50/p95/p99
+LATENCY_WINDOW = 1000
+# โฟลเดอร์เก็บรูปภาพที่ส่งมาแบบ base64 ชั่วคราว (ลบเมื่อตอบคำขอแล้ว, Image Cache ใช้ Hash ของเนื้อหาอยู่แล้ว)
+UPLOAD_DIR = os.path.join(evaluation.OUTPUT_DIR, "server_uploads")
+# ขนาดสูงสุดของ Body ของคำขอ และของรูปภาพหลังถอดรหัส base64 (เกินนี้จะตอบ 413)
+MAX_BODY_BYTES = 32 * 1024 * 1024
+MAX_UPLOAD_BYTES = 16 * 1024 * 1024
+
+# seed ที่ระบุในคำขอต้องอยู่ในช่วง 0 ถึง MAX_SEED - 1 (ช่วงเดียวกับ seed ของแต่ละตัวอย่างใน LLaVADentist.sample_seed)
+MAX_SEED = 2**63
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+def request_seed(item):
+    """
+    seed ของการสุ่ม Narrative ของคำขอหนึ่ง: "seed" ที่ระบุในคำขอ หรือจาก Hash ของเนื้อหารูปภาพ, instruction และ SEED
+    (รูปแบบเดียวกับ case_seed ใน main.py) รูปภาพเดียวกันจึงได้ Narrative เดิมไม่ว่าจะส่งเป็น path หรือ base64
+    """
+    if item.get("seed") is not None:
+        return item["seed"]
+    key = make_key(image=hash_file(item["image_path"]), instruction=item["instruction"], seed=evaluation.SEED)
+    return int(key[:15], 16)
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class LatencyStats:
+    """
+    เก็บ Latency ล่าสุด (วินาที) ของทุกคำตอบ (รวม 4xx/5xx เช่น 503 และ 504) และคำนวณ Percentile แบบ nearest-rank
+    พร้อมนับจำนวนคำตอบแยกตาม HTTP status
+    """
+    def __init__(self, window=LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+        self.status_counts = Counter()
+
+    def record(self, seconds, status=200):
+        self.latencies.append(seconds)
+        self.count += 1
+        self.status_counts[status] += 1
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+    def summary(self):
+        return {"count": self.count, "status_counts": {str(status): count for status, count in sorted(self.status_counts.items())},
+                **{f"p{q}_ms": None if self.percentile(q) is None else round(self.percentile(q) * 1000, 2)
+                   for q in (50, 95, 99)}}
+
+
+class MicroBatcher:
+    """
+    คิวคำขอแบบจำกัดขนาด + ตัวรวบรวมคำขอเป็น Micro-batch
+    คำขอแรกที่เข้ามาจะรอคำขออื่นได้นานสุด max_wait_ms ก่อนส่งทั้ง Batch ไปยัง run_batch (ทำงานใน executor)
+    run_batch รับลิสต์ของ item และคืนค่าลิสต์ของผลลัพธ์ตามลำดับเดียวกัน
+    คำขอที่หมดเวลาก่อนถูกประมวลผลจะถูกข้ามไป
+    """
+    def __init__(self, run_batch, executor, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                 max_queue_size=MAX_QUEUE_SIZE):
+        self.run_batch = run_batch
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self.rejected = 0
+        self.timed_out = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._collect())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def submit(self, item, timeout):
+        """ส่งคำขอเข้าคิวและรอผลลัพธ์ (raise HTTPError 503 ถ้าคิวเต็ม, 504 ถ้าหมดเวลา)"""
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((item, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise HTTPError(503, "Server is overloaded, please retry later.")
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise HTTPError(504, f"Request did not finish within {timeout:.1f} s.")
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            batch = [(item, future) for item, future in batch if not future.done()] # ข้ามคำขอที่หมดเวลาแล้ว
+            if not batch:
+                continue
+            self.batch_sizes.append(len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done(): future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done(): future.set_result(result)
+
+    def metrics(self):
+        sizes = list(self.batch_sizes)
+        return {"queue_depth": self.queue.qsize(), "rejected": self.rejected, "timed_out": self.timed_out,
+                "batches": len(sizes), "mean_batch_size": round(sum(sizes) / len(sizes), 2) if sizes else None}
+
+
+class InferenceServer:
+    """
+    HTTP Server (asyncio) ที่เก็บโมเดลไว้ในหน่วยความจำตลอดเวลา
+    - POST /narrative  {"image_path" หรือ "image_base64", "instruction" (ไม่บังคับ), "seed" (ไม่บังคับ), "timeout" (ไม่บังคับ)}
+    - POST /heatmap    {"image_path" หรือ "image_base64", "narrative", "keywords" (ไม่บังคับ), "instruction", "timeout"}
+    - GET  /metrics    Latency p50/p95/p99 ของแต่ละ Endpoint และสถานะของคิว
+    - GET  /health
+    โมเดลถูกเรียกจาก Thread เดียวเสมอ (executor ขนาด 1) คำขอ /narrative ถูกรวมเป็น Micro-batch
+    ส่วน /heatmap ประมวลผลทีละคำขอ (แต่ละคำขอคำนวณทุก keyword จาก Forward Pass เดียวอยู่แล้ว)
+    Narrative ของแต่ละคำขอสุ่มด้วย seed ของตัวเอง ("seed" ในคำขอ หรือจาก Hash ของเนื้อหารูปภาพ, instruction และ SEED)
+    ผลลัพธ์จึงไม่ขึ้นกับคำขออื่นที่ถูกรวมอยู่ใน Micro-batch เดียวกัน และคำขอเดิมได้ Narrative เดิมเสมอ
+    """
+    def __init__(self, model, instruction=evaluation.INSTRUCTION, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                 max_queue_size=MAX_QUEUE_SIZE, request_timeout=REQUEST_TIMEOUT, upload_dir=UPLOAD_DIR):
+        self.model = model
+        self.instruction = instruction
+        self.request_timeout = request_timeout
+        self.upload_dir = upload_dir
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_queue_size = max_queue_size
+        self.latency = {"/narrative": LatencyStats(), "/heatmap": LatencyStats()}
+        self.keyword_index = load_keyword_index(evaluation.VOCABULARY_PATH)
+        self._server = None
+
+    async def start(self, host=HOST, port=PORT):
+        # executor ขนาด 1: โมเดลไม่ปลอดภัยต่อการเรียกจากหลาย Thread พร้อมกัน
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model")
+        self.narrative_batcher = MicroBatcher(self._run_narrative_batch, self.executor, self.max_batch_size,
+                                              self.max_wait_ms, self.max_queue_size)
+        self.heatmap_batcher = MicroBatcher(self._run_heatmap_batch, self.executor, 1, 0, self.max_queue_size)
+        self.narrative_batcher.start()
+        self.heatmap_batcher.start()
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        print(f"Inference server listening on http://{host}:{self.port}")
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.narrative_batcher.stop()
+        await self.heatmap_batcher.stop()
+        self.executor.shutdown(wait=True)
+
+    async def serve_forever(self, host=HOST, port=PORT):
+        await self.start(host, port)
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    # --- งานของโมเดล (ทำงานใน executor) ---
+    def _run_narrative_batch(self, items):
+        # รวมคำขอที่ใช้ instruction เดียวกันเป็น Batch เดียว
+        results = [None] * len(items)
+        groups = {}
+        for i, item in enumerate(items):
+            groups.setdefault(item["instruction"], []).append(i)
+        for instruction, indices in groups.items():
+            seeds = [request_seed(items[i]) for i in indices]
+            narratives, infos = self.model.generate_narratives(
+                [items[i]["image_path"] for i in indices], instruction, batch_size=len(indices), return_info=True,
+                stop_on_repetition=evaluation.STOP_ON_REPETITION, seed=seeds, **evaluation.REPETITION_STOP_CONFIG)
+            for i, seed, narrative, info in zip(indices, seeds, narratives, infos):
+                results[i] = {"narrative": narrative, "generation_info": info, "seed": seed, "batch_size": len(items)}
+        return results
+
+    def _run_heatmap_batch(self, items):
+        results = []
+        for item in items:
+            prefix = f"USER: <image>\n{item['instruction']}\nASSISTANT: "
+            narrative_spans = self.keyword_index.spans(item["narrative"])
+            keywords = item["keywords"] or [kw for kw in self.keyword_index.keywords if kw in narrative_spans]
+            keyword_spans = {kw: [(start + len(prefix), end + len(prefix)) for start, end in spans]
+                             for kw, spans in narrative_spans.items()}
+            heatmaps, attribution = self.model.generate_xai_heatmaps(
+                item["image_path"], prefix + item["narrative"], keywords, keyword_spans=keyword_spans,
+                return_attribution=True)
+            results.append({
+                "heatmaps": {kw: None if heatmap is None else heatmap.tolist() for kw, heatmap in heatmaps.items()},
+                "attribution": attribution,
+            })
+        return results
+
+    # --- HTTP ---
+    async def _handle_connection(self, reader, writer):
+        start_time = time.perf_counter()
+        path = None
+        try:
+            method, path, body = await self._read_request(reader)
+            status, payload = 200, await self._route(method, path, body)
+        except HTTPError as e:
+            status, payload = e.status, {"error": str(e)}
+        except Exception as e:
+            status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+        if path in self.latency:
+            latency = time.perf_counter() - start_time
+            self.latency[path].record(latency, status)
+            payload["latency_ms"] = round(latency * 1000, 2)
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status} {HTTP_STATUS.get(status, '')}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode("ascii") + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        parts = request_line.split()
+        if len(parts) < 2:
+            raise HTTPError(400, "Malformed request line.")
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length header.")
+        if length < 0:
+            raise HTTPError(400, "Invalid Content-Length header.")
+        if length > MAX_BODY_BYTES:
+            raise HTTPError(413, "Request body is too large.")
+        body = await reader.readexactly(length) if length else b""
+        return parts[0].upper(), parts[1].split("?", 1)[0], body
+
+    async def _route(self, method, path, body):
+        if path == "/health":
+            return {"status": "ok"}
+        if path == "/metrics":
+            return self.metrics()
+        if path not in ("/narrative", "/heatmap"):
+            raise HTTPError(404, f"Unknown endpoint '{path}'.")
+        if method != "POST":
+            raise HTTPError(405, f"{path} only accepts POST.")
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "Request body must be JSON.")
+        if not isinstance(request, dict):
+            raise HTTPError(400, "Request body must be a JSON object.")
+        timeout = self._timeout(request)
+        if path == "/heatmap":
+            if not request.get("narrative") or not isinstance(request["narrative"], str):
+                raise HTTPError(400, "'narrative' is required.")
+            keywords = request.get("keywords")
+            if keywords is not None and (not isinstance(keywords, list) or not all(isinstance(kw, str) for kw in keywords)):
+                raise HTTPError(400, "'keywords' must be a list of strings.")
+        seed = request.get("seed")
+        if seed is not None and (isinstance(seed, bool) or not isinstance(seed, int) or not 0 <= seed < MAX_SEED):
+            raise HTTPError(400, f"'seed' must be an integer from 0 to {MAX_SEED - 1}.")
+        image_path, uploaded = self._image_path(request)
+        try:
+            item = {"image_path": image_path, "instruction": request.get("instruction") or self.instruction}
+            if path == "/narrative":
+                item["seed"] = seed
+                return await self.narrative_batcher.submit(item, timeout)
+            item.update(narrative=request["narrative"], keywords=request.get("keywords"))
+            return await self.heatmap_batcher.submit(item, timeout)
+        finally:
+            # ลบรูปภาพที่อัปโหลดเสมอ (รวมถึงเมื่อหมดเวลา คำขอที่ยังไม่ถูกประมวลผลจะถูกข้ามโดย MicroBatcher)
+            if uploaded:
+                try:
+                    os.remove(image_path)
+                except OSError:
+                    pass
+
+    def _timeout(self, request):
+        try:
+            timeout = float(request.get("timeout", self.request_timeout))
+        except (TypeError, ValueError):
+            raise HTTPError(400, "'timeout' must be a number of seconds.")
+        if not math.isfinite(timeout) or timeout <= 0:
+            raise HTTPError(400, "'timeout' must be a positive number of seconds.")
+        return timeout
+
+    def _image_path(self, request):
+        # คืนค่า (path ของรูปภาพ, True ถ้าเป็นไฟล์ชั่วคราวจาก image_base64 ที่ต้องลบหลังตอบคำขอ)
+        if request.get("image_base64"):
+            encoded = request["image_base64"]
+            if not isinstance(encoded, str):
+                raise HTTPError(400, "'image_base64' must be a string.")
+            if len(encoded) * 3 // 4 > MAX_UPLOAD_BYTES:
+                raise HTTPError(413, f"Uploaded image is larger than {MAX_UPLOAD_BYTES} bytes.")
+            try:
+                data = base64.b64decode(encoded, validate=True)
+            except ValueError:
+                raise HTTPError(400, "'image_base64' is not valid base64.")
+            os.makedirs(self.upload_dir, exist_ok=True)
+            # ชื่อไฟล์ไม่ซ้ำกันต่อคำขอ (คำขอที่ส่งรูปเดียวกันพร้อมกันจะไม่ลบไฟล์ของกันและกัน)
+            fd, image_path = tempfile.mkstemp(suffix=".img", dir=self.upload_dir)
+            with os.fdopen(fd, "wb") as f: f.write(data)
+            return image_path, True
+        image_path = request.get("image_path")
+        if not image_path or not isinstance(image_path, str):
+            raise HTTPError(400, "Either 'image_path' or 'image_base64' is required.")
+        if not os.path.exists(image_path):
+            raise HTTPError(404, f"Image not found at {image_path}")
+        return image_path, False
+
+    def metrics(self):
+        return {
+            "latency": {path: stats.summary() for path, stats in self.latency.items()},
+            "narrative_queue": self.narrative_batcher.metrics(),
+            "heatmap_queue": self.heatmap_batcher.metrics(),
+            "config": {"max_batch_size": self.max_batch_size, "max_wait_ms": self.max_wait_ms,
+                       "max_queue_size": self.max_queue_size, "request_timeout": self.request_timeout},
+        }
+
+def load_model(tiny=False):
+    if tiny:
+        from TinyLLaVA import create_tiny_llava
+        return create_tiny_llava(xai_gradient_mode=evaluation.XAI_GRADIENT_MODE)
+    from LLaVADentist import LLaVADentist
+    return LLaVADentist(evaluation.BASE_MODEL_PATH, evaluation.ADAPTER_PATH, xai_gradient_mode=evaluation.XAI_GRADIENT_MODE,
+                        image_cache_dir=evaluation.IMAGE_CACHE_DIR, materialized_dir=evaluation.MATERIALIZED_MODEL_DIR)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve narratives and XAI heatmaps over HTTP with one resident model.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    parser.add_argument("--max-queue-size", type=int, default=MAX_QUEUE_SIZE)
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT, help="Default per-request timeout in seconds.")
+    parser.add_argument("--tiny", action="store_true", help="Use a tiny randomly initialized LLaVA on CPU (for testing).")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = InferenceServer(load_model(args.tiny), max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                             max_queue_size=args.max_queue_size, request_timeout=args.timeout)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        print("Server stopped.")
@@ -0,0 +1,122 @@
+import os
+from collections import deque, namedtuple
+from functools import lru_cache
+
+# --- การตั้งค่า ---
+# ไฟล์คำศัพท์ทางคลินิกเริ่มต้น (อยู่ในโฟลเดอร์เดียวกับไฟล์นี้)
+DEFAULT_VOCABULARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clinical_vocabulary.txt")
+
+# ผลลัพธ์การค้นหา 1 รายการ: keyword หลัก, คำที่พบจริง (keyword หรือคำพ้อง), ตำแหน่งเริ่มต้นและสิ้นสุด (ตัวอักษร) ในข้อความต้นฉบับ
+KeywordMatch = namedtuple("KeywordMatch", ["keyword", "term", "start", "end"])
+
+
+def load_vocabulary(path=DEFAULT_VOCABULARY_PATH):
+    """อ่านไฟล์คำศัพท์ คืนค่า dict {keyword: [คำพ้อง, ...]} ตามลำดับในไฟล์"""
+    vocabulary = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            terms = [term.strip() for term in line.split("|") if term.strip()]
+            vocabulary[terms[0]] = terms[1:]
+    return vocabulary
+
+def _normalize(text):
+    """
+    แปลงเป็นตัวพิมพ์เล็กและยุบช่องว่างที่ติดกันให้เหลือช่องว่างเดียว
+    คืนค่าข้อความที่ปรับแล้ว และลิสต์ที่จับคู่ตำแหน่งในข้อความที่ปรับแล้วกลับไปยังตำแหน่งในข้อความต้นฉบับ
+    """
+    chars, positions = [], []
+    previous_space = False
+    for i, char in enumerate(text):
+        if char.isspace():
+            if previous_space:
+                continue
+            char, previous_space = " ", True
+        else:
+            previous_space = False
+        chars.append(char.lower())
+        positions.append(i)
+    return "".join(chars), positions
+
+
+class KeywordIndex:
+    """
+    ดัชนีค้นหา keyword ทางคลินิกด้วยอัลกอริทึม Aho-Corasick
+    ค้นหา keyword และคำพ้องทั้งหมดในข้อความได้ในการอ่านข้อความรอบเดียว (เวลาเชิงเส้น)
+    โดยจะนับเฉพาะการพบที่ตรงทั้งคำ (ตัวอักษรก่อนหน้าและถัดไปต้องไม่ใช่ตัวอักษรหรือตัวเลข)
+    """
+    def __init__(self, vocabulary):
+        self.vocabulary = {keyword: list(aliases) for keyword, aliases in vocabulary.items()}
+        self.keywords = list(self.vocabulary)
+        self._goto = [{}]    # การเปลี่ยนสถานะของแต่ละโหนด (ตัวอักษร -> โหนดถัดไป)
+        self._fail = [0]     # Failure link ของแต่ละโหนด
+        self._output = [[]]  # (keyword, term, ความยาว) ที่สิ้นสุดที่โหนดนี้
+        for keyword, aliases in self.vocabulary.items():
+            for term in [keyword] + aliases:
+                self._add_term(keyword, term)
+        self._build_failure_links()
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_VOCABULARY_PATH):
+        return cls(load_vocabulary(path))
+
+    def find_all(self, text):
+        """คืนค่าลิสต์ของ KeywordMatch ทั้งหมดในข้อความ เรียงตามตำแหน่งเริ่มต้น (อาจซ้อนทับกันได้)"""
+        normalized, positions = _normalize(text or "")
+        matches = []
+        state = 0
+        for i, char in enumerate(normalized):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for keyword, term, length in self._output[state]:
+                start, end = i - length + 1, i + 1
+                # ตรวจสอบขอบเขตของคำ (Word boundary)
+                if start > 0 and normalized[start - 1].isalnum():
+                    continue
+                if end < len(normalized) and normalized[end].isalnum():
+                    continue
+                matches.append(KeywordMatch(keyword, term, positions[start], positions[end - 1] + 1))
+        matches.sort(key=lambda match: (match.start, -match.end))
+        return matches
+
+    def mentioned(self, text):
+        """คืนค่า set ของ keyword หลักที่ปรากฏในข้อความ"""
+        return {match.keyword for match in self.find_all(text)}
+
+    def spans(self, text):
+        """คืนค่า dict {keyword: [(start, end), ...]} ของตำแหน่งที่พบแต่ละ keyword ในข้อความ"""
+        spans = {}
+        for match in self.find_all(text):
+            spans.setdefault(match.keyword, []).append((match.start, match.end))
+        return spans
+
+    def _add_term(self, keyword, term):
+        normalized, _ = _normalize(term.strip())
+        state = 0
+        for char in normalized:
+            if char not in self._goto[state]:
+                self._goto.append({}); self._fail.append(0); self._output.append([])
+                self._goto[state][char] = len(self._goto) - 1
+            state = self._goto[state][char]
+        self._output[state].append((keyword, term, len(normalized)))
+
+    def _build_failure_links(self):
+        # สร้าง Failure link ด้วย BFS และรวม output ของโหนดปลายทางของ Failure link
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+@lru_cache(maxsize=None)
+def load_keyword_index(path=DEFAULT_VOCABULARY_PATH):
+    """โหลด KeywordIndex จากไฟล์คำศัพท์ (โหลดครั้งเดียวต่อไฟล์)"""
+    return KeywordIndex.from_file(path)
@@ -1,196 +1,875 @@
 import os
+import json
+import time
+import shutil
+import threading
+from contextlib import contextmanager
+
 import torch
-from PIL import Image
-import numpy as np
-import cv2
 from transformers import (
+    AutoConfig,
     AutoModelForVision2Seq,
     AutoProcessor,
     BitsAndBytesConfig,
+    LogitsProcessor,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TemperatureLogitsWarper,
+    TextIteratorStreamer,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
 )
 from peft import PeftModel
 
-# สร้างตัวแปร Global เพื่อเก็บข้อมูลที่ดักจับได้จาก Layer ของโมเดล
-feature_maps = [] # สำหรับเก็บ Feature Map (ผลลัพธ์จาก Layer ตอน Forward Pass)
-gradients = []    # สำหรับเก็บ Gradients (ค่าความชันที่ไหลย้อนกลับมาตอน Backward Pass)
+from GradCAM import multi_layer_gradcam
+from Profiler import peak_rss_mb, profile
+from HeatmapOverlay import superimpose
+from ModelConfig import (GENERATION_CONFIG, MATERIALIZED_MANIFEST, XAI_GRADIENT_MODES, XAI_TARGET_LAYERS,
+                         XAI_TARGET_MODULE)
+from ResultCache import hash_path
+from ImageFeatureCache import ImageFeatureCache
+from KeywordIndex import KeywordIndex
+from ResponseCleaner import ResponseCleaner, parse_response
+
+class LayerCapture:
+    """
+    ดักจับ Feature Map ของ Layer เป้าหมายหลาย Layer พร้อมกัน (สำหรับ Multi-layer Grad-CAM)
+    Forward Hook ถูกติดตั้งครั้งเดียวตอนสร้าง และใช้ซ้ำได้ทุกการเรียก โดยจะเก็บ Feature Map เฉพาะภายใน
+    with capture.recording(as_leaf): ... เท่านั้น (นอกนั้น Hook คืนค่าทันทีโดยไม่แก้ไขอะไร)
+
+    as_leaf=True:  Layer แรก (ตามลำดับ Forward) ที่ยังไม่ต้องการ Gradient จะถูกตัด Graph และเป็น leaf tensor
+                   ทำให้ Backward Pass หยุดอยู่ที่ Layer นี้ ส่วน Layer ถัดไปต่อจาก leaf นี้จึงต้องการ Gradient อยู่แล้ว
+    as_leaf=False: เรียก retain_grad() เพื่อให้อ่าน .grad ได้หลัง backward()
+    """
+    def __init__(self, layers):
+        # layers: ลิสต์ของ (ชื่อ, โมดูล) เรียงตามลำดับ Forward
+        self.names = [name for name, _ in layers]
+        self.activations = {}
+        self._recording = False
+        self._as_leaf = False
+        self._handles = [module.register_forward_hook(self._hook(name)) for name, module in layers]
+
+    def _hook(self, name):
+        def hook(module, input, output):
+            if not self._recording:
+                return None
+            if self._as_leaf and not output.requires_grad:
+                output = output.detach().requires_grad_(True)
+            elif not self._as_leaf and output.requires_grad:
+                output.retain_grad()
+            self.activations[name] = output
+            return output
+        return hook
+
+    @contextmanager
+    def recording(self, as_leaf):
+        self.activations.clear()
+        self._recording, self._as_leaf = True, as_leaf
+        try:
+            yield self
+        finally:
+            # ไม่เก็บ Feature Map (และ Graph ที่ผูกอยู่) ไว้หลังใช้งาน เพื่อป้องกัน memory leak
+            self._recording = False
+            self.activations.clear()
+
+    def captured(self):
+        """Feature Map ที่ดักจับได้ของทุก Layer ตามลำดับ (None ถ้า Layer นั้นไม่ถูกเรียก)"""
+        return [self.activations.get(name) for name in self.names]
+
+    def remove(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+class RepetitionStoppingCriteria(StoppingCriteria):
+    """
+    เกณฑ์หยุดการสร้างข้อความเมื่อโมเดลวนซ้ำ (Repetition Loop)
+    ตรวจสอบว่า n-gram ท้ายสุดของข้อความที่สร้างใหม่ ปรากฏซ้ำใน window ล่าสุดตั้งแต่ max_repeats ครั้งขึ้นไปหรือไม่
+    ถ้าใช่ จะหยุดเฉพาะแถว (Sequence) นั้น และจดจำจำนวน token ที่สร้างไปแล้วตอนหยุด
+    """
+    def __init__(self, ngram_size=8, max_repeats=3, window=128, prompt_length=0, ignore_token_ids=()):
+        self.ngram_size = ngram_size
+        self.max_repeats = max_repeats
+        self.window = max(window, ngram_size * max_repeats)
+        self.prompt_length = prompt_length # จำนวน token ของ Prompt ใน input_ids (0 เมื่อ generate ด้วย inputs_embeds)
+        self.ignore_token_ids = [t for t in ignore_token_ids if t is not None] # เช่น pad/eos ของแถวที่จบไปแล้ว
+        self.stopped_at = {} # {ลำดับแถว: จำนวน token ที่สร้างแล้วตอนหยุดเพราะวนซ้ำ}
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids[:, self.prompt_length:]
+        is_done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if generated.shape[1] < self.ngram_size * self.max_repeats:
+            return is_done
+        # นับจำนวนครั้งที่ n-gram ท้ายสุดปรากฏใน window (คำนวณพร้อมกันทุกแถวด้วย unfold)
+        recent = generated[:, -self.window:]
+        ngrams = recent.unfold(1, self.ngram_size, 1)
+        last_ngram = recent[:, -self.ngram_size:].unsqueeze(1)
+        repeats = (ngrams == last_ngram).all(dim=-1).sum(dim=-1)
+        is_done = repeats >= self.max_repeats
+        for token_id in self.ignore_token_ids:
+            is_done &= generated[:, -1] != token_id
+        for row in is_done.nonzero().flatten().tolist():
+            self.stopped_at.setdefault(row, generated.shape[1])
+        return is_done
+
+class CancellationStoppingCriteria(StoppingCriteria):
+    """หยุดการสร้างข้อความทุกแถวทันทีเมื่อ cancel_event ถูก set (เช่น ผู้ใช้ยกเลิกระหว่าง Streaming)"""
+    def __init__(self, cancel_event):
+        self.cancel_event = cancel_event
 
-def get_feature_maps_hook(module, input, output):
-    """Hook ที่จะถูกเรียกใช้หลังจากการทำ Forward Pass ใน Layer ที่กำหนด เพื่อดักจับค่า output (Feature Map)"""
-    feature_maps.append(output)
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancel_event.is_set(), dtype=torch.bool, device=input_ids.device)
 
-def get_gradients_hook(module, grad_in, grad_out):
-    """Hook ที่จะถูกเรียกใช้ระหว่างการทำ Backward Pass เพื่อดักจับค่า gradient ที่ไหลผ่าน Layer"""
-    gradients.append(grad_out[0])
+class SeededSamplingProcessor(LogitsProcessor):
+    """
+    สุ่ม token ถัดไปของแต่ละแถวด้วย torch.Generator ของแถวนั้นเอง (seeds: 1 ค่าต่อแถว)
+    ผลการสุ่มของแถวหนึ่งจึงขึ้นกับ seed ของแถวนั้นเท่านั้น ไม่ขึ้นกับแถวอื่นที่อยู่ใน Batch เดียวกัน
+    ปรับ temperature/top_k/top_p เองก่อนสุ่ม (Processor ที่ส่งให้ generate ทำงานก่อน Warper ของ generate)
+    แล้วคืนค่า scores ที่เหลือเพียง token ที่สุ่มได้ การสุ่มของ generate ที่ตามมาจึงได้ token นั้นเสมอ
+    """
+    def __init__(self, seeds, temperature=1.0, top_k=0, top_p=1.0):
+        self.seeds = list(seeds)
+        self.generators = None
+        self.warpers = LogitsProcessorList()
+        if temperature != 1.0: self.warpers.append(TemperatureLogitsWarper(temperature))
+        if top_k: self.warpers.append(TopKLogitsWarper(top_k))
+        if top_p < 1.0: self.warpers.append(TopPLogitsWarper(top_p))
+
+    def __call__(self, input_ids, scores):
+        if self.generators is None:
+            self.generators = [torch.Generator(device=scores.device).manual_seed(seed) for seed in self.seeds]
+        probs = torch.softmax(self.warpers(input_ids, scores).float(), dim=-1)
+        tokens = torch.cat([torch.multinomial(probs[row], 1, generator=generator)
+                            for row, generator in enumerate(self.generators)])
+        chosen = torch.full_like(scores, -float("inf"))
+        return chosen.scatter_(1, tokens.unsqueeze(1), 0.0)
+
+def sample_seed(seed, sample):
+    # seed ของตัวอย่างที่ sample (0 ถึง K - 1) ของรูปภาพที่มี seed นี้ (ตัวอย่างแรกใช้ seed ของรูปภาพตรงๆ)
+    return (seed + sample * 1_000_003) % 2**63
 
 class LLaVADentist:
-    def __init__(self, base_model_path, adapter_path):
+    GENERATION_CONFIG = GENERATION_CONFIG
+
+    def __init__(self, base_model_path, adapter_path, xai_gradient_mode="activation",
+                 image_cache_size=16, image_cache_dir=None, materialized_dir=None, debug=False,
+                 xai_target_layers=XAI_TARGET_LAYERS, adapter_hash=None):
+        if xai_gradient_mode not in XAI_GRADIENT_MODES:
+            raise ValueError(f"xai_gradient_mode must be one of {XAI_GRADIENT_MODES}, got '{xai_gradient_mode}'")
+        self.xai_gradient_mode = xai_gradient_mode
+        self.xai_target_layers = tuple(xai_target_layers)
+        self.debug = debug # True = พิมพ์ผลลัพธ์ดิบของโมเดล (รวม special tokens) เพื่อดีบัก
+        # Hash ของน้ำหนัก Adapter (คำนวณครั้งเดียว หรือรับจากผู้เรียกที่คำนวณไว้แล้ว เช่น main.py)
+        self.adapter_hash = adapter_hash or hash_path(adapter_path)
         # กำหนด Device ที่จะใช้ (ถ้ามี GPU หากไม่มีให้ใช้ CPU แทน)
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print(f"Initializing model with PEFT on device: {self.device}")
+        load_start_time = time.perf_counter()
+
+        with profile("model_load") as load_span:
+            # ใช้โมเดลที่ Materialize ไว้แล้ว (ถ้ามีและยังตรงกับ Base Model และ Adapter ปัจจุบัน)
+            # น้ำหนักถูกบันทึกเป็น safetensors หลังแก้ไข multi_modal_projector แล้ว จึงโหลดแบบ mmap ได้โดยตรง
+            self.load_source = "original"
+            model_path, model_adapter_path = base_model_path, adapter_path
+            projector_fp32 = False
+            manifest = self._read_manifest(materialized_dir) if materialized_dir else None
+            if manifest and manifest.get("sources") == self._materialized_sources(base_model_path, adapter_path, self.adapter_hash):
+                self.load_source = "materialized"
+                model_path, model_adapter_path = materialized_dir, os.path.join(materialized_dir, "adapter")
+                projector_fp32 = manifest.get("projector_dtype") == "float32"
         
+            # --- โหลดโมเดลพื้นฐาน (Base Model) และ Processor ---
+            base_model = self._load_base_model(model_path, keep_projector_fp32=projector_fp32)
+            # Processor ทำหน้าที่เตรียมข้อมูล (รูปภาพและข้อความ) ให้พร้อมสำหรับโมเดล
+            self.processor = AutoProcessor.from_pretrained(model_path, trust_remote_code=True)
+
+            # --- ส่วนแก้ไขที่สำคัญ (Critical Fix) ---
+            # ต้องทำก่อนที่จะโหลด PEFT adapter ทุกครั้ง
+            # (bitsandbytes โหลด Layer ที่ไม่ถูก Quantize กลับมาเป็น float16 จึงต้องแปลงเป็น float32 ใหม่)
+            # ยกเว้นโมเดลที่ Materialize แล้ว ซึ่งบันทึก Projector เป็น float32 และโหลดกลับมาเป็น float32 โดยตรง
+            if projector_fp32 and self._projector_is_fp32(base_model):
+                print("Projector was saved in float32 by materialize. Skipping the fix.")
+            else:
+                self._apply_projector_fix(base_model)
+
+            # --- โหลดโมเดล PEFT (โหลด Adapter) ---
+            # นำ LoRA adapter ที่เรา fine-tune ไว้มา "หุ้ม" โมเดลพื้นฐาน
+            self._setup_model(PeftModel.from_pretrained(base_model, model_adapter_path))
+        self.load_time = time.perf_counter() - load_start_time
+        print(f"PEFT model initialized successfully ({self.load_source} weights, {self.load_time:.1f} s).")
+
+        # --- Cache ของรูปภาพ, pixel_values และ Image Embeddings (ใช้ร่วมกันทุกเมธอด) ---
+        self.image_cache = ImageFeatureCache(
+            max_entries=image_cache_size,
+            disk_dir=image_cache_dir,
+            namespace=self._feature_namespace(base_model_path),
+        )
+
+    def _feature_namespace(self, base_model_path):
+        """
+        namespace ของ Cache บนดิสก์ของ Image Embeddings (ผลลัพธ์ของ multi_modal_projector)
+        ขึ้นกับเนื้อหาของ Adapter (ไม่ใช่แค่ path), dtype ของ Projector และการตั้งค่า Quantization
+        เพื่อไม่ให้ใช้ Embeddings เก่าเมื่อน้ำหนักเปลี่ยนโดยที่ path เดิม
+        """
+        projector_dtype = next((str(param.dtype) for name, param in self.model.named_parameters()
+                                if "multi_modal_projector" in name), "none")
+        quantization = getattr(self.model.config, "quantization_config", None)
+        if quantization is not None and not isinstance(quantization, dict):
+            quantization = quantization.to_dict()
+        return "|".join([os.path.abspath(base_model_path), self.adapter_hash, projector_dtype,
+                         json.dumps(quantization, sort_keys=True, default=str)])
+
+    @classmethod
+    def from_components(cls, model, processor, xai_gradient_mode="activation", image_cache_size=16,
+                        image_cache_dir=None, name="components", debug=False, xai_target_layers=XAI_TARGET_LAYERS):
+        """
+        สร้าง LLaVADentist จากโมเดลและ Processor ที่โหลดไว้แล้ว (ไม่โหลด Base Model, Quantization หรือ Adapter)
+        ใช้กับโมเดลขนาดเล็กที่สุ่มน้ำหนัก (ดู TinyLLaVA.py) เพื่อทดสอบบน CPU หรือกับโมเดลที่เตรียมไว้เอง
+        name ใช้แยก Cache บนดิสก์ของรูปภาพระหว่างโมเดลแต่ละตัว
+        """
+        if xai_gradient_mode not in XAI_GRADIENT_MODES:
+            raise ValueError(f"xai_gradient_mode must be one of {XAI_GRADIENT_MODES}, got '{xai_gradient_mode}'")
+        self = cls.__new__(cls)
+        self.xai_gradient_mode = xai_gradient_mode
+        self.xai_target_layers = tuple(xai_target_layers)
+        self.debug = debug
+        self.device = next(model.parameters()).device
+        self.processor = processor
+        self.load_source, self.load_time = "components", 0.0
+        self._setup_model(model)
+        self.image_cache = ImageFeatureCache(max_entries=image_cache_size, disk_dir=image_cache_dir, namespace=name)
+        return self
+
+    def _setup_model(self, model):
+        self.model = model
+        self.model.eval() # ตั้งค่าโมเดลเป็น evaluation mode (ไม่ทำการ training)
+        if self.xai_gradient_mode == "activation":
+            # Freeze พารามิเตอร์ทั้งหมด เพื่อไม่ให้มีการจอง .grad buffer ระหว่างการทำ XAI
+            for param in self.model.parameters():
+                param.requires_grad_(False)
+        # ค้นหา Layer เป้าหมายของ XAI และติดตั้ง Hook ครั้งเดียว (ไม่ต้องค้นหาโมดูลทั้งโมเดลทุกครั้งที่สร้าง Heatmap)
+        self.layer_capture = LayerCapture(self._resolve_target_layers(self.xai_target_layers))
+
+    def target_layer_indices(self, spec):
+        """
+        แปลง spec ของ Layer เป้าหมาย (ดู XAI_TARGET_LAYERS) เป็น index ของ Encoder Layer ใน Vision Tower จาก config ของโมเดล
+        - "feature": Layer ที่ให้ Feature แก่ multi_modal_projector ตาม vision_feature_layer
+                     (hidden_states[i] คือ output ของ Layer i-1 เช่น -2 ของ 24 layers -> Layer 22)
+        - จำนวนเต็ม: index แบบ Python (ค่าลบนับจาก Layer สุดท้าย)
+        """
+        config = self.model.config
+        num_layers = config.vision_config.num_hidden_layers
+        indices = []
+        for entry in spec:
+            if entry == "feature":
+                feature_layers = config.vision_feature_layer
+                if not isinstance(feature_layers, (list, tuple)): feature_layers = [feature_layers]
+                candidates = [feature_layer % (num_layers + 1) - 1 for feature_layer in feature_layers]
+            elif isinstance(entry, int) and -num_layers <= entry < num_layers:
+                candidates = [entry % num_layers]
+            else:
+                raise ValueError(f"Invalid XAI target layer {entry!r} for a vision tower with {num_layers} layers.")
+            if any(index < 0 for index in candidates):
+                raise ValueError(f"XAI target layer {entry!r} resolves to the patch embeddings, not an encoder layer.")
+            indices.extend(candidates)
+        return sorted(set(indices))
+
+    def _resolve_target_layers(self, spec):
+        # ค้นหาโมดูลของทุก Layer เป้าหมายในการวนรอบเดียว (ชื่อมี prefix ต่างกันตาม PEFT และรุ่นของ transformers)
+        suffixes = [XAI_TARGET_MODULE.format(index=index) for index in self.target_layer_indices(spec)]
+        found = {}
+        for name, module in self.model.named_modules():
+            for suffix in suffixes:
+                if suffix not in found and name.endswith(suffix):
+                    found[suffix] = (name, module)
+        missing = [suffix for suffix in suffixes if suffix not in found]
+        if missing:
+            print(f"     [XAI ERROR] Could not find the target layer(s) {missing}. Heatmap generation is disabled.")
+            return []
+        if self.debug:
+            print(f"     [XAI DEBUG] Target layer(s): {[found[suffix][0] for suffix in suffixes]}")
+        return [found[suffix] for suffix in suffixes]
+
+    @staticmethod
+    def _load_base_model(model_path, keep_projector_fp32=False):
         # --- การตั้งค่า Quantization (การบีบอัดโมเดล) ---
         # โหลดโมเดลแบบ 4-bit เพื่อประหยัดหน่วยความจำ GPU
+        # (bitsandbytes 4-bit ใช้ได้เฉพาะบน GPU บน CPU เช่น โมเดลขนาดเล็กของ Benchmark จะโหลดแบบไม่ Quantize)
         quantization_config = BitsAndBytesConfig(
             load_in_4bit=True,
             bnb_4bit_quant_type="nf4",
             bnb_4bit_compute_dtype=torch.bfloat16,
-        )
-        
-        # --- โหลดโมเดลพื้นฐาน (Base Model) ---
-        base_model = AutoModelForVision2Seq.from_pretrained(
-            base_model_path,
+        ) if torch.cuda.is_available() else None
+        if keep_projector_fp32:
+            # ให้ transformers เก็บ multi_modal_projector เป็น float32 (ไม่แปลงเป็น float16 และไม่ Quantize)
+            config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+            base_class = AutoModelForVision2Seq._model_mapping[type(config)]
+            model_class = type(base_class.__name__, (base_class,), {"_keep_in_fp32_modules": ["multi_modal_projector"]})
+            return model_class.from_pretrained(model_path, config=config, quantization_config=quantization_config,
+                                               device_map="auto")
+        return AutoModelForVision2Seq.from_pretrained(
+            model_path,
             quantization_config=quantization_config,
             trust_remote_code=True,
             device_map="auto" # ให้ transformers จัดการการวางโมเดลบน device อัตโนมัติ
         )
-        
-        # --- โหลด Processor ---
-        # Processor ทำหน้าที่เตรียมข้อมูล (รูปภาพและข้อความ) ให้พร้อมสำหรับโมเดล
-        self.processor = AutoProcessor.from_pretrained(base_model_path, trust_remote_code=True)
 
-        # --- ส่วนแก้ไขที่สำคัญ (Critical Fix) ---
-        # ต้องทำก่อนที่จะโหลด PEFT adapter
+    @staticmethod
+    def _apply_projector_fix(base_model):
         print("Applying critical fix to multi_modal_projector...")
         for name, param in base_model.named_parameters():
-            if "multi_modal_projector" in name:
+            if "multi_modal_projector" in name and param.dtype != torch.float32:
                 # แปลง Data Type ของ multi_modal_projector กลับเป็น float32
                 # เพื่อให้ PEFT สามารถตั้งค่าให้มัน trainable ได้โดยไม่เกิด error
                 param.data = param.data.to(torch.float32)
         print("Fix applied.")
 
-        # --- โหลดโมเดล PEFT (โหลด Adapter) ---
-        # นำ LoRA adapter ที่เรา fine-tune ไว้มา "หุ้ม" โมเดลพื้นฐาน
-        self.model = PeftModel.from_pretrained(base_model, adapter_path)
-        self.model.eval() # ตั้งค่าโมเดลเป็น evaluation mode (ไม่ทำการ training)
-        print("PEFT model initialized successfully.")
+    @staticmethod
+    def _projector_is_fp32(base_model):
+        return all(param.dtype == torch.float32 for name, param in base_model.named_parameters()
+                   if "multi_modal_projector" in name)
 
-    def generate_narrative(self, image_path, instruction):
-        try:
-            # โหลดรูปภาพจาก path ที่กำหนด และแปลงเป็น RGB
-            image = Image.open(image_path).convert("RGB")
-        except FileNotFoundError:
-            return f"Error: Image not found at {image_path}"
+    @staticmethod
+    def _materialized_sources(base_model_path, adapter_path, adapter_hash=None):
+        # แหล่งที่มาของโมเดลที่ Materialize (ถ้า Base Model หรือน้ำหนักของ Adapter เปลี่ยน ต้อง Materialize ใหม่)
+        return {"base_model_path": os.path.abspath(base_model_path), "adapter_hash": adapter_hash or hash_path(adapter_path)}
+
+    @staticmethod
+    def _read_manifest(materialized_dir):
+        manifest_path = os.path.join(materialized_dir, MATERIALIZED_MANIFEST)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, 'r', encoding='utf-8') as f: return json.load(f)
+
+    @classmethod
+    def is_materialized(cls, materialized_dir, base_model_path, adapter_path, adapter_hash=None):
+        """ตรวจสอบว่า materialized_dir มีโมเดลที่ Materialize จาก Base Model และ Adapter นี้แล้ว"""
+        manifest = cls._read_manifest(materialized_dir)
+        return manifest is not None and manifest.get("sources") == cls._materialized_sources(base_model_path, adapter_path, adapter_hash)
+
+    @classmethod
+    def materialize(cls, base_model_path, adapter_path, materialized_dir, adapter_hash=None):
+        """
+        บันทึกโมเดลพื้นฐาน (4-bit) เป็นไฟล์ safetensors พร้อม Processor และสำเนาของ Adapter ลงใน materialized_dir
+        Projector ถูกแก้ไขเป็น float32 ก่อนบันทึก (manifest ระบุ projector_dtype) ตอนโหลดจึงไม่ต้องแก้ไขอีก
+        ข้อจำกัด: LoRA ไม่ถูก merge (PEFT ยังถูกหุ้มตอนโหลดทุกครั้ง เพราะการ merge เข้ากับน้ำหนัก 4-bit ทำให้ผลลัพธ์เปลี่ยนไป)
+        ถ้า base_model_path เป็น Checkpoint 4-bit อยู่แล้ว เวลาเริ่มต้นที่ลดลงมาจากการอ่าน safetensors แบบ mmap
+        และการข้ามการแก้ไข Projector เท่านั้น (วัดเทียบได้ด้วย python main.py --materialize หรือ Benchmark.py)
+        """
+        base_model = cls._load_base_model(base_model_path)
+        processor = AutoProcessor.from_pretrained(base_model_path, trust_remote_code=True)
+        cls._apply_projector_fix(base_model)
+
+        tmp_dir = materialized_dir.rstrip("/\\") + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        base_model.save_pretrained(tmp_dir, safe_serialization=True)
+        processor.save_pretrained(tmp_dir)
+        shutil.copytree(adapter_path, os.path.join(tmp_dir, "adapter"))
+        with open(os.path.join(tmp_dir, MATERIALIZED_MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump({"sources": cls._materialized_sources(base_model_path, adapter_path, adapter_hash),
+                       "projector_dtype": "float32"}, f, indent=2)
+        shutil.rmtree(materialized_dir, ignore_errors=True)
+        os.replace(tmp_dir, materialized_dir)
+        print(f"Materialized model saved to '{materialized_dir}'.")
+
+    def generate_narrative(self, image_path, instruction, return_info=False, **repetition_kwargs):
+        # สร้างคำบรรยายของรูปภาพเดียว (เรียกใช้ generate_narratives ภายใน)
+        responses, infos = self.generate_narratives([image_path], instruction, batch_size=1,
+                                                    return_info=True, **repetition_kwargs)
+        return (responses[0], infos[0]) if return_info else responses[0]
+
+    def generate_narratives(self, image_paths, instruction, batch_size=4, return_info=False,
+                            stop_on_repetition=True, repetition_ngram_size=8, repetition_max_repeats=3,
+                            repetition_window=128, seed=None, num_samples=1):
+        """
+        สร้างคำบรรยายของหลายรูปภาพ โดยรวมรูปภาพเป็น Batch (Left-padding)
+        และเรียก self.model.generate เพียงครั้งเดียวต่อ Batch
+
+        num_samples > 1 จะสุ่มคำบรรยาย K ชุดต่อรูปภาพในการเรียก generate ครั้งเดียวกัน (num_return_sequences)
+        โดยคำนวณ Image Embeddings และ Prompt เพียงครั้งเดียวต่อรูปภาพ (ใช้กับ Self-consistency ใน main.py)
+
+        ถ้า stop_on_repetition=True จะหยุดการสร้างของแต่ละแถวทันทีที่ n-gram ขนาด repetition_ngram_size
+        ซ้ำกันตั้งแต่ repetition_max_repeats ครั้งใน repetition_window token ล่าสุด
+        seed: จำนวนเต็ม (ใช้กับทุกรูปภาพ) หรือลิสต์ของ seed 1 ค่าต่อรูปภาพ (ตามลำดับของ image_paths)
+        แต่ละแถวสุ่มด้วย Generator ของตัวเอง (SeededSamplingProcessor) คำบรรยายของรูปภาพหนึ่งจึงขึ้นกับ seed ของรูปภาพนั้น
+        ไม่ขึ้นกับ batch_size หรือรูปภาพอื่นใน Batch (ยกเว้นความต่างเชิงตัวเลขเล็กน้อยจาก Padding)
+
+        Returns:
+            list: คำตอบที่แยกส่วนแล้ว 1 รายการต่อ 1 รูปภาพ (ตามลำดับของ image_paths)
+                  หรือข้อความที่ขึ้นต้นด้วย "Error:" ถ้าสร้างไม่สำเร็จ
+                  (ถ้า num_samples > 1 แต่ละรายการเป็นลิสต์ของ K คำตอบ)
+            ถ้า return_info=True จะคืนค่า (responses, infos) โดย infos คือ dict ต่อรูปภาพ (หรือลิสต์ของ K dict)
+            ที่มี stop_reason ("eos", "max_new_tokens", "repetition"), tokens_generated และ tokens_saved
+        """
+        num_samples = max(1, num_samples)
+        def per_image(items):
+            # จัดรูปแบบผลลัพธ์ของรูปภาพหนึ่ง: ค่าเดียวเมื่อ num_samples=1 หรือลิสต์ของ K ค่า
+            return items if num_samples > 1 else items[0]
+        responses = [None] * len(image_paths)
+        infos = [per_image([{"stop_reason": "error", "tokens_generated": 0, "tokens_saved": 0}] * num_samples)
+                 for _ in image_paths]
+        max_new_tokens = self.GENERATION_CONFIG["max_new_tokens"]
+        loaded_images = [] # (ลำดับเดิม, CachedImage)
+        for i, image_path in enumerate(image_paths):
+            try:
+                # โหลดรูปภาพ (ผ่าน Cache) จาก path ที่กำหนด
+                loaded_images.append((i, self.image_cache.get(image_path)))
+            except FileNotFoundError:
+                responses[i] = per_image([f"Error: Image not found at {image_path}"] * num_samples)
             
+        repetition_config = {"ngram_size": repetition_ngram_size, "max_repeats": repetition_max_repeats,
+                             "window": repetition_window} if stop_on_repetition else None
+        seeds = seed if isinstance(seed, (list, tuple)) else [seed] * len(image_paths)
+        for start in range(0, len(loaded_images), max(1, batch_size)):
+            batch = loaded_images[start:start + max(1, batch_size)]
+            row_seeds = None if seed is None else [sample_seed(seeds[i], k) for i, _ in batch for k in range(num_samples)]
+            generate_kwargs, repetition_criteria = self._prepare_generation(
+                [cached_image for _, cached_image in batch], instruction, repetition_config, seeds=row_seeds)
+
+            # --- สร้างข้อความด้วยพารามิเตอร์การสุ่ม (ดู GENERATION_CONFIG) ---
+            # generate ด้วย inputs_embeds จะคืนเฉพาะ token ใหม่ (ไม่มี Prompt) จึงถอดรหัสได้โดยตรง
+            # ผลลัพธ์ของ K ตัวอย่างของรูปภาพเดียวกันอยู่ติดกัน (แถว row * K ถึง row * K + K - 1)
+            with profile("generate", batch=len(batch), samples=num_samples) as generate_span:
+                generated_ids = self.model.generate(num_return_sequences=num_samples, **generate_kwargs)
+                for row, (i, _) in enumerate(batch):
+                    sample_rows = range(row * num_samples, (row + 1) * num_samples)
+                    sample_infos = [self._generation_info(generated_ids[r], repetition_criteria.stopped_at.get(r), max_new_tokens)
+                                    for r in sample_rows]
+                    responses[i] = per_image([self._decode_response(generated_ids[r], instruction) for r in sample_rows])
+                    infos[i] = per_image(sample_infos)
+                    generate_span.add(tokens=sum(info["tokens_generated"] for info in sample_infos))
+        return (responses, infos) if return_info else responses
+
+    def stream_narrative(self, image_path, instruction, cancel_event=None, info=None, stop_on_repetition=True,
+                         repetition_ngram_size=8, repetition_max_repeats=3, repetition_window=128, seed=None):
+        """
+        สร้างคำบรรยายของรูปภาพเดียวแบบ Streaming: yield ข้อความที่ตัดแล้วทีละส่วนทันทีที่ถอดรหัสได้
+        (ผลรวมของทุกส่วนเท่ากับผลลัพธ์ของ generate_narrative)
+
+        การยกเลิกกลางคัน: set() ที่ cancel_event (threading.Event) หรือเรียก close() ที่ Generator
+        การสร้างข้อความจะหยุดที่ token ถัดไป
+        ถ้ากำหนด info (dict) จะถูกเติม stop_reason ("eos", "max_new_tokens", "repetition", "cancelled"),
+        tokens_generated และ tokens_saved เมื่อ Streaming จบ
+        """
+        cancel_event = cancel_event or threading.Event()
+        repetition_config = {"ngram_size": repetition_ngram_size, "max_repeats": repetition_max_repeats,
+                             "window": repetition_window} if stop_on_repetition else None
+        generate_kwargs, repetition_criteria = self._prepare_generation(
+            [self.image_cache.get(image_path)], instruction, repetition_config,
+            extra_criteria=[CancellationStoppingCriteria(cancel_event)], seeds=None if seed is None else [seed])
+        # skip_prompt: generate ด้วย inputs_embeds ส่ง input_ids ว่าง (Prompt) มาเป็นครั้งแรกก่อน token ใหม่
+        streamer = TextIteratorStreamer(self.processor.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        result = {}
+
+        def run_generate():
+            try:
+                result["generated_ids"] = self.model.generate(streamer=streamer, **generate_kwargs)
+            except Exception as e:
+                result["error"] = e
+                streamer.end() # ปลด Thread ที่รอข้อความอยู่ ไม่ให้ค้าง
+        thread = threading.Thread(target=run_generate, name="stream-generate", daemon=True)
+        thread.start()
+
+        cleaner = ResponseCleaner()
+        completed = False
+        try:
+            for text in streamer:
+                if cancel_event.is_set():
+                    break
+                chunk = cleaner.feed(text)
+                if chunk: yield chunk
+                if cleaner.finished:
+                    break # โมเดลขึ้นคำตอบรอบใหม่ ไม่ต้องสร้างต่อ
+            else:
+                completed = not cancel_event.is_set()
+                chunk = cleaner.flush()
+                if chunk: yield chunk
+        finally:
+            # หยุดการสร้างข้อความเสมอ (รวมถึงกรณีผู้เรียกปิด Generator กลางคัน) และรอ Thread จบ
+            cancelled = not completed and not cleaner.finished
+            cancel_event.set()
+            thread.join()
+        if "error" in result:
+            raise result["error"]
+        if info is not None:
+            generated_ids = result["generated_ids"][0]
+            info.update(self._generation_info(generated_ids, repetition_criteria.stopped_at.get(0),
+                                               self.GENERATION_CONFIG["max_new_tokens"]))
+            if cancelled:
+                info.update(stop_reason="cancelled", tokens_generated=int(generated_ids.shape[0]))
+
+    def _prepare_generation(self, cached_images, instruction, repetition_config=None, extra_criteria=(), seeds=None):
+        """
+        เตรียมอาร์กิวเมนต์ของ self.model.generate สำหรับ Batch ของรูปภาพ (ใช้ Image Embeddings จาก Cache)
+        seeds: seed ของแต่ละแถวที่สร้าง (รูปภาพ x num_return_sequences) หรือ None เพื่อสุ่มด้วย Random State รวม
+        คืนค่า (generate_kwargs, repetition_criteria)
+        """
+        tokenizer = self.processor.tokenizer
         # สร้าง Prompt ตาม format ของ LLaVA
         prompt = f"USER: <image>\n{instruction}\nASSISTANT:"
-        # ใช้ Processor เพื่อแปลงรูปภาพและข้อความเป็น Tensor ที่โมเดลเข้าใจ
-        inputs = self.processor(text=prompt, images=image, return_tensors="pt").to(self.device)
-        inputs['pixel_values'] = inputs['pixel_values'].to(self.model.dtype)
-
-        with torch.no_grad(): # ปิดการคำนวณ Gradient เพื่อประหยัดหน่วยความจำและเพิ่มความเร็ว
-            # --- สร้างข้อความด้วยพารามิเตอร์การสุ่ม (Aggressive Sampling) ---
-            # ใช้พารามิเตอร์เหล่านี้เพื่อ "กระตุ้น" ให้โมเดลสร้างคำตอบใหม่ๆ และไม่คัดลอก Prompt กลับมา
-            outputs = self.model.generate(
-                **inputs, 
-                max_new_tokens=256,         # จำกัดความยาวสูงสุดของคำตอบ
-                do_sample=True,             # เปิดโหมดการสุ่ม (Sampling)
-                temperature=0.7,            # เพิ่มความหลากหลายและความคิดสร้างสรรค์ของคำตอบ
-                top_k=50,                   # จำกัดการสุ่มให้อยู่ในกลุ่มคำที่น่าจะเป็นที่สุด 50 คำแรก
-                repetition_penalty=1.2      # ลดโอกาสที่โมเดลจะพูดคำซ้ำๆ
-            )
-        
+        with torch.no_grad(), profile("prepare_inputs", images=len(cached_images)): # ปิดการคำนวณ Gradient เพื่อประหยัดหน่วยความจำและเพิ่มความเร็ว
+            # ใช้ Image Embeddings จาก Cache แทนการรัน Vision Tower ซ้ำ
+            image_features = torch.cat([self._get_image_features(cached_image) for cached_image in cached_images])
+            inputs = self._tokenize([prompt] * len(cached_images), image_features.shape[1])
+            inputs_embeds = self._build_inputs_embeds(inputs['input_ids'], image_features)
+
+        # เกณฑ์หยุดเมื่อโมเดลวนซ้ำ (สร้างใหม่ทุก Batch เพื่อจดจำแถวที่หยุดแยกกัน)
+        repetition_criteria = RepetitionStoppingCriteria(
+            ignore_token_ids=(tokenizer.pad_token_id, tokenizer.eos_token_id), **(repetition_config or {}))
+        criteria = ([repetition_criteria] if repetition_config is not None else []) + list(extra_criteria)
+        generate_kwargs = dict(
+            inputs_embeds=inputs_embeds,
+            attention_mask=inputs['attention_mask'],
+            pad_token_id=tokenizer.pad_token_id,
+            stopping_criteria=StoppingCriteriaList(criteria),
+            **self.GENERATION_CONFIG
+        )
+        if seeds is not None and self.GENERATION_CONFIG.get("do_sample"):
+            generate_kwargs["logits_processor"] = LogitsProcessorList([SeededSamplingProcessor(
+                seeds, self.GENERATION_CONFIG.get("temperature", 1.0), self.GENERATION_CONFIG.get("top_k", 50),
+                self.GENERATION_CONFIG.get("top_p", 1.0))])
+        return generate_kwargs, repetition_criteria
+
+    def _generation_info(self, generated_ids, repetition_stop_step, max_new_tokens):
+        # สรุปสาเหตุที่หยุดการสร้างข้อความ และจำนวน token ที่ประหยัดได้จากการหยุดก่อนกำหนด
+        tokenizer = self.processor.tokenizer
+        if repetition_stop_step is not None:
+            return {"stop_reason": "repetition", "tokens_generated": repetition_stop_step,
+                    "tokens_saved": max_new_tokens - repetition_stop_step}
+        eos_positions = (generated_ids == tokenizer.eos_token_id).nonzero().flatten()
+        if len(eos_positions) > 0:
+            return {"stop_reason": "eos", "tokens_generated": int(eos_positions[0]) + 1, "tokens_saved": 0}
+        return {"stop_reason": "max_new_tokens", "tokens_generated": int(generated_ids.shape[0]), "tokens_saved": 0}
+
+    def _decode_response(self, generated_ids, instruction):
         # --- ส่วนของการถอดรหัส (Decoding) และดีบัก ---
-        # ถอดรหัสผลลัพธ์ดิบ (รวม special tokens) เพื่อใช้ในการดีบัก
-        raw_generated_text = self.processor.decode(outputs[0], skip_special_tokens=False)
-        print(f"DEBUG: Raw model output: '{raw_generated_text}'")
+        if self.debug:
+            # ถอดรหัสผลลัพธ์ดิบ (รวม special tokens) เพื่อใช้ในการดีบัก (เฉพาะเมื่อเปิด debug)
+            raw_generated_text = self.processor.decode(generated_ids, skip_special_tokens=False)
+            print(f"DEBUG: Raw model output: '{raw_generated_text}'")
         
-        # ถอดรหัสผลลัพธ์แบบสะอาด (ไม่รวม special tokens) เพื่อนำไปใช้งาน
-        generated_text = self.processor.decode(outputs[0], skip_special_tokens=True)
+        # ถอดรหัสเฉพาะ token ใหม่แบบสะอาด (ไม่รวม special tokens) ครั้งเดียว เพื่อนำไปใช้งาน
+        generated_text = self.processor.decode(generated_ids, skip_special_tokens=True)
         
-        # --- Logic การแยกข้อความตอบกลับที่ทนทานขึ้น ---
-        if "ASSISTANT:" in generated_text:
-            # แยกเอาเฉพาะส่วนที่เป็นคำตอบของ Assistant
-            response = generated_text.split("ASSISTANT:")[1].strip()
-            return response if response else "Error: Model returned an empty response after 'ASSISTANT:'."
-        else:
-            # กรณีที่โมเดลไม่ได้สร้าง "ASSISTANT:" ออกมา ให้พยายามลบส่วน prompt ทิ้ง
-            clean_text = generated_text.replace(f"USER: <image>\n{instruction}".strip(), "").strip()
-            return clean_text if clean_text else "Error: Model produced no parsable output."
+        # --- Logic การแยกข้อความตอบกลับที่ทนทานขึ้น (ดู ResponseCleaner.py) ---
+        return parse_response(generated_text, instruction)
+
+    def prefetch_image(self, image_path):
+        """
+        ถอดรหัสรูปภาพและคำนวณ pixel_values ล่วงหน้าบน CPU (เรียกจาก Thread อื่นได้ เช่น Prefetch ของ Pipeline)
+        เพื่อให้ขั้นตอนที่ใช้โมเดลไม่ต้องรอการอ่านไฟล์และ Preprocessing
+        """
+        cached_image = self.image_cache.get(image_path)
+        if cached_image.pixel_values is None:
+            with profile("preprocess", images=1):
+                cached_image.pixel_values = self.processor.image_processor(cached_image.image, return_tensors="pt")["pixel_values"]
+            self.image_cache.save(cached_image)
+        return cached_image
+
+    def _get_pixel_values(self, cached_image, persist=True):
+        # แปลงรูปภาพเป็น pixel_values ครั้งเดียวต่อรูป แล้วเก็บไว้ใน Cache
+        if cached_image.pixel_values is None:
+            with profile("preprocess", images=1):
+                cached_image.pixel_values = self.processor.image_processor(cached_image.image, return_tensors="pt")["pixel_values"]
+            if persist: self.image_cache.save(cached_image)
+        return cached_image.pixel_values.to(self.device, self.model.dtype)
+
+    def _get_image_features(self, cached_image):
+        # รัน Vision Tower + multi_modal_projector ครั้งเดียวต่อรูป แล้วเก็บ Image Embeddings ไว้ใน Cache
+        if cached_image.image_features is None:
+            pixel_values = self._get_pixel_values(cached_image, persist=False)
+            config = self.model.config
+            with torch.no_grad(), profile("vision_encode", images=pixel_values.shape[0]):
+                image_features = self.model.get_image_features(
+                    pixel_values=pixel_values,
+                    vision_feature_layer=config.vision_feature_layer,
+                    vision_feature_select_strategy=config.vision_feature_select_strategy,
+                )
+            if isinstance(image_features, (list, tuple)):
+                image_features = torch.stack(list(image_features))
+            cached_image.image_features = image_features.detach().cpu()
+            self.image_cache.save(cached_image)
+        return cached_image.image_features.to(self.device)
+
+    def _image_token_id(self):
+        config = self.model.config
+        return getattr(config, "image_token_id", None) or getattr(config, "image_token_index")
+
+    def _num_image_tokens(self, cached_image, pixel_values):
+        # จำนวน token ของรูปภาพ 1 รูปใน Prompt (เช่น 576 สำหรับ CLIP ViT-L/14 ที่ 336px)
+        if cached_image.image_features is not None:
+            return cached_image.image_features.shape[1]
+        config = self.model.config
+        patch_size = config.vision_config.patch_size
+        num_tokens = (pixel_values.shape[-2] // patch_size) * (pixel_values.shape[-1] // patch_size)
+        return num_tokens + 1 if config.vision_feature_select_strategy == "full" else num_tokens
+
+    def _tokenize(self, text, num_image_tokens, return_offsets=False):
+        # ขยาย <image> ให้เป็น token ของรูปภาพตามจำนวนจริง (แบบเดียวกับที่ Processor ทำ) แล้วแปลงเป็น Tensor
+        # รับได้ทั้งข้อความเดียวและลิสต์ของข้อความ (Batch จะถูกเติม padding ทางซ้าย เพื่อให้ generate ต่อท้ายได้ถูกต้อง)
+        # return_offsets=True จะคืน offset_mapping (ตำแหน่งตัวอักษรของแต่ละ token) มาด้วย ถ้า Tokenizer รองรับ
+        texts = [text] if isinstance(text, str) else list(text)
+        expanded_texts = [t.replace("<image>", "<image>" * num_image_tokens) for t in texts]
+        tokenizer = self.processor.tokenizer
+        tokenizer.padding_side = "left"
+        return_offsets = return_offsets and tokenizer.is_fast
+        return tokenizer(expanded_texts, return_tensors="pt", padding=True,
+                         return_offsets_mapping=return_offsets).to(self.device)
+
+    def _build_inputs_embeds(self, input_ids, image_features):
+        # แทนที่ Embedding ของ token <image> ด้วย Image Embeddings ที่คำนวณไว้แล้ว
+        inputs_embeds = self.model.get_input_embeddings()(input_ids)
+        image_mask = (input_ids == self._image_token_id()).unsqueeze(-1)
+        if image_mask.sum() != image_features.shape[0] * image_features.shape[1]:
+            raise ValueError("Number of <image> tokens in the prompt does not match the cached image features.")
+        return inputs_embeds.masked_scatter(image_mask, image_features.to(inputs_embeds.dtype))
 
     def generate_xai_heatmap(self, image_path, full_text, keyword):
-        global feature_maps, gradients # เรียกใช้ตัวแปร global
+        # สร้าง Heatmap ของ keyword เดียว (เรียกใช้ generate_xai_heatmaps ภายใน)
+        return self.generate_xai_heatmaps(image_path, full_text, [keyword]).get(keyword)
+
+    def generate_xai_heatmaps(self, image_path, full_text, keywords, keyword_spans=None, return_attribution=False, info=None):
+        """
+        สร้าง Heatmap ของหลาย keyword พร้อมกันจาก Forward Pass เพียงครั้งเดียว
+
+        เป้าหมายของแต่ละ keyword คือผลรวมของ log-probability ของทุก sub-token ของ keyword
+        ในทุกตำแหน่งที่ keyword ปรากฏใน full_text (Teacher forcing บนข้อความที่สร้างแล้ว)
+        ถ้า keyword ไม่ปรากฏในคำตอบ (Omitted) จะใช้ตำแหน่งสำรองที่กำหนดชัดเจน คือ log-probability
+        ของ sub-token แรกของ keyword ต่อจากการปรากฏครั้งสุดท้ายของ keyword อื่นที่ปรากฏ
+        (หรือต่อจากท้ายข้อความ ถ้าไม่มี keyword ใดปรากฏเลย) ดู _xai_prefill_length
+        จากนั้นคำนวณ Gradient ของทุก keyword ใน Backward Pass แบบ Batch ครั้งเดียว (vector-Jacobian product)
+        ในโหมด "activation" จะคำนวณ Gradient เทียบกับ Feature Map โดยตรงด้วย torch.autograd.grad
+        จึงไม่มีการเติม .grad ให้กับพารามิเตอร์ของโมเดล
+
+        Args:
+            keyword_spans (dict, optional): {keyword: [(start, end), ...]} ตำแหน่งตัวอักษรของ keyword ใน full_text
+                ถ้าไม่ระบุ จะค้นหา keyword แบบตรงทั้งคำในส่วนคำตอบหลัง "ASSISTANT:" ให้อัตโนมัติ
+                อาจมี keyword ที่ไม่อยู่ใน keywords ได้ (ใช้กำหนดตำแหน่งสำรองของ keyword ที่ไม่ปรากฏเท่านั้น)
+            return_attribution (bool): ถ้า True จะคืนค่า (heatmaps, attribution) โดย attribution ระบุ
+                ตำแหน่ง token ที่ใช้คำนวณของแต่ละ keyword
+            info (dict, optional): ถ้ากำหนด จะถูกเติม prefill_tokens (จำนวน token ที่ส่งเข้า Forward Pass)
+                และ prefill_tokens_saved (จำนวน token ท้ายข้อความที่ไม่ต้องคำนวณ ดู _xai_prefill_length)
+
+        Returns:
+            dict: {keyword: heatmap (numpy array) หรือ None ถ้าสร้างไม่สำเร็จ}
+        """
+        heatmaps = {keyword: None for keyword in keywords}
+        attribution = {}
+        result = (heatmaps, attribution) if return_attribution else heatmaps
         
         # ตรวจสอบว่า Narrative ที่ได้มานั้นสมบูรณ์หรือไม่ ก่อนจะเริ่มทำ XAI
-        if not full_text or "ASSISTANT:" not in full_text or not full_text.split("ASSISTANT:")[1].strip():
-             return None
+        if not keywords or not full_text or "ASSISTANT:" not in full_text or not full_text.split("ASSISTANT:")[1].strip():
+             return result
 
-        # --- การแก้ไข: ค้นหา Layer เป้าหมายแบบไดนามิก แทนการใช้ Path ที่ตายตัว ---
-        target_layer = None
-        # วนลูปค้นหาโมดูลทั้งหมดในโมเดลเพื่อหา Layer ที่เราต้องการ
-        for name, module in self.model.named_modules():
-            # ชื่อของ Layer สุดท้ายใน Vision Encoder ของ LLaVA-v1.5 คือ layers.23 (เพราะมี 24 layers เริ่มจาก 0)
-            if name.endswith("vision_model.encoder.layers.23.layer_norm2"):
-                target_layer = module
-                # พิมพ์ข้อความดีบักเมื่อหาเจอ เพื่อยืนยันว่าโค้ดทำงานถูกต้อง
-                print(f"     [XAI DEBUG] Successfully found target layer: {name}")
-                break
-        
-        # ถ้าวนลูปจนจบแล้วยังหา Layer ไม่เจอ ให้หยุดทำงานและคืนค่า None
-        if target_layer is None:
-            print("     [XAI ERROR] Could not find the target layer for hooks. Aborting heatmap generation.")
-            return None
-        # --------------------------------------------------------------------
-        
-        # ติดตั้ง Hooks เข้ากับ Layer ที่เราหาเจอ
-        forward_hook = target_layer.register_forward_hook(get_feature_maps_hook)
-        backward_hook = target_layer.register_full_backward_hook(get_gradients_hook)
-        heatmap = None
-        try:
-            # (ส่วนที่เหลือของฟังก์ชันนี้คือกระบวนการคำนวณ Heatmap ที่คล้ายกับ Grad-CAM)
-            image = Image.open(image_path).convert("RGB")
-            # แปลง keyword ที่สนใจเป็น token ID
-            keyword_token_ids = self.processor.tokenizer.encode(keyword, add_special_tokens=False)
-            if not keyword_token_ids: return None
-            target_token_id = keyword_token_ids[-1] # ใช้ token สุดท้ายถ้าคำนั้นมีหลาย token
-            
-            # เตรียมข้อมูลเข้าสำหรับโมเดล
-            inputs = self.processor(text=full_text, images=image, return_tensors="pt").to(self.device)
-            inputs['pixel_values'] = inputs['pixel_values'].to(self.model.dtype)
-            
-            # ล้างค่าเก่าใน global variables และ reset gradients
-            feature_maps.clear(); gradients.clear(); self.model.zero_grad()
-            
-            # ทำ Forward Pass เพื่อให้ได้ logits และดักจับ Feature Map ผ่าน hook
-            model_output = self.model(**inputs, output_hidden_states=True)
-            logits = model_output.logits
-            
-            # เพิ่มการป้องกัน IndexError กรณีโมเดลสร้างคำตอบสั้นเกินไป
-            if logits.shape[1] < 2:
-                print("     [XAI ERROR] Generated sequence is too short for gradient calculation.")
-                return None
-            # เลือก logit ของ token เป้าหมาย (ที่ตำแหน่งเกือบท้ายสุด)
-            target_logit = logits[0, -2, target_token_id]
-            # ทำ Backward Pass จาก logit นั้น เพื่อคำนวณ Gradient และดักจับผ่าน hook
-            target_logit.backward()
-            
-            # คำนวณ Heatmap จาก Feature Map และ Gradient ที่ดักจับมาได้
-            if gradients and feature_maps:
-                pooled_gradients = torch.mean(gradients[0], dim=[0, 2, 3])
-                last_feature_maps = feature_maps[0].squeeze(0)
-                for i in range(last_feature_maps.shape[0]): last_feature_maps[i, :, :] *= pooled_gradients[i]
-                heatmap = torch.mean(last_feature_maps, dim=0).cpu().detach().numpy()
-                heatmap = np.maximum(heatmap, 0)
-                
-                # เพิ่มการจัดการ Normalization ที่ทนทานขึ้น
-                max_val = np.max(heatmap)
-                if max_val > 1e-6: # ตรวจสอบว่าค่าสูงสุดไม่ใกล้ศูนย์เกินไป
-                    heatmap /= max_val
-        except Exception as e:
-            # พิมพ์ข้อความ error หากเกิดข้อผิดพลาดระหว่างการคำนวณ Gradient
-            print(f"     [XAI ERROR] An exception occurred during gradient calculation for '{keyword}': {e}")
-            heatmap = None
-        finally:
-            # นำ Hooks ออกเสมอ ไม่ว่าจะเกิด error หรือไม่ เพื่อป้องกัน memory leak
-            forward_hook.remove(); backward_hook.remove()
-        return heatmap
+        # Layer เป้าหมายถูกค้นหาและติดตั้ง Hook ไว้แล้วตอนสร้างโมเดล (ดู _resolve_target_layers)
+        if not self.layer_capture.names:
+            print("     [XAI ERROR] No target layer is available for hooks. Aborting heatmap generation.")
+            return result
+
+        if keyword_spans is None:
+            # ค้นหาตำแหน่งของ keyword (ตรงทั้งคำ) ในส่วนคำตอบของ Assistant
+            answer_start = full_text.index("ASSISTANT:") + len("ASSISTANT:")
+            found_spans = KeywordIndex({keyword: [] for keyword in keywords}).spans(full_text[answer_start:])
+            keyword_spans = {keyword: [(start + answer_start, end + answer_start) for start, end in spans]
+                             for keyword, spans in found_spans.items()}
         
+        # เก็บ Feature Map ผ่าน Hook ที่ติดตั้งไว้แล้ว เฉพาะระหว่างการเรียกครั้งนี้
+        activation_only = self.xai_gradient_mode == "activation"
+        rss_before = peak_rss_mb()
+        with self.layer_capture.recording(as_leaf=activation_only) as capture:
+            try:
+                # เตรียมข้อมูลเข้าสำหรับโมเดล (ทำครั้งเดียวต่อเคส, ใช้ pixel_values จาก Cache)
+                # ต้องส่ง pixel_values เข้าโมเดลใหม่ เพราะ Gradient ต้องไหลผ่าน Vision Tower
+                cached_image = self.image_cache.get(image_path)
+                pixel_values = self._get_pixel_values(cached_image)
+                num_image_tokens = self._num_image_tokens(cached_image, pixel_values)
+                inputs = self._tokenize(full_text, num_image_tokens, return_offsets=True)
+                token_offsets = inputs.pop("offset_mapping", None)
+                inputs['pixel_values'] = pixel_values
+
+                # แปลงตำแหน่งตัวอักษรของ keyword เป็นตำแหน่ง token ในลำดับข้อมูลเข้า
+                token_positions = self._keyword_token_positions(full_text, keyword_spans, num_image_tokens, token_offsets)
+
+                # ตัด token ท้ายข้อความที่ไม่มีผลต่อ logits ที่ต้องใช้ออกก่อน Forward Pass
+                # (เก็บ input_ids เต็มไว้ เพื่ออ่าน token เป้าหมายของ keyword)
+                input_ids = inputs['input_ids'][0]
+                full_length = int(input_ids.shape[0])
+                prefill_length = self._xai_prefill_length(input_ids, keywords, token_positions)
+                inputs['input_ids'] = inputs['input_ids'][:, :prefill_length]
+                inputs['attention_mask'] = inputs['attention_mask'][:, :prefill_length]
+                if info is not None:
+                    info.update(prefill_tokens=prefill_length, prefill_tokens_saved=full_length - prefill_length)
+
+                if not activation_only: self.model.zero_grad()
+
+                # ทำ Forward Pass ครั้งเดียว เพื่อให้ได้ logits และดักจับ Feature Map ของทุก Layer เป้าหมายผ่าน hook
+                with profile("xai_forward", input_tokens=prefill_length, tokens_saved=full_length - prefill_length):
+                    logits = self.model(**inputs).logits
+
+                # เพิ่มการป้องกัน IndexError กรณีโมเดลสร้างคำตอบสั้นเกินไป
+                if logits.shape[1] < 2:
+                    print("     [XAI ERROR] Generated sequence is too short for gradient calculation.")
+                    return result
+                activations = capture.captured()
+                if any(activation is None or not activation.requires_grad for activation in activations):
+                    print("     [XAI ERROR] Target layer activation was not captured with gradients enabled.")
+                    return result
+
+                # รวบรวมเป้าหมาย (log-probability) ของทุก keyword จาก logits ชุดเดียว
+                objectives, attribution_positions = self._keyword_objectives(logits, input_ids, keywords, token_positions)
+                if not attribution_positions:
+                    return result
+                attribution.update(attribution_positions)
+
+                # Backward Pass แบบ Batch ของทุก keyword ในครั้งเดียว (Gradient ของทุก Layer เป้าหมายพร้อมกัน)
+                with profile("xai_backward", keywords=len(attribution_positions), layers=len(activations)):
+                    layer_gradients = self._activation_gradients(objectives, activations, activation_only)
+
+                # คำนวณ Heatmap ของทุก keyword พร้อมกันด้วย Grad-CAM แบบ Vectorized (เฉลี่ยทุก Layer ถ้ามีหลาย Layer)
+                # (Feature Map ของ CLIP มีรูปแบบ (batch, 1 + patches, hidden) ตัด CLS token ออกเสมอ
+                #  เพราะ Activation ของ Encoder Layer มี CLS ที่ตำแหน่ง 0 ทุกครั้ง ไม่ว่า vision_feature_select_strategy เป็นอะไร
+                #  strategy มีผลเฉพาะ Feature ที่ส่งให้ Projector ไม่ใช่ Feature Map ที่ Hook ดักจับ)
+                if layer_gradients is not None:
+                    with profile("gradcam", keywords=len(attribution_positions), layers=len(activations)):
+                        cams = multi_layer_gradcam([activation[0] for activation in activations], layer_gradients,
+                                                   drop_cls=True)
+                        for keyword, cam in zip(attribution_positions, cams.cpu().numpy()):
+                            heatmaps[keyword] = cam
+                else:
+                    print("     [XAI ERROR] The target layer does not contribute to the keyword logits (no gradient).")
+            except Exception as e:
+                print(f"     [XAI ERROR] An exception occurred during gradient calculation: {e}")
+            finally:
+                rss_after = peak_rss_mb()
+                if self.debug and rss_before is not None:
+                    print(f"     [XAI DEBUG] Peak RSS ({self.xai_gradient_mode} mode): "
+                          f"{rss_before:.0f} MB before XAI, {rss_after:.0f} MB after XAI")
+        return result
+
+    def _keyword_token_positions(self, full_text, keyword_spans, num_image_tokens, token_offsets):
+        """
+        แปลงตำแหน่งตัวอักษรของ keyword ใน full_text เป็นตำแหน่ง token ในลำดับข้อมูลเข้า (หลังขยาย <image> แล้ว)
+        คืนค่า {keyword: [[ตำแหน่ง token ของการปรากฏครั้งที่ 1], [ครั้งที่ 2], ...]}
+        """
+        if token_offsets is None:
+            return {}
+        offsets = token_offsets[0].tolist()
+        image_index = full_text.find("<image>")
+        shift = len("<image>") * (num_image_tokens - 1) # ความยาวที่เพิ่มขึ้นหลังขยาย <image>
+        positions = {}
+        for keyword, spans in keyword_spans.items():
+            occurrences = []
+            for start, end in spans:
+                if 0 <= image_index < start:
+                    start, end = start + shift, end + shift
+                occurrence = [i for i, (token_start, token_end) in enumerate(offsets)
+                              if token_end > token_start and token_start < end and token_end > start]
+                # ต้องมี token ก่อนหน้าอย่างน้อย 1 ตัว จึงจะมี logits สำหรับทำนาย token แรกของ keyword
+                if occurrence and occurrence[0] > 0:
+                    occurrences.append(occurrence)
+            positions[keyword] = occurrences
+        return positions
+
+    def _xai_prefill_length(self, input_ids, keywords, token_positions):
+        """
+        จำนวน token ต้นลำดับที่ต้องส่งเข้า Forward Pass ของ XAI (ตัดเฉพาะส่วนท้ายของข้อความ ส่วนต้นยังคำนวณใหม่ทุกครั้ง)
+        Causal LM: logits ที่ตำแหน่ง t ขึ้นกับ token 0..t เท่านั้น จึงตัดข้อความหลังการปรากฏครั้งสุดท้ายของ keyword ได้
+        โดยไม่เปลี่ยนค่าของเป้าหมายของ keyword ที่ปรากฏ
+        - ทุก keyword ปรากฏ:  ตัดหลัง token สุดท้ายที่ปรากฏ (token ที่ p ใช้ logits ของตำแหน่ง p - 1)
+        - มี keyword ที่ไม่ปรากฏ: ตัดหลังการปรากฏครั้งสุดท้ายของ keyword ใดๆ ใน token_positions (รวม keyword ที่ไม่ได้ขอ)
+          และเก็บ token นั้นไว้ด้วย เพื่อให้ตำแหน่งสำรอง "continuation" (ตำแหน่งสุดท้ายของลำดับที่ตัดแล้ว)
+          ไม่ขึ้นกับว่าขอ keyword ชุดใด (เช่น เฉพาะ keyword ที่ไม่มีใน Cache)
+        - ไม่มี keyword ใดปรากฏ: ใช้ทั้งลำดับ (ตำแหน่งสำรองอยู่ท้ายข้อความ)
+        (ไม่ตัดเข้าไปใน token ของรูปภาพเสมอ เพราะจำนวน token ของรูปภาพต้องตรงกับ Image Features)
+        """
+        full_length = int(input_ids.shape[0])
+        if all(token_positions.get(keyword) for keyword in keywords):
+            last_position = max(position for keyword in keywords for occurrence in token_positions[keyword]
+                                for position in occurrence)
+        else:
+            mentioned_positions = [position for occurrences in token_positions.values() for occurrence in occurrences
+                                   for position in occurrence]
+            if not mentioned_positions:
+                return full_length
+            last_position = max(mentioned_positions) + 1
+        image_positions = (input_ids == self._image_token_id()).nonzero().flatten()
+        image_end = int(image_positions[-1]) + 1 if len(image_positions) else 0
+        return min(full_length, max(last_position, image_end + 1))
+
+    def _keyword_objectives(self, logits, input_ids, keywords, token_positions):
+        """
+        คำนวณเป้าหมายของทุก keyword จาก logits ในครั้งเดียว
+        - keyword ที่ปรากฏ: ผลรวม log p(sub-token | ข้อความก่อนหน้า) ของทุก sub-token ในทุกตำแหน่งที่ปรากฏ
+        - keyword ที่ไม่ปรากฏ: log p(sub-token แรกของ keyword) ณ ตำแหน่งสุดท้ายของ logits (ตำแหน่งสำรอง "continuation"
+          คือต่อจากการปรากฏครั้งสุดท้ายของ keyword อื่น เพราะส่วนท้ายถูกตัดแล้ว ดู _xai_prefill_length)
+        คืนค่า (Tensor ขนาด (K,), {keyword: ตำแหน่งที่ใช้})
+        """
+        rows, target_ids, owners, attribution = [], [], [], {}
+        last_position = logits.shape[1] - 1
+        for keyword in keywords:
+            occurrences = token_positions.get(keyword, [])
+            if occurrences:
+                for occurrence in occurrences:
+                    for position in occurrence:
+                        rows.append(position - 1); target_ids.append(int(input_ids[position])); owners.append(len(attribution))
+                attribution[keyword] = {"token_positions": occurrences, "fallback": None}
+            else:
+                keyword_token_ids = self.processor.tokenizer.encode(keyword, add_special_tokens=False)
+                if not keyword_token_ids:
+                    continue
+                rows.append(last_position); target_ids.append(keyword_token_ids[0]); owners.append(len(attribution))
+                attribution[keyword] = {"token_positions": [[last_position + 1]], "fallback": "continuation"}
+        if not attribution:
+            return None, attribution
+
+        device = logits.device
+        rows = torch.tensor(rows, device=device)
+        unique_rows, row_index = torch.unique(rows, return_inverse=True)
+        # log_softmax เฉพาะตำแหน่งที่ต้องใช้ (ไม่ต้องคำนวณทั้งลำดับ)
+        log_probs = torch.log_softmax(logits[0, unique_rows].float(), dim=-1)
+        values = log_probs[row_index, torch.tensor(target_ids, device=device)]
+        objectives = torch.zeros(len(attribution), device=device, dtype=values.dtype)
+        return objectives.index_add(0, torch.tensor(owners, device=device), values), attribution
+
+    def _activation_gradients(self, objectives, activations, activation_only):
+        """
+        Gradient ของทุกเป้าหมายเทียบกับ Feature Map ของทุก Layer เป้าหมาย คืนค่าลิสต์ (1 รายการต่อ Layer)
+        ของ Tensor รูปแบบ (K, tokens, hidden) หรือ None สำหรับ Layer ที่ไม่มีผลต่อเป้าหมาย
+        โหมด "activation" ใช้ vector-Jacobian product แบบ Batch (is_grads_batched) ในครั้งเดียว
+        ถ้าทำไม่ได้ (บาง operation ไม่รองรับ vmap) จะถอยกลับไปทำ Backward ทีละเป้าหมายบน Graph เดิม
+        คืนค่า None ถ้าไม่มี Layer เป้าหมายใดมีผลต่อเป้าหมายเลย
+        """
+        num_objectives = objectives.shape[0]
+        if activation_only:
+            try:
+                grad_outputs = torch.eye(num_objectives, device=objectives.device, dtype=objectives.dtype)
+                gradients = torch.autograd.grad(objectives, activations, grad_outputs=grad_outputs,
+                                                retain_graph=True, is_grads_batched=True, allow_unused=True)
+                layer_gradients = [None if gradient is None else gradient.detach()[:, 0] for gradient in gradients]
+                return None if all(gradient is None for gradient in layer_gradients) else layer_gradients
+            except RuntimeError as e:
+                if self.debug: print(f"     [XAI DEBUG] Batched backward is not supported here ({e}). Falling back to one backward per keyword.")
+
+        per_layer = [[] for _ in activations]
+        for i in range(num_objectives):
+            # เก็บ Graph ไว้ใช้กับเป้าหมายถัดไป (ยกเว้นเป้าหมายสุดท้าย)
+            retain_graph = i < num_objectives - 1
+            if activation_only:
+                gradients = torch.autograd.grad(objectives[i], activations, retain_graph=retain_graph, allow_unused=True)
+            else:
+                self.model.zero_grad()
+                objectives[i].backward(retain_graph=retain_graph)
+                gradients = [activation.grad for activation in activations]
+                for activation in activations: activation.grad = None
+            for layer, gradient in enumerate(gradients):
+                per_layer[layer].append(None if gradient is None else gradient.detach()[0])
+        layer_gradients = [None if any(gradient is None for gradient in gradients) else torch.stack(gradients)
+                           for gradients in per_layer]
+        return None if all(gradient is None for gradient in layer_gradients) else layer_gradients
+
     def superimpose_heatmap(self, image_path, heatmap):
         # --- ฟังก์ชันสำหรับสร้างภาพ Visualization ---
-        img = cv2.imread(image_path)
-        # ปรับขนาด Heatmap ให้เท่ากับรูปภาพต้นฉบับ
-        heatmap_resized = cv2.resize(heatmap, (img.shape[1], img.shape[0]))
-        # ใส่สีให้กับ Heatmap (JET colormap ให้สีรุ้ง)
-        heatmap_colored = np.uint8(255 * heatmap_resized); heatmap_colored = cv2.applyColorMap(heatmap_colored, cv2.COLORMAP_JET)
-        # นำ Heatmap มาวางซ้อนบนรูปภาพต้นฉบับ โดยปรับความโปร่งใส (alpha=0.5)
-        superimposed_img = heatmap_colored * 0.5 + img; superimposed_img = np.clip(superimposed_img, 0, 255).astype(np.uint8)
-        return superimposed_img
\ No newline at end of file
+        # ใช้รูปภาพที่ถอดรหัสไว้แล้วจาก Cache แทนการเรียก cv2.imread ซ้ำ และซ้อนสีด้วย LUT เดียวกับ HeatmapOverlay.py
+        # (JET colormap, alpha=0.5)
+        return superimpose(self.image_cache.get(image_path).image_bgr, heatmap)
\ No newline at end of file
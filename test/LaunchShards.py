@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+import main as evaluation
+from Sharding import is_shard_complete, merge_shards, shard_dir
+
+# --- การตั้งค่า ---
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def launch_shards(num_shards, resume=True, threads_per_worker=None, profile=False,
+                  num_samples=evaluation.NUM_SAMPLES, sample_selection=evaluation.SAMPLE_SELECTION):
+    """
+    เริ่ม worker process จำนวน num_shards ตัว (แต่ละตัวรัน main.py --shard i/N และโหลดโมเดลครั้งเดียว)
+    num_samples/sample_selection ถูกส่งต่อให้ทุก worker (--samples/--sample-selection ของ main.py)
+    resume=True จะข้าม Shard ที่ทำงานจบแล้วด้วยการตั้งค่าเดียวกัน (Shard ที่หยุดกลางคันจะรันต่อ โดยเคสที่เสร็จแล้วใช้ผลลัพธ์จาก Cache)
+    profile=True จะให้แต่ละ worker บันทึก Trace ของตัวเองในโฟลเดอร์ของ Shard (รวมเป็นตารางเดียวตอนสร้างสรุปผล)
+    คืนค่า dict {shard index: return code}
+    """
+    if threads_per_worker is None:
+        # แบ่ง CPU core ให้แต่ละ worker เท่าๆ กัน เพื่อไม่ให้ Thread ของ PyTorch แย่ง core กันเอง
+        threads_per_worker = max(1, (os.cpu_count() or 1) // num_shards)
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads_per_worker), MKL_NUM_THREADS=str(threads_per_worker))
+
+    settings = evaluation.shard_settings(num_samples, sample_selection)
+    processes = {}
+    for index in range(num_shards):
+        if resume and is_shard_complete(shard_dir(evaluation.OUTPUT_DIR, index, num_shards), settings):
+            print(f"Shard {index}/{num_shards} is already complete. Skipping.")
+            continue
+        command = [sys.executable, MAIN_SCRIPT, "--shard", f"{index}/{num_shards}", "--no-summary",
+                   "--samples", str(num_samples), "--sample-selection", sample_selection]
+        if profile: command.append("--profile")
+        print(f"Starting shard {index}/{num_shards}: {' '.join(command)}")
+        processes[index] = subprocess.Popen(command, env=env)
+
+    start_time = time.perf_counter()
+    return_codes = {index: process.wait() for index, process in processes.items()}
+    for index, return_code in return_codes.items():
+        status = "finished" if return_code == 0 else f"FAILED (exit code {return_code})"
+        print(f"Shard {index}/{num_shards} {status}.")
+    if processes:
+        print(f"All shard workers exited after {time.perf_counter() - start_time:.1f} s.")
+    return return_codes
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run main.py as N sharded worker processes and merge the results.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of shards / worker processes.")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="Torch threads per worker (default: CPU cores divided by workers).")
+    parser.add_argument("--restart", action="store_true", help="Re-run shards that are already complete.")
+    parser.add_argument("--no-summary", action="store_true", help="Skip the summary heatmap and ROUGE matrix.")
+    parser.add_argument("--profile", action="store_true", help="Record a per-stage trace in every worker.")
+    parser.add_argument("--samples", type=int, default=evaluation.NUM_SAMPLES,
+                        help="Narratives sampled per image in every worker (see main.py --samples).")
+    parser.add_argument("--sample-selection", choices=evaluation.SAMPLE_SELECTIONS, default=evaluation.SAMPLE_SELECTION,
+                        help="How every worker picks the narrative used for the heatmaps (see main.py --sample-selection).")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    num_shards = max(1, args.workers)
+    return_codes = launch_shards(num_shards, resume=not args.restart, threads_per_worker=args.threads_per_worker,
+                                 profile=args.profile, num_samples=max(1, args.samples),
+                                 sample_selection=args.sample_selection)
+    # รวมผลลัพธ์ของทุก Shard เสมอ (รวมถึงเคสที่เสร็จแล้วของ Shard ที่ล้มเหลว) แล้วจึงสร้าง Visualization
+    summary = merge_shards(evaluation.OUTPUT_DIR, count=num_shards)
+    if not args.no_summary:
+        evaluation.create_summaries(os.path.join(evaluation.OUTPUT_DIR, "results_json"))
+    if any(return_codes.values()) or summary["incomplete_shards"]:
+        sys.exit(1)
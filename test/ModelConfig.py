@@ -0,0 +1,30 @@
+# การตั้งค่าของโมเดลที่ใช้ร่วมกันระหว่าง LLaVADentist.py และ main.py
+# แยกไว้ในไฟล์นี้ (ไม่ import torch/transformers) เพื่อให้ main.py คำนวณ key ของ Cache ได้โดยไม่ต้องโหลด Library ของโมเดล
+
+# พารามิเตอร์การสร้างข้อความ (Aggressive Sampling)
+# ใช้พารามิเตอร์เหล่านี้เพื่อ "กระตุ้น" ให้โมเดลสร้างคำตอบใหม่ๆ และไม่คัดลอก Prompt กลับมา
+GENERATION_CONFIG = {
+    "max_new_tokens": 256,          # จำกัดความยาวสูงสุดของคำตอบ
+    "do_sample": True,              # เปิดโหมดการสุ่ม (Sampling)
+    "temperature": 0.7,             # เพิ่มความหลากหลายและความคิดสร้างสรรค์ของคำตอบ
+    "top_k": 50,                    # จำกัดการสุ่มให้อยู่ในกลุ่มคำที่น่าจะเป็นที่สุด 50 คำแรก
+    "repetition_penalty": 1.2,      # ลดโอกาสที่โมเดลจะพูดคำซ้ำๆ
+}
+
+# โหมดการคำนวณ Gradient สำหรับ XAI
+# - "activation": คำนวณ Gradient เทียบกับ Feature Map ของ Layer เป้าหมายเท่านั้น และ freeze พารามิเตอร์ทั้งหมด
+#                 (ไม่มีการจอง .grad ให้พารามิเตอร์ใดๆ เลย)
+# - "full":       วิธีเดิม ทำ backward() ผ่านทั้งโมเดล (ใช้เปรียบเทียบหน่วยความจำ)
+XAI_GRADIENT_MODES = ("activation", "full")
+
+# Layer เป้าหมายของ Grad-CAM ใน Vision Tower (ค้นหาและติดตั้ง Hook ครั้งเดียวตอนโหลดโมเดล)
+# - "feature": Layer ที่ส่ง Feature ให้ Projector จริงตาม vision_feature_layer ของ config
+#              (LLaVA-1.5 ใช้ hidden_states[-2] = ผลลัพธ์ของ Layer 22 จาก 0-23)
+# - จำนวนเต็ม: ลำดับ Layer ของ Encoder แบบ Python (ค่าลบนับจากท้าย)
+# ระบุหลาย Layer เพื่อทำ Grad-CAM หลาย Layer (ค่าเฉลี่ยของ Heatmap ที่ Normalize แล้ว)
+XAI_TARGET_LAYERS = ("feature",)
+# รูปแบบชื่อ Module ที่ใช้ดักจับ Feature Map (ต่อท้ายชื่อเต็มของ Module ในโมเดล)
+XAI_TARGET_MODULE = "vision_model.encoder.layers.{index}.layer_norm2"
+
+# ไฟล์ที่บันทึกแหล่งที่มาของโมเดลที่ Materialize แล้ว (ใช้ตรวจสอบว่ายังตรงกับ Base Model และ Adapter ปัจจุบันหรือไม่)
+MATERIALIZED_MANIFEST = "materialized.json"
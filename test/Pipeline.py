@@ -0,0 +1,123 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class StageStats:
+    """
+    สถิติการทำงานของขั้นตอนหนึ่งใน Pipeline
+    - busy_time: เวลาที่ worker ทำงานจริง (รวมทุก worker)
+    - wait_time: เวลาที่ขั้นตอนนี้ต้องรอขั้นตอนอื่น (เฉพาะขั้นตอนของโมเดล: รอ Prefetch หรือรอคิวของ Writer ว่าง)
+    Utilization = busy_time / (เวลาทั้งหมด x จำนวน worker) ขั้นตอนที่มีค่าสูงสุดคือคอขวดของ Pipeline
+    """
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, items=1):
+        with self._lock:
+            self.busy_time += seconds
+            self.items += items
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.wait_time += seconds
+
+    def utilization(self, wall_time):
+        return self.busy_time / (wall_time * self.workers) if wall_time > 0 else 0.0
+
+
+class EvaluationPipeline:
+    """
+    Pipeline 3 ขั้นตอนสำหรับการประเมินผล เพื่อให้โมเดลไม่ต้องรอ I/O และการวาดภาพ:
+    1. prefetch (Thread pool): load(item) อ่านไฟล์ Ground Truth และถอดรหัสรูปภาพล่วงหน้า
+    2. model (Thread หลัก):   process(batch) รับลิสต์ของผลลัพธ์จาก load แล้วคืนค่าลิสต์ของงานสำหรับ Writer
+    3. writer (Thread pool):  write(job) ซ้อน Heatmap, เข้ารหัสรูปภาพ และเขียนไฟล์ JSON
+    ระหว่างขั้นตอนมีคิวจำกัดขนาด (queue_size) ถ้า Writer ทำงานไม่ทัน ขั้นตอนของโมเดลจะรอจนคิวว่าง
+    และ Prefetch จะอ่านล่วงหน้าได้ไม่เกิน queue_size รายการ เพื่อไม่ให้ใช้หน่วยความจำเกินจำเป็น
+    load ที่คืนค่า None จะถูกข้ามไป
+    """
+    def __init__(self, load, process, write, prefetch_workers=2, writer_workers=2, queue_size=4, batch_size=1):
+        self.load = load
+        self.process = process
+        self.write = write
+        self.queue_size = max(1, queue_size)
+        self.batch_size = max(1, batch_size)
+        self.stats = {
+            "prefetch": StageStats("prefetch", max(1, prefetch_workers)),
+            "model": StageStats("model", 1),
+            "writer": StageStats("writer", max(1, writer_workers)),
+        }
+        self.wall_time = 0.0
+
+    def run(self, items):
+        """รันทุกรายการผ่าน Pipeline และรอจนทุกงานของ Writer เสร็จ (Exception จากทุกขั้นตอนจะถูกส่งต่อออกมา)"""
+        start_time = time.perf_counter()
+        pending_items = iter(items)
+        loading = deque()
+        writer_slots = threading.BoundedSemaphore(self.queue_size)
+        writing = []
+        model_stats = self.stats["model"]
+        with ThreadPoolExecutor(self.stats["prefetch"].workers, thread_name_prefix="prefetch") as loader, \
+             ThreadPoolExecutor(self.stats["writer"].workers, thread_name_prefix="writer") as writer:
+
+            def fill():
+                # อ่านล่วงหน้าให้มีรายการรอในคิวเสมอ (อย่างน้อย 1 Batch)
+                while len(loading) < max(self.queue_size, self.batch_size):
+                    item = next(pending_items, None)
+                    if item is None:
+                        return
+                    loading.append(loader.submit(self._timed, "prefetch", self.load, item))
+
+            def release(_future):
+                writer_slots.release()
+
+            fill()
+            while loading:
+                batch = []
+                while loading and len(batch) < self.batch_size:
+                    wait_start = time.perf_counter()
+                    loaded = loading.popleft().result()
+                    model_stats.record_wait(time.perf_counter() - wait_start)
+                    fill()
+                    if loaded is not None:
+                        batch.append(loaded)
+                if not batch:
+                    continue
+
+                jobs = self._timed("model", self.process, batch, items=len(batch))
+                for job in jobs or []:
+                    wait_start = time.perf_counter()
+                    writer_slots.acquire()
+                    model_stats.record_wait(time.perf_counter() - wait_start)
+                    future = writer.submit(self._timed, "writer", self.write, job)
+                    future.add_done_callback(release)
+                    writing.append(future)
+
+            for future in writing:
+                future.result()
+        self.wall_time = time.perf_counter() - start_time
+        return self.stats
+
+    def report(self):
+        """พิมพ์ตารางการใช้งานของแต่ละขั้นตอน และขั้นตอนที่เป็นคอขวด"""
+        print(f"\nPipeline stage utilization (wall time {self.wall_time:.2f} s):")
+        print(f"  {'stage':<10}{'workers':>8}{'items':>8}{'busy (s)':>11}{'wait (s)':>11}{'utilization':>13}")
+        for stats in self.stats.values():
+            print(f"  {stats.name:<10}{stats.workers:>8}{stats.items:>8}{stats.busy_time:>11.2f}"
+                  f"{stats.wait_time:>11.2f}{stats.utilization(self.wall_time):>12.0%}")
+        if self.wall_time > 0:
+            bottleneck = max(self.stats.values(), key=lambda stats: stats.utilization(self.wall_time))
+            print(f"  Throughput is limited by the '{bottleneck.name}' stage.")
+
+    def _timed(self, stage, function, argument, items=1):
+        start_time = time.perf_counter()
+        try:
+            return function(argument)
+        finally:
+            self.stats[stage].record(time.perf_counter() - start_time, items)
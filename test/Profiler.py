@@ -0,0 +1,256 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import threading
+
+try:
+    import resource # ใช้วัด Peak RSS (มีเฉพาะบน Unix)
+except ImportError:
+    resource = None
+
+from ResultCache import atomic_write
+
+# --- การตั้งค่า ---
+# ชื่อไฟล์ Trace ในโฟลเดอร์ของการรัน (JSON lines: 1 บรรทัดต่อ 1 ช่วงการทำงาน) และไฟล์สำหรับ chrome://tracing / Perfetto
+TRACE_FILENAME = "trace.jsonl"
+CHROME_TRACE_FILENAME = "trace.chrome.json"
+# ตัวนับที่ใช้คำนวณอัตราต่อวินาทีในตารางสรุป (เช่น tokens -> tokens/s)
+RATE_COUNTERS = ("tokens",)
+
+
+def peak_rss_mb():
+    """คืนค่า Peak RSS ของ process ปัจจุบันในหน่วย MB (หรือ None ถ้าระบบไม่รองรับ)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux รายงานเป็น KB ส่วน macOS รายงานเป็น bytes
+    return peak / (1024 * 1024) if os.uname().sysname == "Darwin" else peak / 1024
+
+def _loaded_cuda():
+    # ใช้ torch เฉพาะเมื่อถูก import แล้วโดยโมดูลอื่น (Profiler ไม่ import torch เอง)
+    torch = sys.modules.get("torch")
+    return torch.cuda if torch is not None and torch.cuda.is_available() else None
+
+
+class _NullSpan:
+    """ช่วงการทำงานที่ไม่บันทึกอะไรเลย (ใช้เมื่อปิด Profiler จึงไม่มีค่าใช้จ่ายนอกจากการเรียกฟังก์ชัน)"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, **counts):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    ช่วงการทำงานหนึ่งช่วงของขั้นตอน (stage) ใช้กับ with และเพิ่มตัวนับระหว่างทำงานได้ด้วย add()
+    เช่น with profile("generate", batch=4) as span: ...; span.add(tokens=512)
+    """
+    def __init__(self, profiler, stage, counts):
+        self.profiler = profiler
+        self.stage = stage
+        self.counts = counts
+        self.start = None
+
+    def __enter__(self):
+        self.profiler._synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler._synchronize()
+        self.profiler._record(self, time.perf_counter() - self.start, failed=exc_type is not None)
+        return False
+
+    def add(self, **counts):
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+
+class Profiler:
+    """
+    บันทึกเวลา (wall time), ตัวนับ (เช่น tokens, keywords) และ Peak Memory ของแต่ละขั้นตอนของการประเมินผล
+    - trace_path:        ไฟล์ JSON lines ที่เขียนทันทีเมื่อแต่ละช่วงจบ (อ่านกลับด้วย load_trace)
+    - chrome_trace_path: ไฟล์ Chrome trace (เปิดด้วย chrome://tracing หรือ Perfetto) เขียนตอน close()
+    - synchronize_cuda:  รอ GPU ทำงานเสร็จก่อนจับเวลา เพื่อให้เวลาของแต่ละขั้นตอนตรงกับงานจริง
+    Peak Memory ที่บันทึกเป็นค่าสูงสุดของทั้ง process ณ ตอนจบขั้นตอน (ขั้นตอนแรกที่ค่าเพิ่มขึ้นคือขั้นตอนที่ใช้หน่วยความจำมาก)
+    เมื่อ enabled=False ทุก span คืนค่าวัตถุเดียวกันที่ไม่บันทึกอะไร
+    """
+    def __init__(self, trace_path=None, chrome_trace_path=None, enabled=True, synchronize_cuda=True):
+        self.enabled = enabled
+        self.trace_path = trace_path
+        self.chrome_trace_path = chrome_trace_path
+        self.synchronize_cuda = synchronize_cuda
+        self.records = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._trace_file = None
+        if enabled and trace_path:
+            os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+            self._trace_file = open(trace_path, 'w', encoding='utf-8')
+
+    def span(self, stage, **counts):
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, stage, counts)
+
+    def summary(self):
+        """สรุปตามขั้นตอน (ลำดับตามเวลารวมจากมากไปน้อย)"""
+        return summarize(self.records)
+
+    def close(self):
+        """ปิดไฟล์ Trace และเขียน Chrome trace (ถ้ากำหนด)"""
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
+        if self.enabled and self.chrome_trace_path:
+            write_chrome_trace(self.records, self.chrome_trace_path)
+
+    # --- เมธอดภายใน ---
+    def _synchronize(self):
+        if self.synchronize_cuda:
+            cuda = _loaded_cuda()
+            if cuda is not None: cuda.synchronize()
+
+    def _record(self, span, duration, failed=False):
+        record = {
+            "stage": span.stage, "start": round(span.start - self._origin, 6), "duration": round(duration, 6),
+            "pid": os.getpid(), "thread": threading.current_thread().name, "counts": span.counts,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        cuda = _loaded_cuda()
+        if cuda is not None:
+            record["cuda_peak_mb"] = cuda.max_memory_allocated() / (1024 * 1024)
+        if failed:
+            record["failed"] = True
+        with self._lock:
+            self.records.append(record)
+            if self._trace_file is not None:
+                self._trace_file.write(json.dumps(record) + "\n")
+                self._trace_file.flush()
+
+
+# Profiler ของ process (ปิดไว้เป็นค่าเริ่มต้น) เปิดด้วย enable_profiling
+_profiler = Profiler(enabled=False)
+
+def profile(stage, **counts):
+    """เริ่มช่วงการทำงานของขั้นตอน stage กับ Profiler ของ process (ใช้กับ with)"""
+    return _profiler.span(stage, **counts)
+
+def get_profiler():
+    return _profiler
+
+def enable_profiling(trace_path=None, chrome_trace_path=None, synchronize_cuda=True):
+    """เปิดการบันทึกของ process นี้ (ปิด Profiler เดิมก่อน) และคืนค่า Profiler ใหม่"""
+    global _profiler
+    _profiler.close()
+    _profiler = Profiler(trace_path, chrome_trace_path, enabled=True, synchronize_cuda=synchronize_cuda)
+    return _profiler
+
+def disable_profiling():
+    global _profiler
+    _profiler.close()
+    _profiler = Profiler(enabled=False)
+
+
+def load_trace(*trace_paths):
+    """อ่านบันทึกจากไฟล์ Trace (JSON lines) หลายไฟล์รวมกัน เช่น Trace ของทุก Shard (ข้ามไฟล์ที่ไม่มีและบรรทัดที่เสีย)"""
+    records = []
+    for trace_path in trace_paths:
+        if not os.path.exists(trace_path):
+            continue
+        with open(trace_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue # บรรทัดสุดท้ายที่เขียนไม่สมบูรณ์
+    return records
+
+def summarize(records):
+    """
+    รวมบันทึกตามขั้นตอน คืนค่าลิสต์ของ dict ต่อขั้นตอน:
+    stage, calls, total_s, mean_ms, max_ms, ตัวนับรวม (counts), อัตราต่อวินาที (เช่น tokens_per_s) และ Peak Memory
+    """
+    stages = {}
+    for record in records:
+        row = stages.setdefault(record["stage"], {"stage": record["stage"], "calls": 0, "failed": 0, "total_s": 0.0,
+                                                  "max_ms": 0.0, "counts": {}, "peak_rss_mb": None, "cuda_peak_mb": None})
+        row["calls"] += 1
+        row["failed"] += int(record.get("failed", False))
+        row["total_s"] += record["duration"]
+        row["max_ms"] = max(row["max_ms"], record["duration"] * 1000)
+        for name, value in record.get("counts", {}).items():
+            if isinstance(value, (int, float)):
+                row["counts"][name] = row["counts"].get(name, 0) + value
+        for memory in ("peak_rss_mb", "cuda_peak_mb"):
+            if record.get(memory) is not None:
+                row[memory] = max(row[memory] or 0.0, record[memory])
+    rows = sorted(stages.values(), key=lambda row: row["total_s"], reverse=True)
+    for row in rows:
+        row["mean_ms"] = row["total_s"] / row["calls"] * 1000
+        for name in RATE_COUNTERS:
+            if name in row["counts"] and row["total_s"] > 0:
+                row[f"{name}_per_s"] = row["counts"][name] / row["total_s"]
+    return rows
+
+def format_timing_table(rows):
+    """ตารางเวลาของทุกขั้นตอนเป็นข้อความ (สำหรับพิมพ์ออกหน้าจอ)"""
+    if not rows:
+        return "No profiling records."
+    lines = [f"{'Stage':<22}{'Calls':>7}{'Total (s)':>11}{'Mean (ms)':>11}{'Max (ms)':>11}"
+             f"{'Tokens/s':>10}{'RSS (MB)':>10}{'CUDA (MB)':>11}  Counts"]
+    for row in rows:
+        tokens_per_s = f"{row['tokens_per_s']:.1f}" if "tokens_per_s" in row else "-"
+        rss = f"{row['peak_rss_mb']:.0f}" if row["peak_rss_mb"] is not None else "-"
+        cuda = f"{row['cuda_peak_mb']:.0f}" if row["cuda_peak_mb"] is not None else "-"
+        counts = ", ".join(f"{name}={value:g}" for name, value in sorted(row["counts"].items()))
+        if row["failed"]: counts = f"failed={row['failed']}" + (f", {counts}" if counts else "")
+        lines.append(f"{row['stage']:<22}{row['calls']:>7}{row['total_s']:>11.2f}{row['mean_ms']:>11.1f}"
+                     f"{row['max_ms']:>11.1f}{tokens_per_s:>10}{rss:>10}{cuda:>11}  {counts}")
+    return "\n".join(lines)
+
+def write_timing_table(rows, path):
+    """บันทึกตารางเวลาเป็นไฟล์ CSV (1 แถวต่อขั้นตอน)"""
+    counter_names = sorted({name for row in rows for name in row["counts"]})
+    rate_names = [f"{name}_per_s" for name in RATE_COUNTERS]
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["stage", "calls", "failed", "total_s", "mean_ms", "max_ms"] + rate_names
+                        + ["peak_rss_mb", "cuda_peak_mb"] + counter_names)
+        for row in rows:
+            writer.writerow([row["stage"], row["calls"], row["failed"], round(row["total_s"], 6),
+                             round(row["mean_ms"], 3), round(row["max_ms"], 3)]
+                            + [None if row.get(name) is None else round(row[name], 3) for name in rate_names]
+                            + [row["peak_rss_mb"], row["cuda_peak_mb"]]
+                            + [row["counts"].get(name) for name in counter_names])
+
+def write_chrome_trace(records, path):
+    """เขียนบันทึกเป็น Chrome trace (Trace Event Format, เหตุการณ์แบบ "X" หน่วยเวลาเป็น microseconds)"""
+    events = [{"name": record["stage"], "cat": "evaluation", "ph": "X",
+               "ts": record["start"] * 1e6, "dur": record["duration"] * 1e6,
+               "pid": record["pid"], "tid": record["thread"], "args": record.get("counts", {})}
+              for record in records]
+    atomic_write(path, lambda f: json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f), mode='w')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Print the per-stage timing table of one or more trace files.")
+    parser.add_argument("traces", nargs="+", help=f"{TRACE_FILENAME} file(s) written by main.py --profile.")
+    parser.add_argument("--chrome-trace", default=None, help="Also write the combined records as a Chrome trace.")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    trace_records = load_trace(*args.traces)
+    print(format_timing_table(summarize(trace_records)))
+    if args.chrome_trace:
+        write_chrome_trace(trace_records, args.chrome_trace)
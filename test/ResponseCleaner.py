@@ -0,0 +1,70 @@
+# การตัดข้อความตอบกลับของโมเดล ใช้ร่วมกันระหว่างการสร้างแบบปกติและแบบ Streaming ใน LLaVADentist.py
+# แยกไว้ในไฟล์นี้ (ไม่ import torch/transformers) เพื่อให้ทดสอบได้โดยไม่ต้องโหลด Library ของโมเดล
+import re
+
+# --- การตั้งค่า ---
+EMPTY_RESPONSE_ERROR = "Error: Model returned an empty response after 'ASSISTANT:'."
+NO_PARSABLE_OUTPUT_ERROR = "Error: Model produced no parsable output."
+
+
+def parse_response(text, instruction):
+    """
+    แยกคำตอบจากข้อความที่ถอดรหัสแล้ว (เฉพาะ token ใหม่หลัง "ASSISTANT:" ของ Prompt) ตาม Logic เดิมของ generate_narrative
+    - ปกติ: คำตอบคือข้อความก่อน "ASSISTANT:" ถัดไป (clean_response) ถ้าว่างคืนค่า Error ว่าคำตอบว่าง
+    - โมเดลคัดลอก Prompt ("USER: <image>\n{instruction}") กลับมา: ใช้ข้อความหลัง "ASSISTANT:" ถ้ามี
+      ไม่เช่นนั้นลบส่วน Prompt ทิ้ง ถ้าไม่เหลือข้อความคืนค่า Error ว่าไม่มีผลลัพธ์ที่แยกได้
+    """
+    stripped = text.strip()
+    if not stripped.startswith("USER:"):
+        response = clean_response(text)
+        return response if response else EMPTY_RESPONSE_ERROR
+    if ResponseCleaner.MARKER in stripped:
+        response = clean_response(stripped.split(ResponseCleaner.MARKER, 1)[1])
+        return response if response else EMPTY_RESPONSE_ERROR
+    # <image> อาจหายไปจากข้อความเมื่อถอดรหัสแบบ skip_special_tokens
+    prompt_pattern = r"USER:\s*(?:<image>)?\s*" + re.escape(instruction.strip())
+    clean_text = re.sub(prompt_pattern, "", stripped).strip()
+    return clean_text if clean_text else NO_PARSABLE_OUTPUT_ERROR
+
+def clean_response(text):
+    """
+    ตัดข้อความตอบกลับที่ถอดรหัสแล้ว: ข้อความทั้งหมดอยู่หลัง "ASSISTANT:" ของ Prompt อยู่แล้ว
+    ถ้าโมเดลขึ้น "ASSISTANT:" ใหม่ให้ตัดทิ้งตั้งแต่ตรงนั้น แล้วตัดช่องว่างหน้า/ท้าย
+    """
+    return text.split(ResponseCleaner.MARKER)[0].strip()
+
+class ResponseCleaner:
+    """
+    ตัดข้อความตอบกลับแบบทีละส่วน (Incremental) ให้ได้ผลเดียวกับ clean_response:
+    ตัดช่องว่างหน้า/ท้าย และหยุดเมื่อโมเดลสร้าง "ASSISTANT:" ซ้ำ (ถือเป็นจุดสิ้นสุดของคำตอบ)
+    ข้อความท้ายที่อาจเป็นส่วนต้นของ "ASSISTANT:" หรือเป็นช่องว่าง จะถูกเก็บไว้จนกว่าจะแน่ใจ
+    """
+    MARKER = "ASSISTANT:"
+
+    def __init__(self):
+        self.pending = ""
+        self.text = ""
+        self.finished = False
+
+    def feed(self, text):
+        if self.finished:
+            return ""
+        self.pending += text
+        if not self.text:
+            self.pending = self.pending.lstrip()
+        index = self.pending.find(self.MARKER)
+        if index >= 0:
+            self.finished = True
+            return self._emit(len(self.pending[:index].rstrip()))
+        split = len(self.pending) - max((k for k in range(1, len(self.MARKER)) if self.pending.endswith(self.MARKER[:k])), default=0)
+        while split > 0 and self.pending[split - 1].isspace():
+            split -= 1
+        return self._emit(split)
+
+    def flush(self):
+        return "" if self.finished else self._emit(len(self.pending.rstrip()))
+
+    def _emit(self, end):
+        chunk, self.pending = self.pending[:end], ("" if self.finished else self.pending[end:])
+        self.text += chunk
+        return chunk
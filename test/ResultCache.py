@@ -0,0 +1,128 @@
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+def hash_bytes(data):
+    """คืนค่า SHA-256 (hex) ของข้อมูล bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+def hash_file(path):
+    """คืนค่า SHA-256 ของเนื้อหาไฟล์ (อ่านทีละส่วน เพื่อรองรับไฟล์ขนาดใหญ่ เช่น น้ำหนักของ Adapter)"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_path(path):
+    """
+    คืนค่า Hash ของไฟล์ หรือของทุกไฟล์ในโฟลเดอร์ (รวมชื่อไฟล์แบบ relative ด้วย)
+    ใช้กับ ADAPTER_PATH เพื่อให้ Cache หมดอายุเมื่อน้ำหนักของ Adapter เปลี่ยน
+    """
+    if not os.path.exists(path):
+        return "missing"
+    if os.path.isfile(path):
+        return hash_file(path)
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).replace("\\", "/").encode("utf-8"))
+            digest.update(hash_file(file_path).encode("ascii"))
+    return digest.hexdigest()
+
+def atomic_write(path, write, mode="wb"):
+    """
+    เขียนไฟล์แบบ atomic: write(f) เขียนลงไฟล์ชั่วคราวในโฟลเดอร์เดียวกันแล้วแทนที่ path
+    ชื่อไฟล์ชั่วคราวไม่ซ้ำกัน (mkstemp) จึงเขียน path เดียวกันพร้อมกันได้ทั้งจากหลาย Thread และหลาย process (Shard)
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f: write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def make_key(**parts):
+    """สร้าง key ของ Cache จากส่วนประกอบต่างๆ (ต้องเป็นข้อมูลที่แปลงเป็น JSON ได้)"""
+    return hash_bytes(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+
+
+class ResultCache:
+    """
+    Cache ผลลัพธ์แบบ Content-addressed สำหรับ main.py แบ่งเป็น 3 ระดับ:
+    1. narratives/  : Narrative ที่สร้างแล้ว (key = รูปภาพ, instruction, โมเดล, adapter, พารามิเตอร์การสุ่ม, seed)
+    2. heatmaps/    : Heatmap ดิบของแต่ละ keyword (key = narrative key + keyword + ตำแหน่งที่ปรากฏ + การตั้งค่า XAI)
+    3. cases/       : ผลลัพธ์ทั้งเคส (*_result.json) (key = narrative key + ไฟล์ Ground Truth + การตั้งค่าอื่นๆ)
+    การแก้ไขเฉพาะ key_keywords_expected จะทำให้ระดับ 3 หมดอายุ แต่ยังใช้ Narrative และ Heatmap เดิมได้
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        for sub_dir in ("narratives", "heatmaps", "cases"):
+            os.makedirs(os.path.join(cache_dir, sub_dir), exist_ok=True)
+
+    # --- Narrative ---
+    def get_narrative(self, key):
+        return self._read_json("narratives", key)
+
+    def put_narrative(self, key, generated_narrative, generation_info, samples=None):
+        data = {"generated_narrative": generated_narrative, "generation_info": generation_info}
+        if samples is not None:
+            data["samples"] = samples # Narrative ทั้ง K ชุดของ Self-consistency
+        self._write_json("narratives", key, data)
+
+    # --- Heatmap ---
+    def get_heatmap(self, key):
+        path = self._path("heatmaps", key, ".npy")
+        if not os.path.exists(path):
+            return None
+        try:
+            return np.load(path)
+        except (OSError, ValueError):
+            return None
+
+    def put_heatmap(self, key, heatmap):
+        path = self._path("heatmaps", key, ".npy")
+        atomic_write(path, lambda f: np.save(f, np.asarray(heatmap, dtype=np.float32)))
+
+    # --- ผลลัพธ์ทั้งเคส ---
+    def get_case(self, key):
+        """คืนค่า result_data ที่เคยบันทึกไว้ ถ้า Heatmap ดิบทุกอันที่อ้างถึงยังอยู่ใน Cache ครบ (ไม่เช่นนั้นคืน None)"""
+        result_data = self._read_json("cases", key)
+        if result_data is None:
+            return None
+        for explanation in result_data.get("xai_explanations", {}).values():
+            heatmap_key = explanation.get("heatmap_cache_key")
+            if heatmap_key is None or not os.path.exists(self._path("heatmaps", heatmap_key, ".npy")):
+                return None
+        return result_data
+
+    def put_case(self, key, result_data):
+        self._write_json("cases", key, result_data)
+
+    # --- เมธอดภายใน ---
+    def _path(self, kind, key, extension=".json"):
+        return os.path.join(self.cache_dir, kind, f"{key}{extension}")
+
+    def _read_json(self, kind, key):
+        path = self._path(kind, key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f: return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_json(self, kind, key, data):
+        path = self._path(kind, key)
+        # เขียนแบบ atomic ป้องกันไฟล์ Cache เสียถ้า process ถูกหยุดกลางคัน (หลาย Shard/Thread ใช้ Cache ร่วมกันได้)
+        atomic_write(path, lambda f: json.dump(data, f, indent=2, ensure_ascii=False), mode='w')
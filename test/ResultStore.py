@@ -0,0 +1,165 @@
+import os
+import json
+import threading
+
+# --- การตั้งค่า ---
+# คอลัมน์ที่เก็บในไฟล์ผลลัพธ์รวม (1 แถวต่อ 1 เคส)
+STORE_COLUMNS = [
+    "case_name", "image_path", "ground_truth_path", "generated_narrative", "expert_narrative",
+    "expected_keywords", "rouge1", "rouge2", "rougeL", "rougeLsum", "stop_reason", "tokens_saved",
+]
+ROUGE_COLUMNS = ["rouge1", "rouge2", "rougeL", "rougeLsum"]
+
+def to_row(result_data, expected_keywords):
+    """แปลงผลลัพธ์ของเคสหนึ่ง (รูปแบบเดียวกับ *_result.json) ให้เป็นแถวแบบแบน (flat) ตาม STORE_COLUMNS"""
+    rouge_scores = result_data.get("rouge_scores") or {}
+    generation_info = result_data.get("generation_info") or {}
+    row = {
+        "case_name": result_data["case_name"],
+        "image_path": result_data.get("image_path"),
+        "ground_truth_path": result_data.get("ground_truth_path"),
+        "generated_narrative": result_data.get("generated_narrative", ""),
+        "expert_narrative": result_data.get("expert_narrative", ""),
+        "expected_keywords": list(expected_keywords),
+        "stop_reason": generation_info.get("stop_reason"),
+        "tokens_saved": generation_info.get("tokens_saved"),
+    }
+    for column in ROUGE_COLUMNS:
+        row[column] = rouge_scores.get(column)
+    return row
+
+
+class ResultStore:
+    """
+    ไฟล์ผลลัพธ์รวมของทั้งการรัน แทนการอ่านไฟล์ *_result.json ทีละไฟล์
+    - <name>.jsonl       : แถวของผลลัพธ์ต่อท้ายไปเรื่อยๆ (Append-only, 1 บรรทัดต่อ 1 แถว)
+    - <name>.index.json  : ตำแหน่ง (byte offset, ความยาว) ของแถวล่าสุดของแต่ละเคส
+    เคสที่ถูกบันทึกซ้ำจะใช้แถวล่าสุดเสมอ และสามารถบีบอัดไฟล์ (compact) ให้เหลือเฉพาะแถวล่าสุดได้
+    index ถูกเก็บในหน่วยความจำ และเขียนลงไฟล์เมื่อเรียก flush() หรือ compact() เท่านั้น (append จึงไม่เขียน index ใหม่ทุกครั้ง)
+    ถ้า process หยุดก่อน flush ไฟล์ index จะมีขนาดข้อมูลไม่ตรง และถูกสร้างใหม่จากไฟล์ข้อมูลในการเปิดครั้งถัดไป
+    """
+    def __init__(self, directory, name="results_store"):
+        self.data_path = os.path.join(directory, f"{name}.jsonl")
+        self.index_path = os.path.join(directory, f"{name}.index.json")
+        self._lock = threading.Lock() # append จาก Writer หลาย Thread พร้อมกันได้
+        self._index = None
+
+    def exists(self):
+        return os.path.exists(self.data_path)
+
+    def append(self, result_data, expected_keywords=()):
+        """เพิ่ม (หรือแทนที่) แถวของเคสหนึ่งเคส"""
+        return self.append_row(to_row(result_data, expected_keywords))
+
+    def append_row(self, row):
+        """เพิ่ม (หรือแทนที่) แถวที่อยู่ในรูปแบบ STORE_COLUMNS แล้ว (เช่น แถวจาก ResultStore ของ Shard อื่น)"""
+        line = (json.dumps(row, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            index = self._current_index()
+            os.makedirs(os.path.dirname(self.data_path) or ".", exist_ok=True)
+            with open(self.data_path, "ab+") as f:
+                offset = f.seek(0, os.SEEK_END)
+                if offset > 0:
+                    f.seek(offset - 1)
+                    if f.read(1) != b"\n": # บรรทัดสุดท้ายเขียนไม่สมบูรณ์ ขึ้นบรรทัดใหม่ก่อน
+                        f.write(b"\n"); offset += 1
+                f.write(line)
+            index["rows"][row["case_name"]] = [offset, len(line)]
+            index["size"] = offset + len(line)
+            index["dirty"] = True
+        return row
+
+    def flush(self):
+        """บันทึก index ในหน่วยความจำลงไฟล์ (ถ้ามีการเปลี่ยนแปลง)"""
+        with self._lock:
+            if self._index is not None and self._index.pop("dirty", False):
+                self._save_index(self._index)
+
+    def get(self, case_name):
+        """คืนค่าแถวล่าสุดของเคส หรือ None ถ้ายังไม่มี"""
+        if not self.exists():
+            return None
+        with self._lock: location = self._current_index()["rows"].get(case_name)
+        if location is None:
+            return None
+        with open(self.data_path, "rb") as f:
+            f.seek(location[0])
+            return json.loads(f.read(location[1]))
+
+    def rows(self):
+        """คืนค่าแถวล่าสุดของทุกเคส เรียงตามชื่อเคส"""
+        if not self.exists():
+            return []
+        with self._lock:
+            index = self._current_index()
+            with open(self.data_path, "rb") as f: data = f.read(index["size"])
+        return [json.loads(data[offset:offset + length]) for offset, length in
+                (index["rows"][case_name] for case_name in sorted(index["rows"]))]
+
+    def collect_columns(self, columns=None):
+        """
+        รวบรวมค่าของคอลัมน์ที่ต้องการจากแถวล่าสุดของทุกเคส (อ่านไฟล์ครั้งเดียวด้วย rows())
+        ทุกแถวยังถูก parse ทั้งแถว การเลือกคอลัมน์จึงลดเพียงข้อมูลที่คืนค่า ไม่ลดการอ่านไฟล์
+        คืนค่าเป็น dict {ชื่อคอลัมน์: ลิสต์ของค่า} เรียงตามชื่อเคส
+        """
+        columns = list(columns or STORE_COLUMNS)
+        result = {column: [] for column in columns}
+        for row in self.rows():
+            for column in columns:
+                result[column].append(row.get(column))
+        return result
+
+    def compact(self):
+        """เขียนไฟล์ใหม่ให้เหลือเฉพาะแถวล่าสุดของแต่ละเคส (ลดขนาดไฟล์หลังการรันหลายครั้ง)"""
+        if not self.exists():
+            return
+        with self._lock:
+            index = self._current_index()
+            with open(self.data_path, "rb") as f: data = f.read()
+            new_rows, chunks, offset = {}, [], 0
+            for case_name in sorted(index["rows"]):
+                start, length = index["rows"][case_name]
+                chunks.append(data[start:start + length])
+                new_rows[case_name] = [offset, length]
+                offset += length
+            tmp_path = self.data_path + ".tmp"
+            with open(tmp_path, "wb") as f: f.write(b"".join(chunks))
+            os.replace(tmp_path, self.data_path)
+            self._index = {"size": offset, "rows": new_rows}
+            self._save_index(self._index)
+
+    def _current_index(self):
+        # ใช้ index ในหน่วยความจำ ถ้าขนาดไฟล์ข้อมูลยังตรงกัน (ไม่เช่นนั้นไฟล์ถูกแก้ไขจากภายนอก จึงโหลดใหม่)
+        size = os.path.getsize(self.data_path) if self.exists() else 0
+        if self._index is None or self._index["size"] != size:
+            self._index = self._load_index()
+        return self._index
+
+    def _load_index(self):
+        # ใช้ไฟล์ index ถ้าขนาดไฟล์ข้อมูลตรงกับที่บันทึกไว้ ไม่เช่นนั้นสร้าง index ใหม่จากไฟล์ข้อมูล
+        size = os.path.getsize(self.data_path) if self.exists() else 0
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f: index = json.load(f)
+                if index.get("size") == size:
+                    return index
+            except (OSError, ValueError):
+                pass
+        return self._rebuild_index(size)
+
+    def _rebuild_index(self, size):
+        rows, offset = {}, 0
+        if self.exists():
+            with open(self.data_path, "rb") as f:
+                for line in f:
+                    try:
+                        rows[json.loads(line)["case_name"]] = [offset, len(line)]
+                    except (ValueError, KeyError):
+                        pass # ข้ามบรรทัดที่เขียนไม่สมบูรณ์ (เช่น process ถูกหยุดกลางคัน)
+                    offset += len(line)
+        return {"size": size, "rows": rows, "dirty": True} # บันทึก index ที่สร้างใหม่ใน flush() ครั้งถัดไป
+
+    def _save_index(self, index):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f: json.dump({"size": index["size"], "rows": index["rows"]}, f)
+        os.replace(tmp_path, self.index_path)
@@ -0,0 +1,173 @@
+import re
+from collections import Counter
+from functools import lru_cache
+
+# --- การตั้งค่า ---
+# ชนิดของ ROUGE ที่คำนวณโดยค่าเริ่มต้น (เหมือนกับ evaluate.load('rouge'))
+DEFAULT_ROUGE_TYPES = ("rouge1", "rouge2", "rougeL", "rougeLsum")
+
+_NON_ALPHANUMERIC = re.compile(r"[^a-z0-9]+")
+
+
+@lru_cache(maxsize=4096)
+def tokenize(text):
+    """
+    ตัดคำแบบเดียวกับ rouge_score (ไม่ใช้ Stemmer): แปลงเป็นตัวพิมพ์เล็ก
+    และแทนที่ทุกตัวอักษรที่ไม่ใช่ a-z/0-9 ด้วยช่องว่าง
+    """
+    return tuple(_NON_ALPHANUMERIC.sub(" ", text.lower()).split())
+
+@lru_cache(maxsize=8192)
+def ngram_counts(tokens, n):
+    """เวกเตอร์นับจำนวน n-gram (Counter) ของลำดับคำ (จำผลไว้ เพราะ reference มักถูกใช้ซ้ำหลายครั้งใน Batch)"""
+    return Counter(zip(*(tokens[i:] for i in range(n))))
+
+@lru_cache(maxsize=4096)
+def _match_masks(tokens):
+    # bit-mask ของตำแหน่งที่แต่ละคำปรากฏใน tokens (ใช้กับ lcs_length)
+    masks = {}
+    for i, token in enumerate(tokens):
+        masks[token] = masks.get(token, 0) | (1 << i)
+    return masks
+
+def lcs_length(a, b):
+    """
+    ความยาวของ Longest Common Subsequence แบบ Bit-parallel (Allison-Dix / Hyyrö)
+    ใช้ Python int เป็น bit-vector จึงทำงานในเวลา O(len(b) * len(a) / wordsize) โดยไม่ต้องสร้างตาราง DP
+    """
+    if not a or not b:
+        return 0
+    match_masks = _match_masks(tuple(a))
+    all_ones = (1 << len(a)) - 1
+    v = all_ones
+    for token in b:
+        u = v & match_masks.get(token, 0)
+        v = ((v + u) | (v - u)) & all_ones
+    return len(a) - bin(v).count("1")
+
+def _lcs_indices(ref, can):
+    """ตำแหน่ง (ใน ref) ของ LCS ระหว่าง ref และ can ด้วยตาราง DP และ backtrack แบบเดียวกับ rouge_score"""
+    rows, cols = len(ref), len(can)
+    table = [[0] * (cols + 1) for _ in range(rows + 1)]
+    for i in range(1, rows + 1):
+        row, prev_row, ref_token = table[i], table[i - 1], ref[i - 1]
+        for j in range(1, cols + 1):
+            row[j] = prev_row[j - 1] + 1 if ref_token == can[j - 1] else max(prev_row[j], row[j - 1])
+    i, j, indices = rows, cols, []
+    while i > 0 and j > 0:
+        if ref[i - 1] == can[j - 1]:
+            indices.append(i - 1); i -= 1; j -= 1
+        elif table[i][j - 1] > table[i - 1][j]:
+            j -= 1
+        else:
+            i -= 1
+    return indices
+
+def _ngram_overlap(prediction_counts, reference_counts):
+    # จำนวน n-gram ที่ตรงกัน (ผลรวมของค่าต่ำสุดของแต่ละ n-gram) โดยวนลูปฝั่งที่มีขนาดเล็กกว่า
+    if len(prediction_counts) > len(reference_counts):
+        prediction_counts, reference_counts = reference_counts, prediction_counts
+    return sum(min(count, reference_counts[gram]) for gram, count in prediction_counts.items() if gram in reference_counts)
+
+def _fmeasure(overlap, prediction_total, reference_total):
+    precision = overlap / prediction_total if prediction_total > 0 else 0.0
+    recall = overlap / reference_total if reference_total > 0 else 0.0
+    return 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+
+class RougeScorer:
+    """
+    ตัวคำนวณ ROUGE-1/2/L/Lsum ภายในเครื่อง ไม่ต้องพึ่งพา Library ภายนอกหรือการเชื่อมต่อเครือข่าย
+    ให้ค่า F1 เท่ากับ evaluate.load('rouge') (rouge_score, ไม่ใช้ Stemmer) และรองรับการคำนวณเป็น Batch
+    """
+    def __init__(self, rouge_types=DEFAULT_ROUGE_TYPES):
+        for rouge_type in rouge_types:
+            if rouge_type not in ("rougeL", "rougeLsum") and not re.fullmatch(r"rouge[1-9]", rouge_type):
+                raise ValueError(f"Unsupported ROUGE type: '{rouge_type}'")
+        self.rouge_types = tuple(rouge_types)
+
+    def score(self, prediction, reference):
+        """คำนวณ ROUGE F1 ของคู่ prediction/reference หนึ่งคู่ (reference เป็นลิสต์ได้ จะใช้ค่าที่ดีที่สุด)"""
+        if not isinstance(reference, str):
+            candidates = [self.score(prediction, ref) for ref in reference]
+            return {rouge_type: max(c[rouge_type] for c in candidates) for rouge_type in self.rouge_types}
+        prediction_tokens, reference_tokens = tokenize(prediction), tokenize(reference)
+        scores = {}
+        for rouge_type in self.rouge_types:
+            if rouge_type == "rougeL":
+                scores[rouge_type] = _fmeasure(lcs_length(reference_tokens, prediction_tokens),
+                                               len(prediction_tokens), len(reference_tokens))
+            elif rouge_type == "rougeLsum":
+                if "\n" not in prediction and "\n" not in reference and "rougeL" in scores:
+                    # ข้อความบรรทัดเดียว ROUGE-Lsum เท่ากับ ROUGE-L จึงใช้ค่าที่คำนวณแล้ว
+                    scores[rouge_type] = scores["rougeL"]
+                else:
+                    scores[rouge_type] = self._summary_level_lcs(prediction, reference)
+            else:
+                n = int(rouge_type[5:])
+                prediction_counts = ngram_counts(prediction_tokens, n)
+                reference_counts = ngram_counts(reference_tokens, n)
+                overlap = _ngram_overlap(prediction_counts, reference_counts)
+                scores[rouge_type] = _fmeasure(overlap, max(len(prediction_tokens) - n + 1, 0),
+                                               max(len(reference_tokens) - n + 1, 0))
+        return scores
+
+    def score_batch(self, predictions, references):
+        """คำนวณ ROUGE F1 ของทุกคู่ในครั้งเดียว คืนค่าเป็นลิสต์ของ dict (1 dict ต่อ 1 คู่)"""
+        if len(predictions) != len(references):
+            raise ValueError("predictions and references must have the same length.")
+        return [self.score(prediction, reference) for prediction, reference in zip(predictions, references)]
+
+    def consensus_index(self, predictions, rouge_type="rougeL"):
+        """
+        ลำดับของ prediction ที่ใกล้เคียงกับ prediction อื่นมากที่สุด (Medoid: ค่าเฉลี่ย ROUGE F1 เทียบกับตัวอื่นสูงสุด)
+        ไม่ใช้ reference จึงเลือกได้โดยไม่ทำให้คะแนนที่วัดกับ reference สูงเกินจริง
+        ROUGE F1 สมมาตร จึงคำนวณเฉพาะคู่ i < j (K * (K - 1) / 2 คู่)
+        """
+        if len(predictions) < 2:
+            return 0
+        pairs = [(i, j) for i in range(len(predictions)) for j in range(i + 1, len(predictions))]
+        pair_scores = self.score_batch([predictions[i] for i, _ in pairs], [predictions[j] for _, j in pairs])
+        totals = [0.0] * len(predictions)
+        for (i, j), scores in zip(pairs, pair_scores):
+            totals[i] += scores[rouge_type]
+            totals[j] += scores[rouge_type]
+        return max(range(len(predictions)), key=lambda i: totals[i])
+
+    def compute(self, predictions, references, use_aggregator=True):
+        """
+        Interface เดียวกับ evaluate.load('rouge').compute
+        use_aggregator=True จะคืนค่าเฉลี่ยของแต่ละชนิด ROUGE, False จะคืนค่าเป็นลิสต์ต่อคู่
+        """
+        batch_scores = self.score_batch(predictions, references)
+        if not use_aggregator:
+            return {rouge_type: [s[rouge_type] for s in batch_scores] for rouge_type in self.rouge_types}
+        if not batch_scores:
+            return {rouge_type: 0.0 for rouge_type in self.rouge_types}
+        return {rouge_type: sum(s[rouge_type] for s in batch_scores) / len(batch_scores) for rouge_type in self.rouge_types}
+
+    def _summary_level_lcs(self, prediction, reference):
+        # ROUGE-Lsum: แยกประโยคด้วยการขึ้นบรรทัดใหม่ แล้วคำนวณ Union LCS ระดับสรุป (แบบเดียวกับ rouge_score)
+        reference_sents = [tokenize(s) for s in reference.split("\n") if s]
+        prediction_sents = [tokenize(s) for s in prediction.split("\n") if s]
+        reference_total = sum(len(s) for s in reference_sents)
+        prediction_total = sum(len(s) for s in prediction_sents)
+        if not reference_total or not prediction_total:
+            return 0.0
+        if len(reference_sents) == 1 and len(prediction_sents) == 1:
+            # กรณีประโยคเดียว Union LCS เท่ากับ LCS ปกติ จึงใช้วิธี Bit-parallel ที่เร็วกว่า
+            hits = lcs_length(reference_sents[0], prediction_sents[0])
+            return _fmeasure(hits, prediction_total, reference_total)
+
+        reference_counts = Counter(t for s in reference_sents for t in s)
+        prediction_counts = Counter(t for s in prediction_sents for t in s)
+        hits = 0
+        for reference_sent in reference_sents:
+            union_indices = set()
+            for prediction_sent in prediction_sents:
+                union_indices.update(_lcs_indices(reference_sent, prediction_sent))
+            for token in (reference_sent[i] for i in sorted(union_indices)):
+                if prediction_counts[token] > 0 and reference_counts[token] > 0:
+                    hits += 1
+                    prediction_counts[token] -= 1
+                    reference_counts[token] -= 1
+        return _fmeasure(hits, prediction_total, reference_total)
@@ -0,0 +1,124 @@
+import os
+import json
+import glob
+import shutil
+import hashlib
+
+from HeatmapStore import HeatmapStore
+from ResultStore import ResultStore
+
+# --- การตั้งค่า ---
+# โฟลเดอร์ย่อยใน OUTPUT_DIR ที่เก็บผลลัพธ์ของแต่ละ Shard และชื่อไฟล์ที่บอกว่า Shard ทำงานจบครบทุกเคสแล้ว
+SHARDS_DIR_NAME = "shards"
+SHARD_COMPLETE_FILENAME = "shard_complete.json"
+
+
+def parse_shard(text):
+    """แปลงข้อความ "i/N" (i เริ่มจาก 0) เป็น tuple (i, N)"""
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard must be given as 'i/N' (e.g. '0/4'), got '{text}'")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index must satisfy 0 <= i < N, got '{text}'")
+    return index, count
+
+def shard_of(gt_path, count):
+    """
+    Shard ของไฟล์ Ground Truth กำหนดจาก Hash ของชื่อไฟล์ (ไม่ขึ้นกับลำดับไฟล์หรือเครื่องที่รัน)
+    เคสเดิมจึงอยู่ใน Shard เดิมเสมอแม้จะมีการเพิ่มหรือลบเคสอื่น
+    """
+    digest = hashlib.sha256(os.path.basename(gt_path).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+def select_shard(ground_truth_files, index, count):
+    """คืนค่าเฉพาะไฟล์ Ground Truth ของ Shard ที่ index (เรียงตามชื่อไฟล์)"""
+    return sorted(path for path in ground_truth_files if shard_of(path, count) == index)
+
+def shard_dir(output_dir, index, count):
+    return os.path.join(output_dir, SHARDS_DIR_NAME, f"{index}-of-{count}")
+
+def mark_shard_complete(directory, num_cases, settings=None):
+    """
+    บันทึกว่า Shard ทำงานจบครบทุกเคสแล้ว (Shard ที่ไม่มีไฟล์นี้คือ Shard ที่ยังไม่จบหรือหยุดกลางคัน)
+    settings: การตั้งค่าของการรัน (dict ที่แปลงเป็น JSON ได้) ใช้ตรวจใน is_shard_complete
+    """
+    path = os.path.join(directory, SHARD_COMPLETE_FILENAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump({"num_cases": num_cases, "settings": settings}, f)
+    os.replace(tmp_path, path)
+
+def clear_shard_complete(directory):
+    """ลบสถานะ "จบแล้ว" ก่อนเริ่มรัน Shard ใหม่ (ถ้า Shard หยุดกลางคัน จะไม่ถูกนับว่าจบ)"""
+    path = os.path.join(directory, SHARD_COMPLETE_FILENAME)
+    if os.path.exists(path):
+        os.remove(path)
+
+def is_shard_complete(directory, settings=None):
+    """Shard จบแล้วหรือไม่ ถ้ากำหนด settings จะนับว่าจบเฉพาะเมื่อจบด้วยการตั้งค่าเดียวกัน"""
+    path = os.path.join(directory, SHARD_COMPLETE_FILENAME)
+    if not os.path.exists(path):
+        return False
+    if settings is None:
+        return True
+    try:
+        with open(path, 'r', encoding='utf-8') as f: return json.load(f).get("settings") == settings
+    except (OSError, ValueError):
+        return False
+
+def merge_shards(output_dir, count=None):
+    """
+    รวมผลลัพธ์ results_json ของทุก Shard ใน <output_dir>/shards/ เข้าสู่ <output_dir>/results_json
+    - คัดลอกไฟล์ *_result.json ที่ใหม่หรือเปลี่ยนไป และเพิ่มแถวที่ใหม่หรือเปลี่ยนไปลง ResultStore และ HeatmapStore หลัก
+    - เรียกซ้ำกี่ครั้งก็ได้ผลเท่าเดิม (Idempotent) และรวมเฉพาะเคสที่ทำเสร็จแล้วของ Shard ที่หยุดกลางคัน
+      เมื่อรัน Shard นั้นต่อจนจบ (เคสที่เสร็จแล้วจะถูกใช้จาก Cache) แล้วเรียก merge อีกครั้ง ผลลัพธ์จะครบ
+    count=N จะรวมเฉพาะ Shard ของการแบ่ง N ส่วน (ไม่รวมโฟลเดอร์ของการแบ่งจำนวนอื่นที่ค้างอยู่จากการรันก่อนหน้า)
+    คืนค่า dict สรุปจำนวนเคสที่รวม และรายชื่อ Shard ที่ยังไม่จบ
+    """
+    results_json_dir = os.path.join(output_dir, "results_json")
+    os.makedirs(results_json_dir, exist_ok=True)
+    result_store = ResultStore(results_json_dir)
+    heatmap_store = HeatmapStore(results_json_dir)
+    summary = {"shards": 0, "cases": 0, "updated": 0, "incomplete_shards": []}
+    pattern = f"*-of-{count}" if count else "*"
+    for directory in sorted(glob.glob(os.path.join(output_dir, SHARDS_DIR_NAME, pattern))):
+        shard_results_dir = os.path.join(directory, "results_json")
+        if not os.path.isdir(shard_results_dir):
+            continue
+        summary["shards"] += 1
+        if not is_shard_complete(directory):
+            summary["incomplete_shards"].append(os.path.basename(directory))
+        shard_rows = ResultStore(shard_results_dir).rows()
+        for row in shard_rows:
+            summary["cases"] += 1
+            result_filename = f"{row['case_name']}_result.json"
+            source_path = os.path.join(shard_results_dir, result_filename)
+            target_path = os.path.join(results_json_dir, result_filename)
+            if os.path.exists(source_path) and not _same_content(source_path, target_path):
+                shutil.copyfile(source_path, target_path + ".tmp")
+                os.replace(target_path + ".tmp", target_path)
+            if result_store.get(row["case_name"]) != row:
+                result_store.append_row(row)
+                summary["updated"] += 1
+        # แทนที่ Heatmap ของทุกเคสของ Shard นี้ (เขียนเฉพาะแถวที่เปลี่ยน และลบ keyword ที่ไม่อยู่ใน Shard แล้ว)
+        shard_heatmaps = HeatmapStore(shard_results_dir)
+        shard_maps = shard_heatmaps.as_array()
+        case_heatmaps = {row["case_name"]: {} for row in shard_rows}
+        for (case_name, keyword), row in shard_heatmaps.rows().items():
+            case_heatmaps.setdefault(case_name, {})[keyword] = shard_maps[row]
+        for case_name, heatmaps in case_heatmaps.items():
+            heatmap_store.put_case(case_name, heatmaps)
+    heatmap_store.compact()
+    result_store.compact()
+    print(f"Merged {summary['cases']} case(s) from {summary['shards']} shard(s) "
+          f"({summary['updated']} new or changed).")
+    if summary["incomplete_shards"]:
+        print(f"Warning: Shard(s) {summary['incomplete_shards']} did not finish. "
+              "Re-run them and merge again to complete the results.")
+    return summary
+
+def _same_content(path_a, path_b):
+    if not os.path.exists(path_b) or os.path.getsize(path_a) != os.path.getsize(path_b):
+        return False
+    with open(path_a, "rb") as a, open(path_b, "rb") as b:
+        return a.read() == b.read()
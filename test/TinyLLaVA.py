@@ -0,0 +1,130 @@
+import os
+import re
+
+import torch
+from peft import LoraConfig, get_peft_model
+from tokenizers import Regex, Tokenizer, decoders, models, pre_tokenizers, processors
+from transformers import (
+    CLIPImageProcessor,
+    CLIPVisionConfig,
+    LlamaConfig,
+    LlavaConfig,
+    LlavaForConditionalGeneration,
+    LlavaProcessor,
+    PreTrainedTokenizerFast,
+)
+
+from KeywordIndex import load_vocabulary
+from LLaVADentist import LLaVADentist
+
+# --- การตั้งค่า ---
+# โมเดล LLaVA ขนาดเล็กที่สุ่มน้ำหนัก สำหรับทดสอบ Server, Pipeline และ Benchmark บน CPU (ไม่ต้องดาวน์โหลดโมเดลจริง)
+# โครงสร้างเหมือน LLaVA-1.5 ทุกอย่าง (CLIP Vision Tower + Projector + Llama) แต่มีขนาดเล็กมาก
+TINY_IMAGE_SIZE = 32
+TINY_PATCH_SIZE = 8 # 32/8 = ตาราง Patch 4x4
+SPECIAL_TOKENS = ["<unk>", "<pad>", "<s>", "</s>", "<image>"]
+# ข้อความตัวอย่างที่ใช้สร้างคำศัพท์ของ Tokenizer (คำที่ไม่อยู่ในนี้จะกลายเป็น <unk>)
+BASE_CORPUS = [
+    "USER: <image>\nASSISTANT:",
+    "You are an expert specializing in dentistry. Describe the condition of the anterior teeth in this dentistry "
+    "with clinical accuracy, mentioning any anatomy, pathology, or restorations.",
+    "The image shows the upper and lower anterior teeth with a healthy gingiva and no visible caries, "
+    "a fractured crown on the left side, and a composite restoration near the midline.",
+]
+# LoRA เฉพาะ Attention ของ Language Model (เหมือน Adapter จริงที่ fine-tune ไว้)
+TINY_LORA_TARGET_MODULES = r".*language_model.*\.(q_proj|v_proj)"
+# แบ่งคำพร้อมช่องว่างนำหน้า (เช่น " teeth", "\nASSISTANT", ":") ทำให้ถอดรหัสกลับเป็นข้อความเดิมได้ด้วยการต่อ token
+_PRE_TOKENIZE_PATTERN = r"\s?[A-Za-z0-9]+|\s?[^\sA-Za-z0-9]|\s+"
+
+
+def build_tiny_tokenizer(corpus=()):
+    """Tokenizer แบบ Word-level ที่สร้างจากข้อความตัวอย่าง คำศัพท์ทางคลินิก และ corpus ที่กำหนดเพิ่ม"""
+    texts = list(BASE_CORPUS) + list(corpus)
+    for keyword, aliases in load_vocabulary().items():
+        texts.extend([keyword] + aliases)
+    words = set()
+    for text in texts:
+        for piece in re.findall(_PRE_TOKENIZE_PATTERN, text.replace("<image>", " ")):
+            word = piece.strip() or piece
+            words.update({piece, word, " " + word, "\n" + word})
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS)}
+    for word in sorted(words):
+        vocab.setdefault(word, len(vocab))
+
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split(Regex(_PRE_TOKENIZE_PATTERN), behavior="isolated")
+    tokenizer.decoder = decoders.Fuse()
+    tokenizer.post_processor = processors.TemplateProcessing(single="<s> $A", special_tokens=[("<s>", vocab["<s>"])])
+    tokenizer.add_special_tokens(SPECIAL_TOKENS)
+    # ไม่สร้าง token_type_ids (LlavaForConditionalGeneration.forward ไม่รับ argument นี้)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="<unk>", pad_token="<pad>",
+                                   bos_token="<s>", eos_token="</s>", model_input_names=["input_ids", "attention_mask"])
+
+def build_tiny_processor(tokenizer, image_size=TINY_IMAGE_SIZE, patch_size=TINY_PATCH_SIZE):
+    image_processor = CLIPImageProcessor(size={"shortest_edge": image_size},
+                                         crop_size={"height": image_size, "width": image_size})
+    try:
+        return LlavaProcessor(image_processor=image_processor, tokenizer=tokenizer, patch_size=patch_size,
+                              vision_feature_select_strategy="default")
+    except TypeError: # transformers รุ่นเก่าไม่มี patch_size (LLaVADentist ขยาย <image> เองอยู่แล้ว)
+        return LlavaProcessor(image_processor=image_processor, tokenizer=tokenizer)
+
+def build_tiny_model(tokenizer, image_size=TINY_IMAGE_SIZE, patch_size=TINY_PATCH_SIZE, hidden_size=64,
+                     vision_layers=3, text_layers=2, vision_feature_layer=-2, seed=0):
+    """LlavaForConditionalGeneration ที่สุ่มน้ำหนัก (ขนาดไม่กี่ MB)"""
+    vision_config = CLIPVisionConfig(
+        hidden_size=hidden_size, intermediate_size=hidden_size * 2, num_hidden_layers=vision_layers,
+        num_attention_heads=4, image_size=image_size, patch_size=patch_size, projection_dim=hidden_size,
+    )
+    text_config = LlamaConfig(
+        vocab_size=len(tokenizer), hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+        num_hidden_layers=text_layers, num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=1024,
+        pad_token_id=tokenizer.pad_token_id, bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+    )
+    config = LlavaConfig(
+        vision_config=vision_config, text_config=text_config,
+        image_token_index=tokenizer.convert_tokens_to_ids("<image>"), image_seq_length=(image_size // patch_size) ** 2,
+        vision_feature_layer=vision_feature_layer, vision_feature_select_strategy="default",
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    torch.manual_seed(seed)
+    return LlavaForConditionalGeneration(config)
+
+def add_tiny_lora(model, rank=4, seed=0):
+    """
+    หุ้มโมเดลด้วย LoRA Adapter แบบสุ่มน้ำหนัก (ไม่ใช่ค่าเริ่มต้นที่เป็นศูนย์ จึงมีผลต่อผลลัพธ์จริง)
+    ชื่อโมดูลจะขึ้นต้นด้วย base_model.model. เหมือนโมเดลที่โหลดด้วย PeftModel.from_pretrained
+    """
+    torch.manual_seed(seed)
+    config = LoraConfig(r=rank, lora_alpha=rank * 2, target_modules=TINY_LORA_TARGET_MODULES, lora_dropout=0.0,
+                        init_lora_weights=False)
+    return get_peft_model(model, config)
+
+def save_tiny_llava(directory, corpus=(), seed=0, lora_rank=4, **model_kwargs):
+    """
+    บันทึกโมเดลขนาดเล็กพร้อม Processor (directory/base) และ LoRA Adapter (directory/adapter) ลงดิสก์
+    ใช้ทดสอบการโหลดโมเดลจริงของ LLaVADentist (เช่น materialize) คืนค่า (base_model_path, adapter_path)
+    """
+    tokenizer = build_tiny_tokenizer(corpus)
+    processor = build_tiny_processor(tokenizer, model_kwargs.get("image_size", TINY_IMAGE_SIZE),
+                                     model_kwargs.get("patch_size", TINY_PATCH_SIZE))
+    model = build_tiny_model(tokenizer, seed=seed, **model_kwargs)
+    base_model_path, adapter_path = os.path.join(directory, "base"), os.path.join(directory, "adapter")
+    model.save_pretrained(base_model_path, safe_serialization=True)
+    processor.save_pretrained(base_model_path)
+    add_tiny_lora(model, lora_rank, seed=seed).save_pretrained(adapter_path)
+    return base_model_path, adapter_path
+
+def create_tiny_llava(xai_gradient_mode="activation", image_cache_dir=None, corpus=(), seed=0, lora_rank=None, **model_kwargs):
+    """
+    LLaVADentist ที่ใช้โมเดล LLaVA ขนาดเล็กแบบสุ่มน้ำหนักบน CPU (ผลลัพธ์ไม่มีความหมายทางคลินิก ใช้ทดสอบระบบเท่านั้น)
+    lora_rank จะหุ้มโมเดลด้วย LoRA Adapter ขนาด rank นั้น (None = ไม่มี Adapter)
+    """
+    tokenizer = build_tiny_tokenizer(corpus)
+    processor = build_tiny_processor(tokenizer, model_kwargs.get("image_size", TINY_IMAGE_SIZE),
+                                     model_kwargs.get("patch_size", TINY_PATCH_SIZE))
+    model = build_tiny_model(tokenizer, seed=seed, **model_kwargs)
+    if lora_rank:
+        model = add_tiny_lora(model, lora_rank, seed=seed)
+    return LLaVADentist.from_components(model, processor, xai_gradient_mode=xai_gradient_mode,
+                                        image_cache_dir=image_cache_dir, name=f"tiny-llava-{seed}")
@@ -1,120 +1,571 @@
 import os
 import json
+import argparse
 import glob
-import cv2
-import evaluate
+import time
+import threading
 
-from LLaVADentist import LLaVADentist
-from CreateSummaryHeatMap import CreateHeatMap
-from CreateRougeScore import CreateRougeMatrix
+# โมดูลของโมเดล (torch, transformers, peft, cv2) และการวาดกราฟ (pandas, seaborn, matplotlib) ถูก import เมื่อใช้งานจริงเท่านั้น
+# เพื่อให้การรันที่ทุกเคสอยู่ใน Cache, การรวมผลของ Shard และการสร้างกราฟ เริ่มทำงานได้ทันที
+from ModelConfig import GENERATION_CONFIG, XAI_TARGET_LAYERS
+from RougeScorer import RougeScorer
+from ResultStore import ResultStore
+from HeatmapStore import HeatmapStore, heatmap_key, overlay_filename
+from Pipeline import EvaluationPipeline
+from KeywordIndex import DEFAULT_VOCABULARY_PATH, load_keyword_index
+from Sharding import (SHARDS_DIR_NAME, clear_shard_complete, merge_shards, mark_shard_complete, parse_shard,
+                      select_shard, shard_dir)
+from ResultCache import ResultCache, hash_bytes, hash_file, hash_path, make_key
+from Profiler import (CHROME_TRACE_FILENAME, TRACE_FILENAME, enable_profiling, format_timing_table, load_trace,
+                      profile, summarize as summarize_trace, write_timing_table)
 
 # --- การตั้งค่า ---
 BASE_MODEL_PATH = "llava-1.5-7b-hf-bnb-4bit"
 ADAPTER_PATH = "adapter"
+# "activation" = คำนวณ Gradient เฉพาะที่ Layer เป้าหมาย (ประหยัดหน่วยความจำ), "full" = backward ทั้งโมเดลแบบเดิม
+XAI_GRADIENT_MODE = "activation"
+# เป้าหมายของ Grad-CAM: ผลรวม log-probability ของทุก sub-token ของ keyword ในทุกตำแหน่งที่ปรากฏใน Narrative
+# (keyword ที่ไม่ปรากฏใช้ตำแหน่งสำรอง "continuation" ต่อจากการปรากฏครั้งสุดท้ายของ keyword อื่น)
+# ค่านี้เป็นส่วนหนึ่งของ key ของ Heatmap Cache
+XAI_ATTRIBUTION = "keyword_logprob_after_last_mention"
 
 EVAL_DATA_DIR = "evaluation_dataset/anterior_teeth/"
 OUTPUT_DIR = "evaluation_results/"
+# โฟลเดอร์ Cache บนดิสก์ของรูปภาพที่ถอดรหัสแล้ว, pixel_values และ Image Embeddings (None = ใช้เฉพาะในหน่วยความจำ)
+IMAGE_CACHE_DIR = os.path.join(OUTPUT_DIR, "image_cache")
+# จำนวนเคสที่สร้าง Narrative พร้อมกันใน 1 ครั้งของ generate (1 = ทีละเคสแบบเดิม)
+NARRATIVE_BATCH_SIZE = 4
+# จำนวน Thread ของขั้นตอน Prefetch (อ่านไฟล์/ถอดรหัสรูปภาพ) และ Writer (ซ้อน Heatmap/เขียนไฟล์) ของ Pipeline
+# และขนาดของคิวระหว่างขั้นตอน (จำนวนเคสที่อ่านล่วงหน้า / รอเขียนได้สูงสุด)
+PREFETCH_WORKERS = 2
+WRITER_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 8
+# True = พิมพ์ผลลัพธ์ดิบของโมเดล (รวม special tokens) ของทุกเคสเพื่อดีบัก
+DEBUG_MODEL_OUTPUT = False
+# หยุดการสร้างข้อความก่อนกำหนดเมื่อโมเดลวนซ้ำ (n-gram ขนาด ngram_size ซ้ำครบ max_repeats ครั้งใน window token ล่าสุด)
+STOP_ON_REPETITION = True
+REPETITION_STOP_CONFIG = {"repetition_ngram_size": 8, "repetition_max_repeats": 3, "repetition_window": 128}
+# โฟลเดอร์ Cache ของผลลัพธ์ (Narrative, Heatmap และผลลัพธ์ทั้งเคส) เพื่อประมวลผลใหม่เฉพาะเคสที่เปลี่ยนไป
+RESULT_CACHE_DIR = os.path.join(OUTPUT_DIR, "result_cache")
+# Random Seed สำหรับการสุ่มตอนสร้าง Narrative (เป็นส่วนหนึ่งของ key ใน Cache)
+SEED = 42
+# Self-consistency: สุ่ม Narrative K ชุดต่อรูปภาพในการเรียก generate ครั้งเดียว (1 = ชุดเดียวแบบเดิม)
+# เมื่อ K > 1 rouge_scores ของผลลัพธ์เป็นค่าเฉลี่ยของทั้ง K ชุด (นิ่งกว่าการสุ่มครั้งเดียว) และ rouge_sample_stats เก็บการกระจาย
+NUM_SAMPLES = 1
+# วิธีเลือก Narrative 1 ชุดจาก K ชุดเพื่อสร้าง Heatmap
+# - "consensus": ชุดที่ใกล้เคียงชุดอื่นมากที่สุด (ROUGE-L ระหว่างกันเอง ไม่ใช้ Ground Truth)
+# - "best":      ชุดที่ ROUGE-L เทียบกับ expert_narrative สูงสุด (Best-of-K ใช้ Ground Truth จึงเป็นค่าขอบบนเท่านั้น)
+SAMPLE_SELECTION = "consensus"
+SAMPLE_SELECTIONS = ("consensus", "best")
+# ไฟล์คำศัพท์ทางคลินิก (keyword ที่สนใจสร้าง Heatmap และคำพ้อง) ใช้ร่วมกับ CreateSummaryHeatMap.py
+VOCABULARY_PATH = DEFAULT_VOCABULARY_PATH
+# โฟลเดอร์ของโมเดลที่ Materialize แล้ว (สร้างด้วย python main.py --materialize) ถ้ายังไม่มีจะโหลดจาก BASE_MODEL_PATH และ ADAPTER_PATH
+MATERIALIZED_MODEL_DIR = "llava-dentist-materialized"
+# บันทึกเวลา, จำนวน token และ Peak Memory ของแต่ละขั้นตอนลง <โฟลเดอร์ของการรัน>/trace.jsonl (เปิดด้วย --profile ได้เช่นกัน)
+# ถ้าปิดไว้จะไม่มีการจับเวลาใดๆ และ PROFILE_CHROME_TRACE = True จะเขียน trace.chrome.json สำหรับ chrome://tracing เพิ่ม
+PROFILE = False
+PROFILE_CHROME_TRACE = True
 INSTRUCTION = "You are an expert specializing in dentistry. Describe the condition of the anterior teeth in this dentistry with clinical accuracy, mentioning any anatomy, pathology, or restorations."
 
-def main():
+class LazyResources:
+    """โหลดโมเดลเมื่อจำเป็นต้องใช้จริงเท่านั้น (ถ้าทุกเคสอยู่ใน Cache จะไม่ต้องโหลดโมเดลเลย)"""
+    def __init__(self, adapter_hash=None):
+        self.adapter_hash = adapter_hash # Hash ของ Adapter ที่คำนวณแล้ว (ไม่ต้องอ่านโฟลเดอร์ Adapter ซ้ำตอนโหลดโมเดล)
+        self._model = None
+        self._model_lock = threading.Lock() # Thread ของ Prefetch อาจเรียกใช้โมเดล (prefetch_image) พร้อมกับ Thread หลัก
+        # ตัวคำนวณ ROUGE ภายในเครื่อง (ไม่ต้องโหลดจากเครือข่ายหรือ Cache ของ evaluate)
+        self.rouge_metric = RougeScorer()
+
+    @property
+    def model(self):
+        with self._model_lock:
+            if self._model is None:
+                print("Initializing the model with PEFT...")
+                import_start_time = time.perf_counter()
+                with profile("model_import"):
+                    from LLaVADentist import LLaVADentist
+                import_time = time.perf_counter() - import_start_time
+                self._model = LLaVADentist(BASE_MODEL_PATH, ADAPTER_PATH, xai_gradient_mode=XAI_GRADIENT_MODE,
+                                           image_cache_dir=IMAGE_CACHE_DIR, materialized_dir=MATERIALIZED_MODEL_DIR,
+                                           debug=DEBUG_MODEL_OUTPUT, adapter_hash=self.adapter_hash)
+                print(f"Model startup: imports {import_time:.1f} s, load {self._model.load_time:.1f} s "
+                      f"({self._model.load_source} weights)")
+        return self._model
+
+    @property
+    def model_loaded(self):
+        return self._model is not None
+
+def load_case(gt_path):
+    """อ่านไฟล์ Ground Truth หนึ่งไฟล์ คืนค่าเคส หรือ None ถ้าไม่พบรูปภาพ"""
+    case_name = os.path.splitext(os.path.basename(gt_path))[0]
+    with profile("io.load_case"), open(gt_path, 'rb') as f: ground_truth_bytes = f.read()
+    ground_truth = json.loads(ground_truth_bytes.decode('utf-8'))
+    image_path = ground_truth.get("image_path")
+    if not image_path or not os.path.exists(image_path):
+        print(f"Warning: Image path for '{case_name}' not found. Skipping.")
+        return None
+    return {"case_name": case_name, "gt_path": gt_path, "ground_truth": ground_truth, "image_path": image_path,
+            "ground_truth_hash": hash_bytes(ground_truth_bytes)}
+
+def assign_cache_keys(case, adapter_hash):
+    """คำนวณ key ของ Cache ระดับ Narrative และระดับทั้งเคส"""
+    case["narrative_key"] = make_key(
+        image=hash_file(case["image_path"]), instruction=INSTRUCTION,
+        base_model=BASE_MODEL_PATH, adapter=adapter_hash,
+        generation=GENERATION_CONFIG, seed=SEED,
+        stop_on_repetition=STOP_ON_REPETITION, repetition=REPETITION_STOP_CONFIG,
+        **sampling_key_parts(case),
+    )
+    case["case_key"] = make_key(
+        narrative=case["narrative_key"], ground_truth=case["ground_truth_hash"],
+        case_name=case["case_name"], vocabulary=load_keyword_index(VOCABULARY_PATH).vocabulary, xai_mode=XAI_GRADIENT_MODE,
+        xai_layers=XAI_TARGET_LAYERS, xai_attribution=XAI_ATTRIBUTION,
+    )
+
+def case_seed(case):
+    # seed ของการสุ่ม Narrative ต่อเคส จาก narrative key (ซึ่งรวม SEED ไว้แล้ว)
+    # Narrative ของเคสหนึ่งจึงขึ้นกับเนื้อหาของเคสเท่านั้น ไม่ขึ้นกับเคสอื่นที่ถูกสร้างใน Batch เดียวกัน (ตรงกับ Cache)
+    return int(case["narrative_key"][:15], 16)
+
+def shard_settings(num_samples, sample_selection):
+    # การตั้งค่าจาก command line ที่บันทึกตอน Shard จบ (LaunchShards.py รัน Shard ที่จบด้วยค่าอื่นใหม่)
+    return {"samples": num_samples, "sample_selection": sample_selection}
+
+def sampling_key_parts(case):
+    # ส่วนของ key ของ Narrative สำหรับ Self-consistency (ไม่มีเมื่อ K = 1 เพื่อให้ Cache เดิมยังใช้ได้)
+    if NUM_SAMPLES <= 1:
+        return {}
+    parts = {"num_samples": NUM_SAMPLES, "sample_selection": SAMPLE_SELECTION}
+    if SAMPLE_SELECTION == "best":
+        parts["ground_truth"] = case["ground_truth_hash"] # ชุดที่เลือกขึ้นกับ expert_narrative
+    return parts
+
+def select_sample(rouge_metric, samples, expert_narrative):
+    """เลือก Narrative 1 ชุดจาก K ชุดตาม SAMPLE_SELECTION คืนค่าลำดับของชุดที่เลือก (ข้ามชุดที่สร้างไม่สำเร็จ)"""
+    valid = [i for i, sample in enumerate(samples) if "Error:" not in sample]
+    if not valid:
+        return 0
+    predictions = [samples[i] for i in valid]
+    if SAMPLE_SELECTION == "best" and expert_narrative:
+        scores = rouge_metric.compute(predictions=predictions, references=[expert_narrative] * len(predictions),
+                                      use_aggregator=False)["rougeL"]
+        return valid[max(range(len(valid)), key=lambda i: scores[i])]
+    return valid[rouge_metric.consensus_index(predictions)]
+
+def sample_score_stats(sample_scores, selected):
+    """การกระจายของ ROUGE ของ K Narrative (ค่าเฉลี่ย, ส่วนเบี่ยงเบนมาตรฐาน, ต่ำสุด, สูงสุด) และคะแนนของชุดที่เลือก"""
+    stats = {"num_samples": len(next(iter(sample_scores.values()))), "selection": SAMPLE_SELECTION,
+             "selected": {rouge_type: values[selected] for rouge_type, values in sample_scores.items()}}
+    for rouge_type, values in sample_scores.items():
+        mean = sum(values) / len(values)
+        stats[rouge_type] = {"mean": mean, "std": (sum((v - mean) ** 2 for v in values) / len(values)) ** 0.5,
+                             "min": min(values), "max": max(values)}
+    return stats
+
+def heatmap_cache_key(case, keyword, keyword_spans):
+    """
+    key ของ Heatmap ดิบของ keyword หนึ่ง: ตำแหน่งที่ keyword ปรากฏใน Narrative และสถานะ mentioned/fallback
+    รวมถึงคำศัพท์ทั้งชุด (ตำแหน่งสำรองของ keyword ที่ไม่ปรากฏขึ้นกับการปรากฏของ keyword อื่น)
+    """
+    return make_key(narrative=case["narrative_key"], keyword=keyword, spans=keyword_spans.get(keyword, []),
+                    mentioned=keyword in keyword_spans, vocabulary=load_keyword_index(VOCABULARY_PATH).vocabulary,
+                    xai_mode=XAI_GRADIENT_MODE, xai_attribution=XAI_ATTRIBUTION, xai_layers=XAI_TARGET_LAYERS)
+
+def write_result(result_data, results_json_dir):
+    result_filename = f"{result_data['case_name']}_result.json"
+    result_path = os.path.join(results_json_dir, result_filename)
+    with profile("io.write_result"), open(result_path, 'w', encoding='utf-8') as f: json.dump(result_data, f, indent=2, ensure_ascii=False)
+    return result_path
+
+def compute_case_heatmaps(resources, result_cache, case, generated_narrative):
+    """
+    ขั้นตอนที่ใช้โมเดลของเคสหนึ่งเคส (Thread หลัก): ค้นหา keyword ใน Narrative และสร้าง XAI Heatmap
+    เฉพาะ keyword ที่ยังไม่มีใน Cache คืนค่าข้อมูลสำหรับ write_case
+    """
+    case_name, ground_truth, image_path = case["case_name"], case["ground_truth"], case["image_path"]
+    print(f"\n--- Processing case: {case_name} ---")
+    xai = {"keywords": [], "keyword_spans": {}, "heatmaps": {}, "computed_keywords": [], "prefill": {}}
+    if "Error:" in generated_narrative:
+        print(f"Failed to generate narrative: {generated_narrative}")
+        print("Skipping XAI heatmap generation.")
+        return xai
+
+    print(f"Generated Narrative: {generated_narrative}")
+    print("Generating XAI heatmaps...")
+    xai_prompt_prefix = f"USER: <image>\n{INSTRUCTION}\nASSISTANT: "
+    full_xai_prompt = xai_prompt_prefix + generated_narrative
+    # ค้นหา keyword ทางคลินิกทั้งหมดใน Narrative ในการอ่านรอบเดียว (ตรงทั้งคำ รวมคำพ้อง)
+    keyword_index = load_keyword_index(VOCABULARY_PATH)
+    keyword_spans = keyword_index.spans(generated_narrative)
+    expected_keywords = set(ground_truth.get("key_keywords_expected", []))
+    keywords_to_generate_heatmap_for = [kw for kw in keyword_index.keywords if kw in keyword_spans or kw in expected_keywords]
+    print(f"Keywords for heatmap generation: {keywords_to_generate_heatmap_for}")
+
+    # ใช้ Heatmap จาก Cache ก่อน แล้วคำนวณเฉพาะ keyword ที่ยังไม่มี (จาก Forward Pass เดียว)
+    heatmaps = {kw: result_cache.get_heatmap(heatmap_cache_key(case, kw, keyword_spans)) for kw in keywords_to_generate_heatmap_for}
+    missing_keywords = [kw for kw, heatmap in heatmaps.items() if heatmap is None]
+    if missing_keywords:
+        print(f"Computing heatmaps for {len(missing_keywords)} keyword(s) not found in cache: {missing_keywords}")
+        # ส่งตำแหน่งของ keyword ใน Narrative (เลื่อนตามความยาวของ prompt) เพื่อใช้ token ของ keyword ในตำแหน่งจริง
+        prompt_spans = {kw: [(start + len(xai_prompt_prefix), end + len(xai_prompt_prefix)) for start, end in spans]
+                        for kw, spans in keyword_spans.items()}
+        model = resources.model
+        with profile("xai", keywords=len(missing_keywords)):
+            computed, attribution = model.generate_xai_heatmaps(image_path, full_xai_prompt, missing_keywords,
+                                                                keyword_spans=prompt_spans, return_attribution=True,
+                                                                info=xai["prefill"])
+        if xai["prefill"]:
+            print(f"XAI prefill: {xai['prefill']['prefill_tokens']} token(s), "
+                  f"{xai['prefill']['prefill_tokens_saved']} saved by stopping after the last keyword")
+        for keyword, positions in attribution.items():
+            print(f"   - Attribution for '{keyword}': token positions {positions['token_positions']}"
+                  + (f" (fallback: {positions['fallback']})" if positions["fallback"] else ""))
+        heatmaps.update(computed)
+    xai.update(keywords=keywords_to_generate_heatmap_for, keyword_spans=keyword_spans, heatmaps=heatmaps,
+               computed_keywords=missing_keywords)
+    return xai
+
+def write_case(resources, result_cache, result_store, heatmap_store, case, generated_narrative, generation_info, xai, results_json_dir, heatmaps_dir,
+               narrative_samples=None):
+    """
+    ขั้นตอนที่ไม่ใช้โมเดลของเคสหนึ่งเคส (Thread ของ Writer): คำนวณ ROUGE, บันทึก Heatmap ดิบลง Cache และ HeatmapStore
+    แล้วบันทึกผลลัพธ์ (ภาพ Overlay ไม่ถูกสร้างที่นี่ สร้างเมื่อต้องการด้วย HeatmapOverlay.py)
+    narrative_samples คือ Narrative ทั้ง K ชุดของ Self-consistency (None เมื่อสุ่มชุดเดียว)
+    """
+    case_name, gt_path = case["case_name"], case["gt_path"]
+    ground_truth, image_path = case["ground_truth"], case["image_path"]
+
+    # --- การคำนวณและเก็บข้อมูล ---
+    rouge_scores, rouge_sample_stats = {}, None
+    expert_narrative = ground_truth.get("expert_narrative", "")
+    if "Error:" not in generated_narrative and expert_narrative:
+        # ให้คะแนนทุก Narrative ที่สุ่มได้ (K ชุด) ใน Batch เดียว และใช้ค่าเฉลี่ยเป็นคะแนนของเคส
+        predictions = [sample for sample in (narrative_samples or [generated_narrative]) if "Error:" not in sample]
+        with profile("rouge", samples=len(predictions)):
+            scores = resources.rouge_metric.compute(
+                predictions=predictions,
+                references=[expert_narrative] * len(predictions),
+                use_aggregator=False
+            )
+        rouge_scores = {rouge_type: sum(values) / len(values) for rouge_type, values in scores.items()}
+        print(f"ROUGE Scores for {case_name}: {rouge_scores}")
+        if narrative_samples:
+            rouge_sample_stats = sample_score_stats(scores, predictions.index(generated_narrative))
+            print(f"ROUGE-L over {len(predictions)} samples for {case_name}: "
+                  f"{rouge_sample_stats['rougeL']['mean']:.4f} +/- {rouge_sample_stats['rougeL']['std']:.4f}")
+
+    # (ส่วนบันทึก XAI Heatmap)
+    xai_explanations, case_heatmaps = {}, {}
+    keyword_spans = xai["keyword_spans"]
+    for keyword in xai["keywords"]:
+        was_mentioned = keyword in keyword_spans
+        heatmap = xai["heatmaps"].get(keyword)
+        if heatmap is not None:
+            if keyword in xai["computed_keywords"]:
+                with profile("io.heatmap_store"):
+                    result_cache.put_heatmap(heatmap_cache_key(case, keyword, keyword_spans), heatmap)
+            case_heatmaps[keyword] = heatmap
+            xai_explanations[keyword] = {"heatmap_key": heatmap_key(case_name, keyword),
+                                         "heatmap_cache_key": heatmap_cache_key(case, keyword, keyword_spans),
+                                         # สร้างเมื่อเรียก HeatmapOverlay.py เท่านั้น
+                                         "overlay_path": os.path.join(heatmaps_dir, overlay_filename(case_name, keyword, was_mentioned)),
+                                         "mentioned_in_narrative": was_mentioned,
+                                         "narrative_spans": keyword_spans.get(keyword, []),
+                                         "attribution_target": "keyword_tokens" if was_mentioned else "continuation"}
+        else: print(f"   - Failed to generate heatmap for '{keyword}' ({case_name})")
+    # แทนที่ Heatmap ทั้งเคสใน HeatmapStore (ลบ keyword ที่ไม่อยู่ในผลลัพธ์นี้แล้ว เช่น จาก Narrative เดิม)
+    with profile("io.heatmap_store"):
+        heatmap_store.put_case(case_name, case_heatmaps)
+
+    # --- การบันทึกผลลัพธ์ ---
+    result_data = {
+        "case_name": case_name, "image_path": image_path, "ground_truth_path": gt_path,
+        "analysis_focus": ground_truth.get("analysis_focus", "N/A"),
+        "generated_narrative": generated_narrative,
+        "generation_info": generation_info, # สาเหตุที่หยุดการสร้างข้อความ และจำนวน token ที่ประหยัดได้
+        "expert_narrative": expert_narrative,
+        "rouge_scores": rouge_scores, # บันทึก ROUGE scores ลงในไฟล์ .json
+        "xai_explanations": xai_explanations
+    }
+    if xai["prefill"]:
+        result_data["xai_prefill"] = xai["prefill"] # จำนวน token ของ Forward Pass ของ XAI และจำนวนที่ไม่ต้องคำนวณ
+    if narrative_samples:
+        result_data["narrative_samples"] = narrative_samples # Narrative ทั้ง K ชุด (generated_narrative คือชุดที่เลือก)
+        result_data["rouge_sample_stats"] = rouge_sample_stats
+    result_path = write_result(result_data, results_json_dir)
+    with profile("io.result_store"):
+        result_store.append(result_data, expected_keywords=ground_truth.get("key_keywords_expected", []))
+        result_cache.put_case(case["case_key"], result_data)
+    print(f"Saved results for {case_name} to {result_path}")
+
+
+class CaseRunner:
+    """
+    ขั้นตอนทั้ง 3 ของ EvaluationPipeline สำหรับ main.py
+    - prefetch:  อ่าน Ground Truth, ตรวจสอบ Cache และถอดรหัสรูปภาพล่วงหน้า (Thread pool)
+    - run_model: สร้าง Narrative ทีละ Batch และคำนวณ Heatmap (Thread หลัก เพราะใช้ GPU)
+    - write:     ROUGE, บันทึก Heatmap ดิบและ JSON (Thread pool)
+    """
+    def __init__(self, resources, result_cache, result_store, heatmap_store, adapter_hash, results_json_dir, heatmaps_dir):
+        self.resources = resources
+        self.result_cache = result_cache
+        self.result_store = result_store
+        self.heatmap_store = heatmap_store
+        self.adapter_hash = adapter_hash
+        self.results_json_dir = results_json_dir
+        self.heatmaps_dir = heatmaps_dir
+        self.num_cases = 0
+        self.num_generated = 0
+        self.generation_time = 0.0
+        self.total_tokens_saved = 0
+        self.total_prefill_tokens_saved = 0
+
+    def prefetch(self, gt_path):
+        case = load_case(gt_path)
+        if case is None:
+            return None
+        assign_cache_keys(case, self.adapter_hash)
+        case["cached_result"] = self.result_cache.get_case(case["case_key"])
+        if case["cached_result"] is None:
+            case["cached_narrative"] = self.result_cache.get_narrative(case["narrative_key"])
+            if self.resources.model_loaded:
+                # ถอดรหัสรูปภาพและ Preprocessing ล่วงหน้า ระหว่างที่โมเดลประมวลผลเคสก่อนหน้า
+                self.resources.model.prefetch_image(case["image_path"])
+        return case
+
+    def run_model(self, batch):
+        jobs, cases_to_generate = [], []
+        for case in batch:
+            self.num_cases += 1
+            if case["cached_result"] is not None:
+                # ไม่มีอะไรเปลี่ยน ใช้ผลลัพธ์และ Heatmap เดิมทั้งหมด
+                print(f"Case '{case['case_name']}' is unchanged. Reusing cached result.")
+                jobs.append({"case": case})
+            elif case["cached_narrative"] is not None:
+                # Narrative เดิมยังใช้ได้ คำนวณใหม่เฉพาะ ROUGE และ Heatmap ที่ได้รับผลกระทบ
+                print(f"Case '{case['case_name']}' changed. Reusing cached narrative.")
+                narrative = case["cached_narrative"]
+                jobs.append(self._case_job(case, narrative["generated_narrative"], narrative["generation_info"],
+                                           narrative.get("samples")))
+            else:
+                cases_to_generate.append(case)
+        if not cases_to_generate:
+            return jobs
+
+        # สร้าง Narrative ของเคสที่เหลือใน Batch เดียว
+        print(f"\nGenerating narratives for {len(cases_to_generate)} case(s): {[case['case_name'] for case in cases_to_generate]}")
+        model = self.resources.model
+        batch_start_time = time.perf_counter()
+        narratives, generation_infos = model.generate_narratives(
+            [case["image_path"] for case in cases_to_generate], INSTRUCTION, batch_size=len(cases_to_generate),
+            return_info=True, stop_on_repetition=STOP_ON_REPETITION, seed=[case_seed(case) for case in cases_to_generate],
+            num_samples=NUM_SAMPLES, **REPETITION_STOP_CONFIG)
+        self.generation_time += time.perf_counter() - batch_start_time
+        self.num_generated += len(cases_to_generate)
+        for case, generated_narrative, generation_info in zip(cases_to_generate, narratives, generation_infos):
+            samples = None
+            if NUM_SAMPLES > 1:
+                # Self-consistency: เลือก 1 ชุดจาก K ชุดเพื่อสร้าง Heatmap (ROUGE ของทุกชุดคำนวณใน write)
+                samples, sample_infos = generated_narrative, generation_info
+                selected = select_sample(self.resources.rouge_metric, samples, case["ground_truth"].get("expert_narrative", ""))
+                generated_narrative = samples[selected]
+                generation_info = {**sample_infos[selected], "num_samples": NUM_SAMPLES, "selected_sample": selected,
+                                   "tokens_saved": sum(info["tokens_saved"] for info in sample_infos)}
+            print(f"Generation for {case['case_name']}: {generation_info}")
+            self.total_tokens_saved += generation_info["tokens_saved"]
+            job = self._case_job(case, generated_narrative, generation_info, samples)
+            job["new_narrative"] = "Error:" not in generated_narrative
+            jobs.append(job)
+        return jobs
+
+    def write(self, job):
+        case = job["case"]
+        if case["cached_result"] is not None:
+            self._restore_heatmaps(case["cached_result"])
+            write_result(case["cached_result"], self.results_json_dir)
+            self.result_store.append(case["cached_result"], expected_keywords=case["ground_truth"].get("key_keywords_expected", []))
+            return
+        if job.get("new_narrative"):
+            self.result_cache.put_narrative(case["narrative_key"], job["generated_narrative"], job["generation_info"],
+                                            samples=job["narrative_samples"])
+        write_case(self.resources, self.result_cache, self.result_store, self.heatmap_store, case, job["generated_narrative"],
+                   job["generation_info"], job["xai"], self.results_json_dir, self.heatmaps_dir,
+                   narrative_samples=job["narrative_samples"])
+
+    def _restore_heatmaps(self, result_data):
+        """
+        คัดลอก Heatmap ดิบของผลลัพธ์ที่ใช้จาก Cache เข้าสู่ HeatmapStore ของการรันนี้
+        แถวที่มีอยู่แล้วแต่ไม่ตรงกับ Cache (เช่น จาก Narrative ของการรันก่อนหน้า) จะถูกแทนที่
+        และ keyword ที่ไม่อยู่ในผลลัพธ์แล้วจะถูกลบ
+        """
+        self.heatmap_store.put_case(result_data["case_name"], {
+            keyword: self.result_cache.get_heatmap(explanation["heatmap_cache_key"])
+            for keyword, explanation in result_data["xai_explanations"].items()})
+
+    def _case_job(self, case, generated_narrative, generation_info, narrative_samples=None):
+        xai = compute_case_heatmaps(self.resources, self.result_cache, case, generated_narrative)
+        self.total_prefill_tokens_saved += xai["prefill"].get("prefill_tokens_saved", 0)
+        return {"case": case, "generated_narrative": generated_narrative, "generation_info": generation_info, "xai": xai,
+                "narrative_samples": narrative_samples}
+
+def create_summaries(results_json_dir):
+    from CreateSummaryHeatMap import CreateHeatMap
+    from CreateRougeScore import CreateRougeMatrix
+
+    # --- ขั้นตอนที่ 5: สร้าง Visualization สรุปผล ---
+    print("\n--- Generating Summary Heatmap ---")
+    CreateHeatMap(results_json_dir)
+
+    # --- การเรียกใช้ Class เพื่อสร้าง Heatmap ---
+    print("\n--- Generating ROUGE Score Matrix ---")
+    rouge_matrix_creator = CreateRougeMatrix(results_json_dir)
+    rouge_matrix_creator.generate()
+
+    create_timing_table(os.path.dirname(os.path.normpath(results_json_dir)))
+
+def create_timing_table(output_dir, filename="timing_table.csv"):
+    """
+    ตารางเวลาของแต่ละขั้นตอน จาก Trace ของการรันล่าสุด (รวม Trace ของทุก Shard ถ้ารันแบบแบ่ง Shard)
+    พิมพ์ออกหน้าจอและบันทึกเป็น CSV ไว้คู่กับกราฟสรุปผล (ข้ามไปถ้าไม่ได้เปิด Profiling)
+    """
+    trace_paths = [os.path.join(output_dir, TRACE_FILENAME)] + sorted(
+        glob.glob(os.path.join(output_dir, SHARDS_DIR_NAME, "*", TRACE_FILENAME)))
+    records = load_trace(*trace_paths)
+    if not records:
+        return
+    print("\n--- Stage Timing Table ---")
+    rows = summarize_trace(records)
+    print(format_timing_table(rows))
+    save_path = os.path.join(output_dir, filename)
+    write_timing_table(rows, save_path)
+    print(f"Timing table saved to '{save_path}'")
+
+def main(shard=None, summarize=True, profile_run=PROFILE):
+    """
+    รันการประเมินผล
+    shard=(i, N) จะประมวลผลเฉพาะเคสของ Shard ที่ i จาก N และเขียน results_json (รวม Heatmap ดิบ) ไว้ใน
+    <OUTPUT_DIR>/shards/i-of-N/ (Cache ใช้ร่วมกันทุก Shard) จากนั้นรวมผลด้วย merge_shards ก่อนสร้าง Visualization
+    profile_run=True จะบันทึก Trace ของทุกขั้นตอนลง <โฟลเดอร์ของการรัน>/trace.jsonl และพิมพ์ตารางเวลาเมื่อจบ
+    """
+    if SAMPLE_SELECTION not in SAMPLE_SELECTIONS:
+        raise ValueError(f"SAMPLE_SELECTION must be one of {SAMPLE_SELECTIONS}, got '{SAMPLE_SELECTION}'")
     # --- ขั้นตอนที่ 1: เตรียมโฟลเดอร์สำหรับเก็บผลลัพธ์ ---
-    results_json_dir = os.path.join(OUTPUT_DIR, "results_json")
+    run_dir = shard_dir(OUTPUT_DIR, *shard) if shard else OUTPUT_DIR
+    results_json_dir = os.path.join(run_dir, "results_json")
     heatmaps_dir = os.path.join(OUTPUT_DIR, "heatmaps")
     os.makedirs(results_json_dir, exist_ok=True)
-    os.makedirs(heatmaps_dir, exist_ok=True)
-
-    # --- ขั้นตอนที่ 2: โหลดโมเดลและ Metric ---
-    print("Initializing the model with PEFT...")
-    model = LLaVADentist(BASE_MODEL_PATH, ADAPTER_PATH)
-    
-    # เตรียมตัวคำนวณ ROUGE
-    print("Loading ROUGE metric...")
-    rouge_metric = evaluate.load('rouge')
+    if shard:
+        clear_shard_complete(run_dir)
+    trace_path = os.path.join(run_dir, TRACE_FILENAME)
+    if profile_run:
+        profiler = enable_profiling(trace_path, os.path.join(run_dir, CHROME_TRACE_FILENAME) if PROFILE_CHROME_TRACE else None)
+    elif os.path.exists(trace_path):
+        os.remove(trace_path) # Trace ของการรันก่อนหน้า ไม่ตรงกับการรันนี้แล้ว
+
+    # --- ขั้นตอนที่ 2: เตรียม Cache (โมเดลและ Metric จะถูกโหลดเมื่อจำเป็นเท่านั้น) ---
+    adapter_hash = hash_path(ADAPTER_PATH)
+    resources = LazyResources(adapter_hash)
+    result_cache = ResultCache(RESULT_CACHE_DIR)
+    # ไฟล์ผลลัพธ์รวม (อ่านครั้งเดียวโดย CreateHeatMap และ CreateRougeMatrix)
+    result_store = ResultStore(results_json_dir)
+    # Heatmap ดิบ (float16) ของทุกเคสในไฟล์เดียว ภาพ Overlay ใน heatmaps_dir สร้างภายหลังด้วย HeatmapOverlay.py
+    heatmap_store = HeatmapStore(results_json_dir)
     print("-" * 30)
 
-    # --- ขั้นตอนที่ 3: ค้นหาและประมวลผลข้อมูลทดสอบทีละเคส ---
+    # --- ขั้นตอนที่ 3: ค้นหาข้อมูลทดสอบ ---
     ground_truth_files = glob.glob(os.path.join(EVAL_DATA_DIR, "*.json"))
     if not ground_truth_files:
         print(f"Error: No ground truth .json files found in '{EVAL_DATA_DIR}'.")
         return
     print(f"Found {len(ground_truth_files)} evaluation cases.")
+    if shard:
+        ground_truth_files = select_shard(ground_truth_files, *shard)
+        print(f"Shard {shard[0]}/{shard[1]}: processing {len(ground_truth_files)} case(s).")
 
-    for gt_path in ground_truth_files:
-        case_name = os.path.splitext(os.path.basename(gt_path))[0]
-        print(f"\n--- Processing case: {case_name} ---")
-        with open(gt_path, 'r', encoding='utf-8') as f: ground_truth = json.load(f)
-        image_path = ground_truth.get("image_path")
-        if not image_path or not os.path.exists(image_path):
-            print(f"Warning: Image path for '{case_name}' not found. Skipping.")
-            continue
-        
-        print("Generating narrative...")
-        generated_narrative = model.generate_narrative(image_path, INSTRUCTION)
-
-        # --- การคำนวณและเก็บข้อมูล ---
-        rouge_scores = {}
-        expert_narrative = ground_truth.get("expert_narrative", "")
-        if "Error:" not in generated_narrative and expert_narrative:
-            print("Calculating ROUGE scores...")
-            scores = rouge_metric.compute(
-                predictions=[generated_narrative],
-                references=[expert_narrative]
-            )
-            rouge_scores = scores
-            print(f"ROUGE Scores: {scores}")
-
-        # (ส่วนสร้าง XAI Heatmap เหมือนเดิม)
-        xai_explanations = {}
-        if "Error:" not in generated_narrative:
-            print(f"Generated Narrative: {generated_narrative}")
-            print("Generating XAI heatmaps...")
-            full_xai_prompt = f"USER: <image>\n{INSTRUCTION}\nASSISTANT: {generated_narrative}"
-            keywords_in_narrative = generated_narrative.lower()
-            expected_keywords = ground_truth.get("key_keywords_expected", [])
-            all_keywords_to_check = set(expected_keywords) | {word.strip(".,!?") for word in keywords_in_narrative.split()}
-            relevant_keywords = ["anterior", "bone", "canine", "central incisor", "crown", "fracture", "incisor", "lateral incisor", "lesion", "loss", "mandibular", "maxillary", "normal", "pathology", "periapical", "restoration", "untreated"]
-            keywords_to_generate_heatmap_for = [kw for kw in relevant_keywords if kw in all_keywords_to_check]
-            print(f"Keywords for heatmap generation: {keywords_to_generate_heatmap_for}")
-            for keyword in keywords_to_generate_heatmap_for:
-                was_mentioned = keyword in keywords_in_narrative
-                print(f" - Generating for keyword: '{keyword}' (Mentioned: {was_mentioned})")
-                heatmap = model.generate_xai_heatmap(image_path, full_xai_prompt, keyword)
-                if heatmap is not None:
-                    suffix = "" if was_mentioned else "_omitted"
-                    heatmap_filename = f"{case_name}_heatmap_{keyword}{suffix}.jpg"
-                    heatmap_path = os.path.join(heatmaps_dir, heatmap_filename)
-                    cv2.imwrite(model.superimpose_heatmap(image_path, heatmap), heatmap_path)
-                    xai_explanations[keyword] = {"path": heatmap_path, "mentioned_in_narrative": was_mentioned}
-                else: print(f"   - Failed to generate heatmap for '{keyword}'")
-        else:
-             print(f"Failed to generate narrative: {generated_narrative}")
-             print("Skipping XAI heatmap generation.")
-
-        # --- การบันทึกผลลัพธ์ ---
-        result_data = {
-            "case_name": case_name, "image_path": image_path, "ground_truth_path": gt_path,
-            "analysis_focus": ground_truth.get("analysis_focus", "N/A"),
-            "generated_narrative": generated_narrative,
-            "expert_narrative": expert_narrative,
-            "rouge_scores": rouge_scores, # บันทึก ROUGE scores ลงในไฟล์ .json
-            "xai_explanations": xai_explanations
-        }
-        result_filename = f"{case_name}_result.json"
-        result_path = os.path.join(results_json_dir, result_filename)
-        with open(result_path, 'w', encoding='utf-8') as f: json.dump(result_data, f, indent=2, ensure_ascii=False)
-        print(f"Saved results for {case_name} to {result_path}")
-    
+    # --- ขั้นตอนที่ 4: ประมวลผลทุกเคสผ่าน Pipeline (Prefetch -> โมเดล -> Writer) ---
+    runner = CaseRunner(resources, result_cache, result_store, heatmap_store, adapter_hash, results_json_dir, heatmaps_dir)
+    pipeline = EvaluationPipeline(runner.prefetch, runner.run_model, runner.write,
+                                  prefetch_workers=PREFETCH_WORKERS, writer_workers=WRITER_WORKERS,
+                                  queue_size=PIPELINE_QUEUE_SIZE, batch_size=NARRATIVE_BATCH_SIZE)
+    with profile("evaluation_run", cases=len(ground_truth_files)):
+        pipeline.run(sorted(ground_truth_files))
+
+    result_store.compact()
+    heatmap_store.compact()
     print("\nEvaluation run completed.")
-    
-    # --- ขั้นตอนที่ 4: สร้าง Visualization สรุปผล ---
-    # (ส่วนนี้ไม่มีการเปลี่ยนแปลง)
-    print("\n--- Generating Summary Heatmap ---")
-    CreateHeatMap(results_json_dir)
+    print(f"{runner.num_cases - runner.num_generated} of {runner.num_cases} case(s) reused a cached narrative.")
+    if runner.num_generated and runner.generation_time > 0:
+        print(f"Narrative throughput: {runner.num_generated / runner.generation_time * 60:.2f} cases/min (batch size {NARRATIVE_BATCH_SIZE})")
+        print(f"Tokens saved by repetition early stopping: {runner.total_tokens_saved}")
+    if runner.total_prefill_tokens_saved:
+        print(f"XAI prefill tokens saved by stopping after the last keyword: {runner.total_prefill_tokens_saved}")
+    pipeline.report()
+    print(f"Raw heatmaps saved to '{heatmap_store.data_path}'. Render overlays with: python HeatmapOverlay.py")
+    if profile_run:
+        profiler.close()
+        print(f"\nProfiling trace saved to '{trace_path}'.")
+        print(format_timing_table(profiler.summary()))
 
-    # --- การเรียกใช้ Class เพื่อสร้าง Heatmap ---
-    print("\n--- Generating ROUGE Score Matrix ---")
-    rouge_matrix_creator = CreateRougeMatrix(results_json_dir)
-    rouge_matrix_creator.generate()
+    if shard:
+        mark_shard_complete(run_dir, runner.num_cases, shard_settings(NUM_SAMPLES, SAMPLE_SELECTION))
+        # Visualization ต้องใช้ผลลัพธ์ของทุก Shard จึงสร้างหลังการรวมผลเท่านั้น
+        return
+    if summarize:
+        create_summaries(results_json_dir)
+
+def materialize_model():
+    """
+    Materialize โมเดล (ทำครั้งเดียว) แล้วเปรียบเทียบเวลาเริ่มต้นระหว่างการโหลดจากต้นฉบับและจากโมเดลที่ Materialize แล้ว
+    ทั้งสองแบบวัดด้วยเงื่อนไขเดียวกัน (Base Model, Processor, แก้ไข Projector และหุ้ม Adapter) และโหลดทีละโมเดล
+    """
+    import gc
+    import_start_time = time.perf_counter()
+    import torch
+    from LLaVADentist import LLaVADentist
+    import_time = time.perf_counter() - import_start_time
+    adapter_hash = hash_path(ADAPTER_PATH)
+    LLaVADentist.materialize(BASE_MODEL_PATH, ADAPTER_PATH, MATERIALIZED_MODEL_DIR, adapter_hash=adapter_hash)
+
+    load_times = {}
+    for materialized_dir in (None, MATERIALIZED_MODEL_DIR):
+        model = LLaVADentist(BASE_MODEL_PATH, ADAPTER_PATH, xai_gradient_mode=XAI_GRADIENT_MODE,
+                             materialized_dir=materialized_dir, adapter_hash=adapter_hash)
+        load_times[model.load_source] = model.load_time
+        del model
+        gc.collect() # คืนหน่วยความจำของโมเดลก่อนหน้า ก่อนวัดเวลาโหลดโมเดลถัดไป
+        if torch.cuda.is_available(): torch.cuda.empty_cache()
+    print(f"\nStartup times including adapter (imports {import_time:.1f} s):")
+    for source, load_time in load_times.items():
+        print(f"  {source + ':':<14} {load_time:.1f} s")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Evaluate the dental LLaVA model and generate XAI heatmaps.")
+    parser.add_argument("--shard", type=parse_shard, default=None, metavar="i/N",
+                        help="Process only shard i of N (0-based); results go to <OUTPUT_DIR>/shards/i-of-N/.")
+    parser.add_argument("--merge", action="store_true",
+                        help="Merge the results of all shards into <OUTPUT_DIR>/results_json and create the summaries.")
+    parser.add_argument("--num-shards", type=int, default=None,
+                        help="With --merge, only merge the shards of an N-way split.")
+    parser.add_argument("--no-summary", action="store_true", help="Skip the summary heatmap and ROUGE matrix.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Record a per-stage trace (trace.jsonl and trace.chrome.json) and print a timing table.")
+    parser.add_argument("--samples", type=int, default=NUM_SAMPLES,
+                        help="Narratives sampled per image in one generate call; ROUGE is averaged over them.")
+    parser.add_argument("--sample-selection", choices=SAMPLE_SELECTIONS, default=SAMPLE_SELECTION,
+                        help="How the narrative used for the heatmaps is picked from the samples.")
+    parser.add_argument("--materialize", action="store_true",
+                        help="Save the base model and adapter to MATERIALIZED_MODEL_DIR and compare startup times.")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    NUM_SAMPLES, SAMPLE_SELECTION = max(1, args.samples), args.sample_selection
+    if args.materialize:
+        materialize_model()
+    elif args.merge:
+        merge_shards(OUTPUT_DIR, count=args.num_shards)
+        if not args.no_summary:
+            create_summaries(os.path.join(OUTPUT_DIR, "results_json"))
+    else:
+        main(shard=args.shard, summarize=not args.no_summary, profile_run=PROFILE or args.profile)
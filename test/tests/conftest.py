@@ -0,0 +1,5 @@
+import os
+import sys
+
+# โมดูลของโปรเจกต์อยู่ในโฟลเดอร์แม่ของ tests/ แบบ flat (import ด้วยชื่อไฟล์ตรงๆ เหมือนที่ main.py ทำ)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,25 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("peft")
+
+from Benchmark import check_results, save_baseline
+
+RESULTS = {"rouge/cases=1": {"median_s": 0.1, "min_s": 0.1, "repeats": 3}}
+
+def test_missing_baseline_fails_unless_updating(tmp_path, capsys):
+    baseline_path = str(tmp_path / "baseline.json")
+    assert check_results(RESULTS, [], baseline_path) == 1
+    assert "No baseline found" in capsys.readouterr().out
+    assert not (tmp_path / "baseline.json").exists()
+    assert check_results(RESULTS, [], baseline_path, update_baseline=True) == 0
+    assert check_results(RESULTS, [], baseline_path) == 0
+
+def test_regression_and_failure_exit_codes(tmp_path):
+    baseline_path = str(tmp_path / "baseline.json")
+    save_baseline(RESULTS, baseline_path)
+    slower = {"rouge/cases=1": {"median_s": 0.2, "min_s": 0.2, "repeats": 3}}
+    assert check_results(slower, [], baseline_path) == 1
+    assert check_results(RESULTS, ["rouge/cases=1: broken"], baseline_path) == 1
+    assert check_results(RESULTS, ["rouge/cases=1: broken"], baseline_path, update_baseline=True) == 1
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+Image = pytest.importorskip("PIL.Image")
+
+from TinyLLaVA import create_tiny_llava
+
+
+@pytest.fixture(scope="module")
+def tiny_model():
+    model = create_tiny_llava()
+    model.GENERATION_CONFIG = {**model.GENERATION_CONFIG, "max_new_tokens": 12}
+    return model
+
+def _images(tmp_path, colors):
+    paths = []
+    for i, color in enumerate(colors):
+        path = str(tmp_path / f"image_{i}.png")
+        Image.new("RGB", (32, 32), color).save(path)
+        paths.append(path)
+    return paths
+
+def test_narrative_does_not_depend_on_batch_composition(tiny_model, tmp_path):
+    paths = _images(tmp_path, [(200, 180, 150), (20, 40, 60), (90, 90, 90)])
+    alone = tiny_model.generate_narratives(paths[:1], "Describe.", batch_size=1, seed=[7])
+    batched = tiny_model.generate_narratives(paths, "Describe.", batch_size=3, seed=[7, 8, 9])
+    assert batched[0] == alone[0]
+
+def test_seeded_samples_are_reproducible(tiny_model, tmp_path):
+    paths = _images(tmp_path, [(200, 180, 150)])
+    first = tiny_model.generate_narratives(paths, "Describe.", seed=[7], num_samples=3)
+    second = tiny_model.generate_narratives(paths, "Describe.", seed=[7], num_samples=3)
+    assert first == second
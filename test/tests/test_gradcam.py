@@ -0,0 +1,39 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from GradCAM import _loop_gradcam, vit_gradcam
+
+
+@pytest.mark.parametrize("drop_cls, num_tokens", [(True, 17), (False, 16)])
+def test_vectorized_matches_loop_reference(drop_cls, num_tokens):
+    torch.manual_seed(0)
+    feature_maps = torch.randn(num_tokens, 32)
+    gradients = torch.randn(5, num_tokens, 32)
+    vectorized = vit_gradcam(feature_maps, gradients, drop_cls=drop_cls)
+    assert vectorized.shape == (5, 4, 4)
+    assert torch.allclose(vectorized, _loop_gradcam(feature_maps, gradients, drop_cls=drop_cls), atol=1e-5)
+
+def test_batched_feature_maps_match_shared_feature_map():
+    torch.manual_seed(0)
+    feature_maps = torch.randn(17, 8)
+    gradients = torch.randn(3, 17, 8)
+    shared = vit_gradcam(feature_maps, gradients)
+    per_keyword = vit_gradcam(feature_maps.expand(3, 17, 8), gradients)
+    assert torch.allclose(shared, per_keyword, atol=1e-6)
+
+def test_patch_grid_and_normalization():
+    # Patch เดียวที่มีค่าบวก: Heatmap มีค่า 1 ที่ตำแหน่งนั้น (แถว 1 คอลัมน์ 2 ของตาราง 4x4) และ 0 ที่อื่น
+    feature_maps = torch.zeros(17, 2)
+    feature_maps[1 + 1 * 4 + 2, 0] = 3.0
+    gradients = torch.zeros(1, 17, 2)
+    gradients[0, :, 0] = 1.0
+    cam = vit_gradcam(feature_maps, gradients)[0]
+    expected = torch.zeros(4, 4)
+    expected[1, 2] = 1.0
+    assert torch.equal(cam, expected)
+    assert torch.equal(vit_gradcam(feature_maps, torch.zeros(1, 17, 2)), torch.zeros(1, 4, 4)) # ไม่หารด้วยศูนย์
+
+def test_rejects_non_square_patch_counts():
+    with pytest.raises(ValueError):
+        vit_gradcam(torch.randn(16, 4), torch.randn(1, 16, 4)) # 15 Patch หลังตัด CLS
@@ -0,0 +1,110 @@
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from HeatmapStore import HeatmapStore
+
+
+def grid(value, size=4):
+    return np.full((size, size), value, dtype=np.float32)
+
+
+def test_round_trip_in_float16(tmp_path):
+    store = HeatmapStore(str(tmp_path))
+    assert store.get("a", "caries") is None and store.keys() == []
+    heatmap = np.linspace(0, 1, 16, dtype=np.float32).reshape(4, 4)
+    store.put("a", "caries", heatmap)
+    loaded = store.get("a", "caries")
+    assert loaded.dtype == np.float32
+    assert np.allclose(loaded, heatmap, atol=1e-3)
+    assert os.path.getsize(store.data_path) == heatmap.size * 2 # 2 bytes ต่อค่า
+
+def test_latest_row_wins_and_array_is_memory_mapped(tmp_path):
+    store = HeatmapStore(str(tmp_path))
+    store.put("a", "caries", grid(0.1))
+    store.put("b", "lesion", grid(0.3))
+    store.put("a", "caries", grid(0.5))
+    assert store.keys() == [("a", "caries"), ("b", "lesion")]
+    assert np.allclose(store.get("a", "caries"), 0.5, atol=1e-3)
+    array, rows = store.as_array(), store.rows()
+    assert isinstance(array, np.memmap) and array.shape == (3, 4, 4)
+    assert np.allclose(array[rows[("b", "lesion")]], 0.3, atol=1e-3)
+
+def test_rejects_a_different_grid_shape(tmp_path):
+    store = HeatmapStore(str(tmp_path))
+    store.put("a", "caries", grid(0.1))
+    with pytest.raises(ValueError):
+        store.put("a", "molar", grid(0.1, size=5))
+
+def test_partial_last_row_is_truncated(tmp_path):
+    store = HeatmapStore(str(tmp_path))
+    store.put("a", "caries", grid(0.1))
+    with open(store.data_path, "ab") as f:
+        f.write(b"\x00" * 7) # แถวที่เขียนไม่สมบูรณ์
+    store.put("a", "molar", grid(0.2))
+    assert store.as_array().shape == (2, 4, 4)
+    assert np.allclose(store.get("a", "molar"), 0.2, atol=1e-3)
+
+def test_put_case_replaces_and_deletes(tmp_path):
+    store = HeatmapStore(str(tmp_path))
+    store.put_case("a", {"caries": grid(0.1), "molar": grid(0.2)})
+    store.put_case("b", {"caries": grid(0.3)})
+    size = os.path.getsize(store.data_path)
+    store.put_case("a", {"caries": grid(0.1), "molar": grid(0.2)})
+    assert os.path.getsize(store.data_path) == size # ค่าเท่าเดิมไม่ถูกเขียนซ้ำ
+    # รันใหม่: "molar" ไม่อยู่ในผลลัพธ์แล้ว, "caries" เปลี่ยน และ "lesion" ไม่มี Heatmap
+    store.put_case("a", {"caries": grid(0.5), "lesion": None})
+    assert store.keys() == [("a", "caries"), ("b", "caries")]
+    assert np.allclose(store.get("a", "caries"), 0.5, atol=1e-3)
+    assert np.allclose(store.get("b", "caries"), 0.3, atol=1e-3) # เคสอื่นไม่ถูกแตะต้อง
+
+def test_index_log_survives_until_flush(tmp_path):
+    store = HeatmapStore(str(tmp_path))
+    store.put("a", "caries", grid(0.1))
+    store.put_case("b", {"lesion": grid(0.3)})
+    assert os.path.exists(store.log_path)
+    reopened = HeatmapStore(str(tmp_path)) # process ใหม่ที่ยังไม่ได้ flush
+    assert reopened.keys() == [("a", "caries"), ("b", "lesion")]
+    reopened.flush()
+    assert not os.path.exists(reopened.log_path)
+    assert HeatmapStore(str(tmp_path)).keys() == [("a", "caries"), ("b", "lesion")]
+
+def test_compact_drops_unreferenced_rows(tmp_path):
+    store = HeatmapStore(str(tmp_path))
+    for value in (0.1, 0.2, 0.3): # รันซ้ำ 3 ครั้งด้วยค่าที่เปลี่ยนไป
+        store.put_case("a", {"caries": grid(value), "molar": grid(value + 0.5)})
+    store.put_case("b", {"lesion": grid(0.4)})
+    assert store.as_array().shape[0] == 7
+    store.compact()
+    assert store.as_array().shape == (3, 4, 4)
+    assert not os.path.exists(store.log_path)
+    reopened = HeatmapStore(str(tmp_path))
+    assert reopened.keys() == [("a", "caries"), ("a", "molar"), ("b", "lesion")]
+    assert np.allclose(reopened.get("a", "caries"), 0.3, atol=1e-3)
+    assert np.allclose(reopened.get("b", "lesion"), 0.4, atol=1e-3)
+    size = os.path.getsize(store.data_path)
+    reopened.compact()
+    assert os.path.getsize(store.data_path) == size
+
+@pytest.mark.parametrize("data_replaced", [False, True])
+def test_interrupted_compact_is_recovered(tmp_path, data_replaced):
+    store = HeatmapStore(str(tmp_path))
+    store.put("a", "caries", grid(0.1))
+    store.put("a", "caries", grid(0.2))
+    store.put("b", "lesion", grid(0.3))
+    compacted = HeatmapStore(str(tmp_path / "compacted"))
+    os.makedirs(str(tmp_path / "compacted"))
+    # จำลอง compact() ที่หยุดหลังเขียน Snapshot (และอาจหลังแทนที่ไฟล์ข้อมูล) แต่ก่อนเขียน index
+    with open(store.compact_path, 'w', encoding='utf-8') as f:
+        json.dump({"shape": [4, 4], "rows": {"a/caries": 0, "b/lesion": 1}, "data_size": 64}, f)
+    if data_replaced:
+        compacted.put("a", "caries", grid(0.2))
+        compacted.put("b", "lesion", grid(0.3))
+        os.replace(compacted.data_path, store.data_path)
+    reopened = HeatmapStore(str(tmp_path))
+    assert np.allclose(reopened.get("a", "caries"), 0.2, atol=1e-3)
+    assert np.allclose(reopened.get("b", "lesion"), 0.3, atol=1e-3)
+    assert not os.path.exists(store.compact_path)
@@ -0,0 +1,44 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+Image = pytest.importorskip("PIL.Image")
+
+from ImageFeatureCache import ImageFeatureCache
+
+
+def save_image(path, color):
+    Image.new("RGB", (8, 8), color).save(str(path))
+    return str(path)
+
+def test_key_follows_file_content(tmp_path):
+    cache = ImageFeatureCache()
+    first = save_image(tmp_path / "a.png", (10, 20, 30))
+    copy = save_image(tmp_path / "b.png", (10, 20, 30))
+    other = save_image(tmp_path / "c.png", (200, 0, 0))
+    assert cache.key_for(first) == cache.key_for(copy)
+    assert cache.key_for(first) != cache.key_for(other)
+    assert cache.get(first) is cache.get(copy) # รูปภาพเนื้อหาเดียวกันใช้รายการเดียวกัน
+    save_image(tmp_path / "a.png", (1, 2, 3)) # แก้ไขไฟล์: key ต้องเปลี่ยนตาม
+    assert cache.key_for(first) != cache.key_for(copy)
+
+def test_lru_eviction(tmp_path):
+    cache = ImageFeatureCache(max_entries=2)
+    paths = [save_image(tmp_path / f"{i}.png", (i, i, i)) for i in range(3)]
+    entries = [cache.get(path) for path in paths]
+    assert cache.get(paths[2]) is entries[2]
+    assert cache.get(paths[0]) is not entries[0] # รายการที่เก่าที่สุดถูกนำออกแล้ว
+
+def test_disk_round_trip_is_namespaced(tmp_path):
+    path = save_image(tmp_path / "a.png", (10, 20, 30))
+    cache = ImageFeatureCache(disk_dir=str(tmp_path / "cache"), namespace="model-a")
+    entry = cache.get(path)
+    entry.pixel_values = torch.arange(6.0).reshape(1, 6)
+    entry.image_features = torch.ones(1, 4, 2)
+    cache.save(entry)
+
+    reloaded = ImageFeatureCache(disk_dir=str(tmp_path / "cache"), namespace="model-a").get(path)
+    assert torch.equal(reloaded.pixel_values, entry.pixel_values)
+    assert torch.equal(reloaded.image_features, entry.image_features)
+    assert reloaded.image_bgr.shape == (8, 8, 3)
+    other_model = ImageFeatureCache(disk_dir=str(tmp_path / "cache"), namespace="model-b").get(path)
+    assert other_model.pixel_values is None and other_model.image_features is None
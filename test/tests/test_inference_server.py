@@ -0,0 +1,111 @@
+import io
+import json
+import base64
+import asyncio
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+Image = pytest.importorskip("PIL.Image")
+
+from InferenceServer import LatencyStats, InferenceServer
+from TinyLLaVA import create_tiny_llava
+
+
+def test_latency_stats_count_every_status():
+    stats = LatencyStats()
+    stats.record(0.010, 200)
+    stats.record(0.500, 503)
+    stats.record(1.000, 504)
+    summary = stats.summary()
+    assert summary["count"] == 3
+    assert summary["status_counts"] == {"200": 1, "503": 1, "504": 1}
+    assert summary["p99_ms"] == 1000.0
+
+
+@pytest.fixture(scope="module")
+def tiny_model():
+    model = create_tiny_llava()
+    model.GENERATION_CONFIG = {**model.GENERATION_CONFIG, "max_new_tokens": 8}
+    return model
+
+def _image_base64(color=(200, 180, 150)):
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), color).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+async def _request(port, method, path, body=b"", headers=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    headers = {"Content-Length": str(len(body)), **(headers or {})}
+    head = f"{method} {path} HTTP/1.1\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+    writer.write(head.encode("ascii") + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    status_line, _, payload = response.partition(b"\r\n\r\n")
+    return int(status_line.split()[1]), json.loads(payload)
+
+def _run(tiny_model, upload_dir, scenario):
+    async def run():
+        server = await InferenceServer(tiny_model, upload_dir=str(upload_dir)).start("127.0.0.1", 0)
+        try:
+            return await scenario(server)
+        finally:
+            await server.stop()
+    return asyncio.run(run())
+
+def test_narrative_round_trip_removes_upload(tiny_model, tmp_path):
+    async def scenario(server):
+        body = json.dumps({"image_base64": _image_base64()}).encode("utf-8")
+        return await _request(server.port, "POST", "/narrative", body), server.metrics()
+    (status, payload), metrics = _run(tiny_model, tmp_path, scenario)
+    assert status == 200
+    assert isinstance(payload["narrative"], str)
+    assert list(tmp_path.iterdir()) == [] # ไฟล์ชั่วคราวถูกลบหลังตอบคำขอ
+    assert metrics["latency"]["/narrative"]["status_counts"] == {"200": 1}
+
+def test_narrative_seed_follows_the_request_not_the_batch(tiny_model, tmp_path):
+    image, other = _image_base64(), _image_base64((90, 40, 40))
+    async def scenario(server):
+        post = lambda request: _request(server.port, "POST", "/narrative", json.dumps(request).encode("utf-8"))
+        alone = await post({"image_base64": image})
+        # คำขอที่เข้ามาพร้อมกันถูกรวมเป็น Micro-batch เดียวกัน
+        batched = await asyncio.gather(post({"image_base64": image}), post({"image_base64": other}),
+                                       post({"image_base64": image, "seed": 7}))
+        return alone, batched
+    (status, alone), batched = _run(tiny_model, tmp_path, scenario)
+    (_, same), (_, different), (_, seeded) = batched
+    assert status == 200 and same["batch_size"] > 1
+    assert same["seed"] == alone["seed"] and same["narrative"] == alone["narrative"]
+    assert different["seed"] != alone["seed"]
+    assert seeded["seed"] == 7
+
+@pytest.mark.parametrize("body, headers", [
+    ({"image_base64": "x", "timeout": "soon"}, None),
+    ({"image_base64": "x", "timeout": -1}, None),
+    ({"image_base64": "not base64!"}, None),
+    ({"image_base64": "x", "seed": "7"}, None),
+    ({"image_base64": "x", "seed": -1}, None),
+    (None, {"Content-Length": "abc"}),
+])
+def test_invalid_requests_return_400(tiny_model, tmp_path, body, headers):
+    async def scenario(server):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        return await _request(server.port, "POST", "/narrative", data, headers), server.metrics()
+    (status, payload), metrics = _run(tiny_model, tmp_path, scenario)
+    assert status == 400, payload
+    if body is not None: # Content-Length ผิดรูปแบบถูกปฏิเสธก่อนรู้ endpoint
+        assert metrics["latency"]["/narrative"]["status_counts"] == {"400": 1}
+    assert list(tmp_path.iterdir()) == []
+
+def test_oversized_upload_returns_413(tiny_model, tmp_path, monkeypatch):
+    import InferenceServer as server_module
+    monkeypatch.setattr(server_module, "MAX_UPLOAD_BYTES", 16)
+    async def scenario(server):
+        body = json.dumps({"image_base64": _image_base64()}).encode("utf-8")
+        return await _request(server.port, "POST", "/narrative", body)
+    status, _ = _run(tiny_model, tmp_path, scenario)
+    assert status == 413
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,29 @@
+from KeywordIndex import DEFAULT_VOCABULARY_PATH, KeywordIndex, load_vocabulary
+
+
+def make_index():
+    return KeywordIndex({"normal": [], "incisor": ["incisors"], "central incisor": ["central incisors"],
+                         "fracture": ["fractures", "fractured"]})
+
+def test_matches_whole_words_only():
+    index = make_index()
+    assert index.mentioned("The tooth looks abnormal.") == set()
+    assert index.mentioned("normality is preserved") == set()
+    assert index.mentioned("Looks normal.") == {"normal"}
+    assert index.mentioned("normal-appearing crown") == {"normal"} # เครื่องหมายวรรคตอนเป็นขอบเขตของคำ
+
+def test_aliases_map_to_the_main_keyword():
+    matches = make_index().find_all("Two Fractured incisors")
+    assert [(m.keyword, m.term) for m in matches] == [("fracture", "fractured"), ("incisor", "incisors")]
+
+def test_spans_point_into_the_original_text():
+    text = "Upper  CENTRAL\n incisors are fine"
+    spans = make_index().spans(text)
+    start, end = spans["central incisor"][0]
+    assert text[start:end] == "CENTRAL\n incisors" # ช่องว่างหลายตัวถูกยุบตอนค้นหา แต่ตำแหน่งอ้างถึงข้อความเดิม
+    assert text[slice(*spans["incisor"][0])] == "incisors" # keyword ที่ซ้อนทับกันถูกพบทั้งคู่
+
+def test_default_vocabulary_loads():
+    vocabulary = load_vocabulary(DEFAULT_VOCABULARY_PATH)
+    assert vocabulary["canine"] == ["canines"]
+    assert KeywordIndex(vocabulary).mentioned("no periapical lesions seen") == {"periapical", "lesion"}
@@ -0,0 +1,46 @@
+import json
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("peft")
+pytest.importorskip("accelerate")
+
+from LLaVADentist import MATERIALIZED_MANIFEST, LLaVADentist
+from TinyLLaVA import save_tiny_llava
+
+
+@pytest.fixture(scope="module")
+def saved_model(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("tiny")
+    base_model_path, adapter_path = save_tiny_llava(str(directory))
+    materialized_dir = str(directory / "materialized")
+    LLaVADentist.materialize(base_model_path, adapter_path, materialized_dir)
+    return base_model_path, adapter_path, materialized_dir
+
+def projector_params(dentist):
+    return {name: param for name, param in dentist.model.named_parameters() if "multi_modal_projector" in name}
+
+def test_materialized_projector_skips_the_fix(saved_model, capsys):
+    base_model_path, adapter_path, materialized_dir = saved_model
+    with open(os.path.join(materialized_dir, MATERIALIZED_MANIFEST), 'r', encoding='utf-8') as f:
+        assert json.load(f)["projector_dtype"] == "float32"
+    original = LLaVADentist(base_model_path, adapter_path)
+    capsys.readouterr()
+    materialized = LLaVADentist(base_model_path, adapter_path, materialized_dir=materialized_dir)
+    output = capsys.readouterr().out
+    assert materialized.load_source == "materialized"
+    assert "Skipping the fix" in output and "Applying critical fix" not in output
+    expected, loaded = projector_params(original), projector_params(materialized)
+    assert expected.keys() == loaded.keys()
+    for name, param in loaded.items():
+        assert param.dtype == torch.float32
+        assert torch.equal(param, expected[name])
+
+def test_stale_manifest_loads_the_original(saved_model, capsys):
+    base_model_path, adapter_path, materialized_dir = saved_model
+    dentist = LLaVADentist(base_model_path, adapter_path, materialized_dir=materialized_dir, adapter_hash="other")
+    assert dentist.load_source == "original"
+    assert "Applying critical fix" in capsys.readouterr().out
@@ -0,0 +1,50 @@
+import time
+import random
+import threading
+
+import pytest
+
+from Pipeline import EvaluationPipeline
+
+
+def test_model_sees_items_in_order_and_in_batches():
+    rng = random.Random(0)
+    def load(item):
+        time.sleep(rng.random() * 0.002) # Prefetch เสร็จไม่ตามลำดับ
+        return None if item % 5 == 0 else item
+    batches, written = [], []
+    lock = threading.Lock()
+    def write(job):
+        with lock: written.append(job)
+    pipeline = EvaluationPipeline(load, lambda batch: batches.append(list(batch)) or [x * 10 for x in batch], write,
+                                  prefetch_workers=4, writer_workers=3, queue_size=2, batch_size=3)
+    stats = pipeline.run(range(1, 15))
+    expected = [x for x in range(1, 15) if x % 5] # load ที่คืนค่า None ถูกข้าม
+    assert [x for batch in batches for x in batch] == expected
+    assert all(len(batch) <= 3 for batch in batches)
+    assert sorted(written) == [x * 10 for x in expected]
+    assert stats["prefetch"].items == 14 and stats["model"].items == len(expected) and stats["writer"].items == len(expected)
+
+def test_writer_queue_is_bounded():
+    active, peak = [0], [0]
+    lock = threading.Lock()
+    def write(job):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.005)
+        with lock: active[0] -= 1
+    EvaluationPipeline(lambda item: item, lambda batch: batch, write, writer_workers=8, queue_size=2).run(range(10))
+    assert peak[0] <= 2
+
+@pytest.mark.parametrize("stage", ["load", "process", "write"])
+def test_errors_propagate_from_every_stage(stage):
+    def fail_on_three(value):
+        if value == 3 or value == [3]:
+            raise RuntimeError(f"{stage} failed")
+        return value
+    functions = {"load": lambda item: item, "process": lambda batch: batch, "write": lambda job: None}
+    functions[stage] = fail_on_three
+    pipeline = EvaluationPipeline(functions["load"], functions["process"], functions["write"])
+    with pytest.raises(RuntimeError, match=f"{stage} failed"):
+        pipeline.run(range(5))
@@ -0,0 +1,82 @@
+import json
+import threading
+
+import pytest
+
+from Profiler import Profiler, format_timing_table, load_trace, summarize, write_chrome_trace
+
+
+def record(stage, duration, thread="MainThread", failed=False, **counts):
+    result = {"stage": stage, "start": 0.0, "duration": duration, "pid": 1, "thread": thread,
+              "counts": counts, "peak_rss_mb": 100.0}
+    if failed:
+        result["failed"] = True
+    return result
+
+
+def test_summarize_groups_by_stage():
+    rows = summarize([record("generate", 1.0, tokens=40), record("generate", 3.0, tokens=120),
+                      record("load", 0.5, failed=True)])
+    assert [row["stage"] for row in rows] == ["generate", "load"] # เรียงตามเวลารวมจากมากไปน้อย
+    generate, load = rows
+    assert generate["calls"] == 2 and generate["total_s"] == 4.0
+    assert generate["mean_ms"] == 2000.0 and generate["max_ms"] == 3000.0
+    assert generate["counts"] == {"tokens": 160}
+    assert generate["tokens_per_s"] == 40.0
+    assert load["failed"] == 1 and "tokens_per_s" not in load
+
+def test_format_timing_table():
+    assert format_timing_table([]) == "No profiling records."
+    lines = format_timing_table(summarize([record("generate", 2.0, tokens=100), record("load", 0.5, failed=True)])).splitlines()
+    assert lines[0].split()[:2] == ["Stage", "Calls"]
+    assert lines[1].split()[:6] == ["generate", "1", "2.00", "2000.0", "2000.0", "50.0"]
+    assert lines[1].endswith("tokens=100")
+    assert lines[2].endswith("failed=1")
+
+def test_spans_are_recorded_to_the_trace(tmp_path):
+    trace_path, chrome_path = str(tmp_path / "trace.jsonl"), str(tmp_path / "trace.json")
+    profiler = Profiler(trace_path, chrome_path, synchronize_cuda=False)
+    with profiler.span("generate", tokens=5) as span:
+        span.add(tokens=3)
+    with pytest.raises(RuntimeError):
+        with profiler.span("write"):
+            raise RuntimeError("disk full")
+    def prefetch():
+        with profiler.span("load"):
+            pass
+    thread = threading.Thread(target=prefetch, name="Prefetch")
+    thread.start(); thread.join()
+    profiler.close()
+    records = load_trace(trace_path, str(tmp_path / "missing.jsonl"))
+    assert [r["stage"] for r in records] == ["generate", "write", "load"]
+    assert records[0]["counts"] == {"tokens": 8}
+    assert records[1]["failed"] and records[2]["thread"] == "Prefetch"
+    with open(chrome_path, encoding="utf-8") as f:
+        events = json.load(f)["traceEvents"]
+    assert [(e["name"], e["ph"], e["tid"]) for e in events] == [("generate", "X", "MainThread"), ("write", "X", "MainThread"), ("load", "X", "Prefetch")]
+
+def test_disabled_profiler_records_nothing(tmp_path):
+    profiler = Profiler(str(tmp_path / "trace.jsonl"), enabled=False)
+    with profiler.span("generate", tokens=5) as span:
+        span.add(tokens=1)
+    profiler.close()
+    assert profiler.records == [] and not (tmp_path / "trace.jsonl").exists()
+
+def test_chrome_trace_uses_microseconds(tmp_path):
+    path = str(tmp_path / "trace.json")
+    write_chrome_trace([dict(record("generate", 0.25, tokens=2), start=1.5)], path)
+    with open(path, encoding="utf-8") as f:
+        event = json.load(f)["traceEvents"][0]
+    assert event["ts"] == 1.5e6 and event["dur"] == 0.25e6 and event["args"] == {"tokens": 2}
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["trace.json"] # ไม่มีไฟล์ชั่วคราวค้าง
+
+def test_concurrent_chrome_traces_stay_valid(tmp_path):
+    # หลาย Thread ใน process เดียวกันเขียนไฟล์เดียวกันพร้อมกัน (ชื่อไฟล์ชั่วคราวเดิมใช้ pid จึงชนกันได้)
+    path = str(tmp_path / "trace.json")
+    threads = [threading.Thread(target=write_chrome_trace, args=([record(f"stage{i}", 0.1)] * 200, path))
+               for i in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    with open(path, encoding="utf-8") as f:
+        assert len(json.load(f)["traceEvents"]) == 200
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["trace.json"]
@@ -0,0 +1,34 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from LLaVADentist import RepetitionStoppingCriteria
+
+
+def run_steps(criteria, sequences):
+    # เรียกเกณฑ์ทีละ token เหมือน generate แล้วคืนค่าขั้นที่แต่ละแถวหยุดครั้งแรก
+    input_ids = torch.tensor(sequences)
+    stopped = {}
+    for length in range(1, input_ids.shape[1] + 1):
+        for row in criteria(input_ids[:, :length], None).nonzero().flatten().tolist():
+            stopped.setdefault(row, length)
+    return stopped
+
+def test_stops_only_the_looping_row():
+    criteria = RepetitionStoppingCriteria(ngram_size=2, max_repeats=3, window=16)
+    looping = [5, 6, 5, 6, 5, 6, 5, 6]
+    varied = [1, 2, 3, 4, 5, 6, 7, 8]
+    assert run_steps(criteria, [looping, varied]) == {0: 6}
+    assert criteria.stopped_at == {0: 6}
+
+def test_repeats_outside_the_window_do_not_count():
+    criteria = RepetitionStoppingCriteria(ngram_size=2, max_repeats=3, window=6)
+    sequence = [5, 6, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 5, 6]
+    assert run_steps(criteria, [sequence]) == {}
+
+def test_ignores_padding_of_finished_rows_and_the_prompt():
+    pad = 0
+    criteria = RepetitionStoppingCriteria(ngram_size=2, max_repeats=3, prompt_length=6, ignore_token_ids=(pad, None))
+    prompt = [5, 6, 5, 6, 5, 6]
+    assert run_steps(criteria, [prompt + [1, 2, 3, pad, pad, pad, pad, pad, pad, pad]]) == {}
@@ -0,0 +1,78 @@
+import os
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from ResultCache import ResultCache, hash_path, make_key
+
+
+def test_make_key_depends_on_every_part():
+    base = make_key(image="a", seed=1, generation={"top_k": 50})
+    assert base == make_key(generation={"top_k": 50}, seed=1, image="a") # ไม่ขึ้นกับลำดับ
+    assert base != make_key(image="a", seed=2, generation={"top_k": 50})
+    assert base != make_key(image="a", seed=1, generation={"top_k": 40})
+
+def test_hash_path_follows_adapter_content(tmp_path):
+    adapter = tmp_path / "adapter"
+    adapter.mkdir()
+    (adapter / "adapter_model.safetensors").write_bytes(b"weights")
+    first = hash_path(str(adapter))
+    (adapter / "adapter_model.safetensors").write_bytes(b"new weights")
+    assert hash_path(str(adapter)) != first
+    assert hash_path(str(tmp_path / "missing")) == "missing"
+
+def test_narrative_and_heatmap_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    assert cache.get_narrative("k") is None
+    cache.put_narrative("k", "caries on the molar", {"stop_reason": "eos"})
+    assert cache.get_narrative("k") == {"generated_narrative": "caries on the molar", "generation_info": {"stop_reason": "eos"}}
+    cache.put_heatmap("h", np.ones((2, 2)))
+    assert np.array_equal(cache.get_heatmap("h"), np.ones((2, 2)))
+    assert cache.get_heatmap("missing") is None
+
+
+def test_case_requires_its_cached_heatmaps(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    result_data = {"case_name": "a", "xai_explanations": {"caries": {"heatmap_cache_key": "h"}}}
+    cache.put_case("c", result_data)
+    assert cache.get_case("c") is None # Heatmap ดิบที่อ้างถึงยังไม่อยู่ใน Cache
+    cache.put_heatmap("h", np.ones((2, 2)))
+    assert cache.get_case("c") == result_data
+
+
+@pytest.fixture
+def case(tmp_path):
+    image_path = tmp_path / "case.png"
+    image_path.write_bytes(b"image bytes")
+    gt_path = tmp_path / "case.json"
+    gt_path.write_text(json.dumps({"image_path": str(image_path), "expert_narrative": "caries"}))
+    return {"case_name": "case", "gt_path": str(gt_path), "image_path": str(image_path),
+            "ground_truth": json.loads(gt_path.read_text()), "ground_truth_hash": "gt-v1"}
+
+def test_case_keys_invalidate_only_what_changed(case):
+    main = pytest.importorskip("main")
+    main.assign_cache_keys(case, "adapter-v1")
+    narrative_key, case_key = case["narrative_key"], case["case_key"]
+
+    # Ground Truth เปลี่ยน: คำนวณผลลัพธ์ทั้งเคสใหม่ แต่ยังใช้ Narrative เดิม
+    case["ground_truth_hash"] = "gt-v2"
+    main.assign_cache_keys(case, "adapter-v1")
+    assert case["narrative_key"] == narrative_key and case["case_key"] != case_key
+
+    # Adapter หรือรูปภาพเปลี่ยน: Narrative หมดอายุ
+    main.assign_cache_keys(case, "adapter-v2")
+    assert case["narrative_key"] != narrative_key
+    with open(case["image_path"], "ab") as f: f.write(b"edited")
+    main.assign_cache_keys(case, "adapter-v1")
+    assert case["narrative_key"] != narrative_key
+
+def test_heatmap_key_follows_spans_and_mention(case):
+    main = pytest.importorskip("main")
+    main.assign_cache_keys(case, "adapter-v1")
+    key = main.heatmap_cache_key(case, "caries", {"caries": [(0, 6)]})
+    assert key == main.heatmap_cache_key(case, "caries", {"caries": [(0, 6)]})
+    assert key != main.heatmap_cache_key(case, "caries", {"caries": [(0, 6), (20, 26)]}) # ปรากฏเพิ่มอีกครั้ง
+    assert key != main.heatmap_cache_key(case, "caries", {}) # ไม่ปรากฏ ใช้ตำแหน่งสำรอง
+    assert key != main.heatmap_cache_key(case, "molar", {"molar": [(0, 6)]})
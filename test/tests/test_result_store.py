@@ -0,0 +1,70 @@
+import os
+import json
+
+from ResultStore import STORE_COLUMNS, ResultStore, to_row
+
+
+def make_result(case_name, narrative="caries on the upper molar", rouge_l=0.5):
+    return {"case_name": case_name, "image_path": f"{case_name}.jpg", "generated_narrative": narrative,
+            "rouge_scores": {"rouge1": 0.6, "rouge2": 0.4, "rougeL": rouge_l, "rougeLsum": rouge_l},
+            "generation_info": {"stop_reason": "eos", "tokens_saved": 0}}
+
+def test_round_trip_and_replace(tmp_path):
+    store = ResultStore(str(tmp_path))
+    store.append(make_result("b"), ["caries"])
+    store.append(make_result("a"))
+    store.append(make_result("b", narrative="normal", rouge_l=0.9), ["normal"])
+    store.flush()
+    assert store.get("b") == to_row(make_result("b", narrative="normal", rouge_l=0.9), ["normal"])
+    assert store.get("missing") is None
+    reopened = ResultStore(str(tmp_path))
+    assert [row["case_name"] for row in reopened.rows()] == ["a", "b"]
+    assert reopened.collect_columns(["rougeL"]) == {"rougeL": [0.5, 0.9]}
+
+def test_compact_keeps_only_the_latest_rows(tmp_path):
+    store = ResultStore(str(tmp_path))
+    for i in range(5):
+        store.append(make_result("a", rouge_l=i / 10))
+    store.append(make_result("b"))
+    rows_before = store.rows()
+    size_before = os.path.getsize(store.data_path)
+    store.compact()
+    assert os.path.getsize(store.data_path) < size_before
+    with open(store.data_path, encoding="utf-8") as f: assert len(f.readlines()) == 2
+    assert store.rows() == rows_before
+    assert ResultStore(str(tmp_path)).rows() == rows_before
+
+def test_rebuilds_index_when_not_flushed(tmp_path):
+    store = ResultStore(str(tmp_path))
+    store.append(make_result("a"))
+    store.flush()
+    store.append(make_result("b")) # ไม่ได้ flush: index บนดิสก์มีขนาดข้อมูลไม่ตรง
+    reopened = ResultStore(str(tmp_path))
+    assert [row["case_name"] for row in reopened.rows()] == ["a", "b"]
+    reopened.flush()
+    with open(reopened.index_path, encoding="utf-8") as f: assert set(json.load(f)["rows"]) == {"a", "b"}
+
+def test_skips_a_partially_written_last_line(tmp_path):
+    store = ResultStore(str(tmp_path))
+    store.append(make_result("a"))
+    with open(store.data_path, "ab") as f: f.write(b'{"case_name": "b", "gen') # process ถูกหยุดกลางคัน
+    reopened = ResultStore(str(tmp_path))
+    assert [row["case_name"] for row in reopened.rows()] == ["a"]
+    reopened.append(make_result("c"))
+    assert [row["case_name"] for row in ResultStore(str(tmp_path)).rows()] == ["a", "c"]
+
+def test_reloads_after_external_change(tmp_path):
+    first, second = ResultStore(str(tmp_path)), ResultStore(str(tmp_path))
+    first.append(make_result("a"))
+    assert second.get("a")["case_name"] == "a"
+    second.append(make_result("b"))
+    assert [row["case_name"] for row in first.rows()] == ["a", "b"]
+
+def test_collect_columns_defaults_and_missing_values(tmp_path):
+    store = ResultStore(str(tmp_path))
+    store.append(make_result("b"), ["caries"])
+    store.append_row({"case_name": "a"}) # แถวที่ไม่มีคอลัมน์อื่น
+    columns = store.collect_columns()
+    assert list(columns) == list(STORE_COLUMNS)
+    assert columns["case_name"] == ["a", "b"]
+    assert columns["expected_keywords"] == [None, ["caries"]]
@@ -0,0 +1,73 @@
+import random
+
+import pytest
+
+from RougeScorer import RougeScorer, _lcs_indices, lcs_length, tokenize
+
+
+def brute_force_lcs(a, b):
+    # ตาราง DP แบบตรงไปตรงมา ใช้เป็นค่าอ้างอิงของ lcs_length แบบ Bit-parallel
+    table = [[0] * (len(b) + 1) for _ in range(len(a) + 1)]
+    for i in range(1, len(a) + 1):
+        for j in range(1, len(b) + 1):
+            table[i][j] = table[i - 1][j - 1] + 1 if a[i - 1] == b[j - 1] else max(table[i - 1][j], table[i][j - 1])
+    return table[-1][-1]
+
+def brute_force_rouge_l(prediction, reference):
+    prediction_tokens, reference_tokens = tokenize(prediction), tokenize(reference)
+    lcs = brute_force_lcs(reference_tokens, prediction_tokens)
+    if not lcs:
+        return 0.0
+    precision, recall = lcs / len(prediction_tokens), lcs / len(reference_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+def random_tokens(rng, length, vocabulary="abcde"):
+    return tuple(rng.choice(vocabulary) for _ in range(length))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_lcs_length_matches_brute_force(seed):
+    rng = random.Random(seed)
+    # ความยาวเกิน 64 คำเพื่อครอบคลุม bit-vector หลาย word
+    a, b = random_tokens(rng, rng.randint(0, 90)), random_tokens(rng, rng.randint(0, 90))
+    assert lcs_length(a, b) == brute_force_lcs(a, b)
+
+@pytest.mark.parametrize("seed", range(10))
+def test_lcs_indices_form_a_common_subsequence(seed):
+    rng = random.Random(seed)
+    ref, can = random_tokens(rng, rng.randint(1, 30)), random_tokens(rng, rng.randint(1, 30))
+    indices = sorted(_lcs_indices(ref, can))
+    assert len(indices) == brute_force_lcs(ref, can)
+    remaining = iter(can)
+    assert all(ref[i] in remaining for i in indices) # เป็น subsequence ของ can ตามลำดับ
+
+def test_rouge_l_matches_brute_force():
+    rng = random.Random(0)
+    words = ["caries", "molar", "upper", "left", "periapical", "lesion", "no", "the", "is", "visible"]
+    predictions = [" ".join(rng.choice(words) for _ in range(rng.randint(1, 25))) for _ in range(30)]
+    references = [" ".join(rng.choice(words) for _ in range(rng.randint(1, 25))) for _ in range(30)]
+    scores = RougeScorer(["rougeL"]).compute(predictions, references, use_aggregator=False)["rougeL"]
+    assert scores == pytest.approx([brute_force_rouge_l(p, r) for p, r in zip(predictions, references)])
+
+def test_rouge_n_and_aggregation():
+    scorer = RougeScorer(["rouge1", "rouge2"])
+    assert scorer.score("the cat sat", "the cat sat") == {"rouge1": 1.0, "rouge2": 1.0}
+    assert scorer.score("the cat", "a dog") == {"rouge1": 0.0, "rouge2": 0.0}
+    assert scorer.score("The CAT, sat!", ["a dog", "the cat sat"])["rouge1"] == 1.0 # ใช้ reference ที่ดีที่สุด
+    aggregated = scorer.compute(["the cat sat", "the cat"], ["the cat sat", "a dog"])
+    assert aggregated == {"rouge1": 0.5, "rouge2": 0.5}
+
+def test_rouge_lsum_single_line_equals_rouge_l():
+    scores = RougeScorer(["rougeL", "rougeLsum"]).score("caries on the upper molar", "upper left molar caries")
+    assert scores["rougeLsum"] == scores["rougeL"]
+
+def test_consensus_index_picks_the_medoid():
+    scorer = RougeScorer()
+    samples = ["caries on the upper molar", "zzz qqq", "caries on the upper left molar", "caries on upper molar"]
+    totals = [sum(brute_force_rouge_l(a, b) for j, b in enumerate(samples) if j != i) for i, a in enumerate(samples)]
+    assert scorer.consensus_index(samples) == totals.index(max(totals))
+    assert scorer.consensus_index(["only one"]) == 0
+
+def test_unsupported_rouge_type():
+    with pytest.raises(ValueError):
+        RougeScorer(["rougeX"])
@@ -0,0 +1,41 @@
+import pytest
+
+main = pytest.importorskip("main")
+from RougeScorer import RougeScorer
+
+SAMPLES = ["caries on the upper molar", "Error: Image not found at x.png", "caries on the upper left molar",
+           "a fractured crown"]
+
+
+def test_consensus_selection_skips_failed_samples(monkeypatch):
+    monkeypatch.setattr(main, "SAMPLE_SELECTION", "consensus")
+    assert main.select_sample(RougeScorer(), SAMPLES, "a fractured crown") == 0 # ไม่ดู expert_narrative
+    assert main.select_sample(RougeScorer(), ["Error: a", "Error: b"], "x") == 0
+
+def test_best_selection_uses_the_expert_narrative(monkeypatch):
+    monkeypatch.setattr(main, "SAMPLE_SELECTION", "best")
+    assert main.select_sample(RougeScorer(), SAMPLES, "a fractured crown") == 3
+    assert main.select_sample(RougeScorer(), SAMPLES, "") == 0 # ไม่มี expert_narrative ใช้ consensus แทน
+
+def test_sample_score_stats():
+    stats = main.sample_score_stats({"rougeL": [0.2, 0.4, 0.6]}, selected=2)
+    assert stats["num_samples"] == 3
+    assert stats["selected"] == {"rougeL": 0.6}
+    assert stats["rougeL"]["mean"] == pytest.approx(0.4)
+    assert stats["rougeL"]["std"] == pytest.approx((0.08 / 3) ** 0.5)
+    assert (stats["rougeL"]["min"], stats["rougeL"]["max"]) == (0.2, 0.6)
+
+def test_k_samples_per_image(tmp_path):
+    pytest.importorskip("torch")
+    pytest.importorskip("peft")
+    Image = pytest.importorskip("PIL.Image")
+    from TinyLLaVA import create_tiny_llava
+    dentist = create_tiny_llava()
+    dentist.GENERATION_CONFIG = {**dentist.GENERATION_CONFIG, "max_new_tokens": 6}
+    image_path = str(tmp_path / "image.png")
+    Image.new("RGB", (32, 32), (200, 180, 150)).save(image_path)
+    responses, infos = dentist.generate_narratives([image_path, str(tmp_path / "missing.png")], "Describe.",
+                                                   return_info=True, seed=0, num_samples=3)
+    assert len(responses[0]) == 3 and len(infos[0]) == 3
+    assert all(info["tokens_generated"] <= 6 for info in infos[0])
+    assert responses[1] == [f"Error: Image not found at {tmp_path / 'missing.png'}"] * 3
@@ -0,0 +1,82 @@
+import os
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from HeatmapStore import HeatmapStore
+from ResultStore import ResultStore
+from Sharding import is_shard_complete, mark_shard_complete, merge_shards, parse_shard, select_shard, shard_dir
+
+
+def write_shard(output_dir, index, count, cases, complete=True):
+    # เขียนผลลัพธ์ของ Shard แบบเดียวกับ main.py --shard: *_result.json, ResultStore และ HeatmapStore
+    directory = shard_dir(output_dir, index, count)
+    results_dir = os.path.join(directory, "results_json")
+    os.makedirs(results_dir, exist_ok=True)
+    result_store, heatmap_store = ResultStore(results_dir), HeatmapStore(results_dir)
+    for case_name, heatmaps in cases.items():
+        result_data = {"case_name": case_name, "generated_narrative": f"narrative of {case_name}"}
+        with open(os.path.join(results_dir, f"{case_name}_result.json"), 'w', encoding='utf-8') as f:
+            json.dump(result_data, f)
+        result_store.append(result_data, sorted(heatmaps))
+        heatmap_store.put_case(case_name, heatmaps)
+    result_store.flush()
+    heatmap_store.flush()
+    if complete:
+        mark_shard_complete(directory, len(cases))
+
+def store_snapshot(output_dir):
+    results_dir = os.path.join(output_dir, "results_json")
+    heatmap_store = HeatmapStore(results_dir)
+    heatmaps = {key: heatmap_store.get(*key).tolist() for key in heatmap_store.keys()}
+    sizes = {name: os.path.getsize(os.path.join(results_dir, name)) for name in sorted(os.listdir(results_dir))}
+    return ResultStore(results_dir).rows(), heatmaps, sizes
+
+def grid(value):
+    return np.full((4, 4), value, dtype=np.float32)
+
+
+def test_parse_and_select_shard():
+    assert parse_shard("1/3") == (1, 3)
+    for text in ("3/3", "-1/2", "a/b"):
+        with pytest.raises(ValueError):
+            parse_shard(text)
+    files = [f"case_{i}.json" for i in range(20)]
+    shards = [select_shard(files, index, 3) for index in range(3)]
+    assert sorted(path for shard in shards for path in shard) == sorted(files) # ทุกเคสอยู่ใน Shard เดียวพอดี
+
+def test_merge_is_idempotent(tmp_path):
+    output_dir = str(tmp_path)
+    write_shard(output_dir, 0, 2, {"a": {"caries": grid(0.1), "molar": grid(0.2)}})
+    write_shard(output_dir, 1, 2, {"b": {"lesion": grid(0.3)}}, complete=False)
+    first = merge_shards(output_dir, count=2)
+    assert first["cases"] == 2 and first["updated"] == 2
+    assert first["incomplete_shards"] == ["1-of-2"]
+    snapshot = store_snapshot(output_dir)
+    assert [row["case_name"] for row in snapshot[0]] == ["a", "b"]
+    assert set(snapshot[1]) == {("a", "caries"), ("a", "molar"), ("b", "lesion")}
+
+    second = merge_shards(output_dir, count=2)
+    assert second["updated"] == 0
+    assert store_snapshot(output_dir) == snapshot # ไฟล์ไม่โตขึ้นเมื่อรวมซ้ำ
+
+def test_merge_replaces_changed_cases(tmp_path):
+    output_dir = str(tmp_path)
+    write_shard(output_dir, 0, 1, {"a": {"caries": grid(0.1)}})
+    merge_shards(output_dir, count=1)
+    write_shard(output_dir, 0, 1, {"a": {"caries": grid(0.5), "lesion": grid(0.2)}}) # รัน Shard ใหม่ ผลลัพธ์เปลี่ยน
+    assert merge_shards(output_dir, count=1)["updated"] == 1
+    assert ResultStore(os.path.join(output_dir, "results_json")).get("a")["expected_keywords"] == ["caries", "lesion"]
+    heatmap_store = HeatmapStore(os.path.join(output_dir, "results_json"))
+    assert heatmap_store.keys() == [("a", "caries"), ("a", "lesion")]
+    assert np.allclose(heatmap_store.get("a", "caries"), 0.5, atol=1e-3)
+
+def test_shard_complete_settings(tmp_path):
+    directory = str(tmp_path)
+    assert not is_shard_complete(directory)
+    mark_shard_complete(directory, 3, {"samples": 1, "sample_selection": "consensus"})
+    assert is_shard_complete(directory)
+    assert is_shard_complete(directory, {"samples": 1, "sample_selection": "consensus"})
+    assert not is_shard_complete(directory, {"samples": 5, "sample_selection": "consensus"})
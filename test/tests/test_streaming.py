@@ -0,0 +1,74 @@
+import random
+import threading
+
+import pytest
+
+from ResponseCleaner import (EMPTY_RESPONSE_ERROR, NO_PARSABLE_OUTPUT_ERROR, ResponseCleaner, clean_response,
+                             parse_response)
+
+
+def stream(text, rng):
+    # ส่งข้อความเป็นส่วนๆ ขนาดสุ่ม แบบเดียวกับ TextIteratorStreamer ที่ส่งทีละคำ/token
+    cleaner, chunks, position = ResponseCleaner(), [], 0
+    while position < len(text) and not cleaner.finished:
+        size = rng.randint(1, 6)
+        chunks.append(cleaner.feed(text[position:position + size]))
+        position += size
+    chunks.append(cleaner.flush())
+    return cleaner, chunks
+
+TEXTS = [
+    "  The upper molar shows caries.  ",
+    "Normal crown.\nASSISTANT: repeated answer",
+    "Lesion near ASSIST the apex ASSISTANT",
+    "\n\n  periapical   lesion \n",
+    "ASSISTANT: everything after the marker",
+    "",
+    "Trailing partial marker ASSI",
+]
+
+@pytest.mark.parametrize("text", TEXTS)
+@pytest.mark.parametrize("seed", range(5))
+def test_streamed_chunks_match_clean_response(text, seed):
+    cleaner, chunks = stream(text, random.Random(seed))
+    assert "".join(chunks) == clean_response(text)
+    assert cleaner.text == clean_response(text)
+
+def test_stops_at_a_new_assistant_turn():
+    cleaner = ResponseCleaner()
+    assert cleaner.feed("Caries on the molar. ASSIST") == "Caries on the molar." # ส่วนต้นของ marker ถูกเก็บไว้ก่อน
+    assert cleaner.feed("ANT: more") == ""
+    assert cleaner.finished
+    assert cleaner.feed("ignored") == "" and cleaner.flush() == ""
+    assert cleaner.text == "Caries on the molar."
+
+def test_never_emits_trailing_whitespace_early():
+    cleaner = ResponseCleaner()
+    assert cleaner.feed("  Normal ") == "Normal"
+    assert cleaner.feed(" crown") == "  crown" # ช่องว่างที่ถูกเก็บไว้ถูกส่งเมื่อมีข้อความตามมา
+    assert cleaner.flush() == ""
+
+INSTRUCTION = "Describe the teeth."
+
+@pytest.mark.parametrize("text, expected", [
+    (" Caries on the molar.\nASSISTANT: again", "Caries on the molar."),
+    ("  \n", EMPTY_RESPONSE_ERROR),
+    # โมเดลคัดลอก Prompt กลับมา
+    ("USER: <image>\nDescribe the teeth.\nASSISTANT: Normal crown.", "Normal crown."),
+    ("USER: <image>\nDescribe the teeth.\nASSISTANT:", EMPTY_RESPONSE_ERROR),
+    ("USER: <image>\nDescribe the teeth. Fractured crown.", "Fractured crown."),
+    ("USER: \nDescribe the teeth.", NO_PARSABLE_OUTPUT_ERROR), # <image> ถูกตัดออกตอนถอดรหัส
+])
+def test_parse_response(text, expected):
+    assert parse_response(text, INSTRUCTION) == expected
+
+def test_cancellation_stopping_criteria():
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("transformers")
+    from LLaVADentist import CancellationStoppingCriteria
+    cancel_event = threading.Event()
+    criteria = CancellationStoppingCriteria(cancel_event)
+    input_ids = torch.zeros((3, 5), dtype=torch.long)
+    assert not criteria(input_ids, None).any()
+    cancel_event.set()
+    assert criteria(input_ids, None).all()
@@ -0,0 +1,59 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("peft")
+Image = pytest.importorskip("PIL.Image")
+
+from LLaVADentist import LLaVADentist
+from TinyLLaVA import build_tiny_model, build_tiny_processor, build_tiny_tokenizer, create_tiny_llava
+
+NARRATIVE = "USER: <image>\nDescribe.\nASSISTANT: The image shows caries and a fractured crown."
+
+
+def build_dentist(xai_target_layers, vision_feature_layer=-2):
+    # Vision Tower ขนาดเล็กมี 3 Layer (0-2) และ Projector อ่าน hidden_states[vision_feature_layer]
+    tokenizer = build_tiny_tokenizer()
+    model = build_tiny_model(tokenizer, vision_feature_layer=vision_feature_layer)
+    return LLaVADentist.from_components(model, build_tiny_processor(tokenizer), xai_target_layers=xai_target_layers)
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = str(tmp_path / "image.png")
+    Image.new("RGB", (32, 32), (200, 180, 150)).save(path)
+    return path
+
+
+def test_feature_layer_follows_the_config():
+    dentist = create_tiny_llava(lora_rank=2)
+    assert dentist.target_layer_indices(("feature",)) == [1] # hidden_states[-2] ของ 3 Layer = output ของ Layer 1
+    assert dentist.target_layer_indices((-1, 0, "feature")) == [0, 1, 2]
+    # ค้นหาโมดูลได้แม้ชื่อมี prefix ของ PEFT
+    assert len(dentist.layer_capture.names) == 1
+    assert dentist.layer_capture.names[0].startswith("base_model.model.")
+    assert dentist.layer_capture.names[0].endswith("encoder.layers.1.layer_norm2")
+
+def test_invalid_target_layers_are_rejected():
+    dentist = create_tiny_llava()
+    for spec in ((3,), (-4,), ("last",)):
+        with pytest.raises(ValueError):
+            dentist.target_layer_indices(spec)
+    with pytest.raises(ValueError): # hidden_states[0] คือ Patch Embedding ไม่ใช่ Encoder Layer
+        build_dentist(("feature",), vision_feature_layer=0)
+
+def test_hooks_are_installed_once(image_path):
+    dentist = build_dentist(("feature",))
+    module = dict(dentist.model.named_modules())[dentist.layer_capture.names[0]]
+    hooks = len(module._forward_hooks)
+    for _ in range(2):
+        heatmaps = dentist.generate_xai_heatmaps(image_path, NARRATIVE, ["caries", "crown"])
+        assert all(heatmap is not None for heatmap in heatmaps.values())
+    assert len(module._forward_hooks) == hooks
+
+def test_multi_layer_heatmaps(image_path):
+    dentist = build_dentist(("feature", -1))
+    assert len(dentist.layer_capture.names) == 2
+    heatmaps = dentist.generate_xai_heatmaps(image_path, NARRATIVE, ["caries", "crown"])
+    for heatmap in heatmaps.values():
+        assert heatmap.shape == (4, 4)
+        assert heatmap.min() >= 0 and heatmap.max() <= 1
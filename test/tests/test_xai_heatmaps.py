@@ -0,0 +1,72 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("peft")
+Image = pytest.importorskip("PIL.Image")
+from tokenizers import Tokenizer, models, pre_tokenizers
+
+from LLaVADentist import LLaVADentist
+
+# คำศัพท์ของ Tokenizer ขนาดเล็ก (แบ่งคำด้วยช่องว่าง)
+WORDS = ["USER:", "ASSISTANT:", "The", "upper", "molar", "shows", "caries", "and", "a", "fractured", "crown", "."]
+NARRATIVE = "USER: <image>\nDescribe.\nASSISTANT: The upper molar shows caries and a fractured crown ."
+
+
+def build_tiny_dentist(xai_gradient_mode="activation", vision_layers=24, hidden_size=32, image_size=32, patch_size=8):
+    """LLaVADentist ที่ใช้ LlavaForConditionalGeneration ขนาดเล็กแบบสุ่มน้ำหนักบน CPU (ไม่โหลดโมเดลจริง)"""
+    vocab = {token: i for i, token in enumerate(["<unk>", "<pad>", "<s>", "</s>", "<image>"] + WORDS)}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="<unk>", pad_token="<pad>",
+                                                     bos_token="<s>", eos_token="</s>",
+                                                     model_input_names=["input_ids", "attention_mask"])
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<image>"]})
+    image_processor = transformers.CLIPImageProcessor(size={"shortest_edge": image_size},
+                                                      crop_size={"height": image_size, "width": image_size})
+    processor = transformers.LlavaProcessor(image_processor=image_processor, tokenizer=tokenizer, patch_size=patch_size,
+                                            vision_feature_select_strategy="default")
+    config = transformers.LlavaConfig(
+        vision_config=transformers.CLIPVisionConfig(
+            hidden_size=hidden_size, intermediate_size=hidden_size * 2, num_hidden_layers=vision_layers,
+            num_attention_heads=4, image_size=image_size, patch_size=patch_size, projection_dim=hidden_size),
+        text_config=transformers.LlamaConfig(
+            vocab_size=len(tokenizer), hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+            num_hidden_layers=1, num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=256),
+        image_token_index=vocab["<image>"], image_seq_length=(image_size // patch_size) ** 2, vision_feature_layer=-1, vision_feature_select_strategy="default",
+    )
+    torch.manual_seed(0)
+    model = transformers.LlavaForConditionalGeneration(config)
+    return LLaVADentist.from_components(model, processor, xai_gradient_mode=xai_gradient_mode)
+
+@pytest.fixture(scope="module")
+def tiny_dentist():
+    return build_tiny_dentist()
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = str(tmp_path / "image.png")
+    Image.new("RGB", (32, 32), (200, 180, 150)).save(path)
+    return path
+
+
+def test_all_keywords_share_one_forward_pass(tiny_dentist, image_path):
+    calls = []
+    handle = tiny_dentist.model.register_forward_hook(lambda module, args, output: calls.append(1))
+    try:
+        heatmaps = tiny_dentist.generate_xai_heatmaps(image_path, NARRATIVE, ["caries", "crown", "molar"])
+    finally:
+        handle.remove()
+    assert len(calls) == 1
+    assert set(heatmaps) == {"caries", "crown", "molar"}
+    for heatmap in heatmaps.values():
+        assert heatmap.shape == (4, 4) # ตาราง Patch 4x4 ของรูป 32px (Patch 8px) หลังตัด CLS token
+        assert heatmap.min() >= 0 and heatmap.max() <= 1
+
+def test_incomplete_narrative_skips_xai(tiny_dentist, image_path):
+    heatmaps = tiny_dentist.generate_xai_heatmaps(image_path, "USER: <image>\nDescribe.", ["caries"])
+    assert heatmaps == {"caries": None}
+
+def test_activation_mode_allocates_no_parameter_gradients(tiny_dentist, image_path):
+    tiny_dentist.generate_xai_heatmaps(image_path, NARRATIVE, ["caries", "crown"])
+    assert all(param.grad is None for param in tiny_dentist.model.parameters())
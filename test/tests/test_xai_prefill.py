@@ -0,0 +1,73 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("peft")
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+from TinyLLaVA import create_tiny_llava
+
+# keyword อยู่ต้นคำตอบ ข้อความหลัง "molar" ไม่มีผลต่อเป้าหมายของ keyword
+NARRATIVE = ("USER: <image>\nDescribe.\nASSISTANT: The image shows caries on the molar, with a healthy gingiva "
+             "and a composite restoration near the midline.")
+
+
+@pytest.fixture(scope="module")
+def dentist():
+    return create_tiny_llava()
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = str(tmp_path / "image.png")
+    Image.new("RGB", (32, 32), (200, 180, 150)).save(path)
+    return path
+
+def heatmaps_with_info(dentist, image_path, keywords):
+    info = {}
+    heatmaps = dentist.generate_xai_heatmaps(image_path, NARRATIVE, keywords, info=info)
+    return heatmaps, info
+
+
+def test_prefill_stops_after_the_last_keyword(dentist, image_path, monkeypatch):
+    heatmaps, info = heatmaps_with_info(dentist, image_path, ["caries", "molar"])
+    assert all(heatmap is not None for heatmap in heatmaps.values())
+    assert info["prefill_tokens_saved"] > 0
+    # ผลลัพธ์เท่ากับการส่งทั้งลำดับเข้า Forward Pass
+    monkeypatch.setattr(type(dentist), "_xai_prefill_length", lambda self, input_ids, *args: int(input_ids.shape[0]))
+    full_heatmaps, full_info = heatmaps_with_info(dentist, image_path, ["caries", "molar"])
+    assert full_info["prefill_tokens_saved"] == 0
+    assert full_info["prefill_tokens"] == info["prefill_tokens"] + info["prefill_tokens_saved"]
+    for keyword in heatmaps:
+        np.testing.assert_allclose(heatmaps[keyword], full_heatmaps[keyword], atol=1e-5)
+
+def test_later_keywords_need_a_longer_prefill(dentist, image_path):
+    _, early = heatmaps_with_info(dentist, image_path, ["caries"])
+    _, late = heatmaps_with_info(dentist, image_path, ["caries", "restoration"])
+    assert early["prefill_tokens"] < late["prefill_tokens"]
+
+def test_omitted_keyword_is_scored_after_the_last_mention(dentist, image_path):
+    info = {}
+    heatmaps, attribution = dentist.generate_xai_heatmaps(image_path, NARRATIVE, ["caries", "molar", "fractured"],
+                                                          return_attribution=True, info=info)
+    assert info["prefill_tokens_saved"] > 0 # ไม่ต้องส่งทั้งลำดับเพราะ keyword ที่ไม่ปรากฏ
+    molar_end = attribution["molar"]["token_positions"][-1][-1]
+    assert attribution["fractured"] == {"token_positions": [[molar_end + 1]], "fallback": "continuation"}
+    assert info["prefill_tokens"] == molar_end + 1
+    # ผลลัพธ์เท่ากับข้อความที่จบที่ "molar" จริง
+    truncated = NARRATIVE[:NARRATIVE.index("molar") + len("molar")]
+    truncated_heatmaps = dentist.generate_xai_heatmaps(image_path, truncated, ["caries", "molar", "fractured"])
+    np.testing.assert_allclose(heatmaps["fractured"], truncated_heatmaps["fractured"], atol=1e-5)
+
+def test_no_mentioned_keyword_uses_the_full_sequence(dentist, image_path):
+    _, info = heatmaps_with_info(dentist, image_path, ["fractured"])
+    assert info["prefill_tokens_saved"] == 0
+
+def test_fallback_does_not_depend_on_the_requested_subset(dentist, image_path):
+    # main.py ขอเฉพาะ keyword ที่ไม่มีใน Cache แต่ส่งตำแหน่งของทุก keyword ที่ปรากฏ
+    full_text_spans = {keyword: [(NARRATIVE.index(keyword), NARRATIVE.index(keyword) + len(keyword))]
+                       for keyword in ("caries", "molar")}
+    alone = dentist.generate_xai_heatmaps(image_path, NARRATIVE, ["fractured"], keyword_spans=full_text_spans)
+    together = dentist.generate_xai_heatmaps(image_path, NARRATIVE, ["caries", "molar", "fractured"],
+                                             keyword_spans=full_text_spans)
+    np.testing.assert_allclose(alone["fractured"], together["fractured"], atol=1e-5)